@@ -0,0 +1,86 @@
+import os
+import sys
+try:
+    import click
+except ImportError:
+    sys.exit("You have to manually install the 'click' package to run this file.")
+
+import random
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault("HELTOUR_ENV", "LIVE")
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "heltour.settings")
+
+import django
+django.setup()
+
+from heltour.tournament.models import find, PairingIndex, LonePlayerPairing, PlayerBye
+
+
+def make_season(players, rounds, seed):
+    # Synthetic lone season built from unsaved model instances (no database access needed)
+    rnd = random.Random(seed)
+    player_ids = list(range(1, players + 1))
+    pairings = []
+    byes = []
+    for round_id in range(1, rounds + 1):
+        rnd.shuffle(player_ids)
+        if len(player_ids) % 2:
+            byes.append(PlayerBye(round_id=round_id, player_id=player_ids[-1], type='full-point-pairing-bye'))
+        for i in range(0, len(player_ids) - 1, 2):
+            pairings.append(LonePlayerPairing(round_id=round_id, white_id=player_ids[i], black_id=player_ids[i + 1],
+                                              result=rnd.choice(['1-0', '1/2-1/2', '0-1']), pairing_order=i // 2))
+    return player_ids, pairings, byes
+
+
+def scan_lookup(player_ids, rounds, pairings, byes):
+    # The previous approach: filter the round's pairings for every player
+    found = 0
+    for round_id in range(1, rounds + 1):
+        round_pairings = [p for p in pairings if p.round_id == round_id]
+        round_byes = [b for b in byes if b.round_id == round_id]
+        for player_id in player_ids:
+            white_pairing = find(round_pairings, white_id=player_id)
+            black_pairing = find(round_pairings, black_id=player_id)
+            bye = find(round_byes, player_id=player_id)
+            found += (white_pairing or black_pairing or bye) is not None
+    return found
+
+
+def index_lookup(player_ids, rounds, pairings, byes):
+    found = 0
+    pairing_index = PairingIndex(pairings, byes)
+    for round_id in range(1, rounds + 1):
+        for player_id in player_ids:
+            white_pairing = pairing_index.white_pairing(round_id, player_id)
+            black_pairing = pairing_index.black_pairing(round_id, player_id)
+            bye = pairing_index.bye(round_id, player_id)
+            found += (white_pairing or black_pairing or bye) is not None
+    return found
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+@click.command()
+@click.option('--players', default=300, help='number of players in the season.')
+@click.option('--rounds', default=11, help='number of completed rounds.')
+@click.option('--seed', default=0, help='random seed for the synthetic season.')
+def run(players, rounds, seed):
+    player_ids, pairings, byes = make_season(players, rounds, seed)
+    scan_found, scan_time = timed(scan_lookup, player_ids, rounds, pairings, byes)
+    index_found, index_time = timed(index_lookup, player_ids, rounds, pairings, byes)
+    assert scan_found == index_found == players * rounds
+
+    print(f"{players} players, {rounds} rounds, {len(pairings)} pairings, {len(byes)} byes")
+    print(f"find() scans:   {scan_time * 1000:10.2f} ms")
+    print(f"PairingIndex:   {index_time * 1000:10.2f} ms")
+    print(f"Speedup:        {scan_time / index_time:10.1f}x")
+
+
+if __name__ == "__main__":
+    run()
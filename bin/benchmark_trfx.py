@@ -0,0 +1,90 @@
+import os
+import sys
+try:
+    import click
+except ImportError:
+    sys.exit("You have to manually install the 'click' package to run this file.")
+
+import random
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault("HELTOUR_ENV", "LIVE")
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "heltour.settings")
+
+import django
+django.setup()
+
+from heltour.tournament.models import Player
+from heltour.tournament.pairinggen import JavafoInstance, JavafoPlayer, JavafoPairing
+
+
+def make_field(players, rounds, seed):
+    # Synthetic swiss field of unsaved Player instances with random (but consistent) results
+    rnd = random.Random(seed)
+    field = [Player(pk=n, lichess_username='player%d' % n) for n in range(1, players + 1)]
+    pairings = {p: [] for p in field}
+    scores = {p: 0 for p in field}
+    for _ in range(rounds):
+        order = list(field)
+        rnd.shuffle(order)
+        if len(order) % 2:
+            bye = order.pop()
+            pairings[bye].append(JavafoPairing(None, None, 1, forfeit=True))
+            scores[bye] += 1
+        for white, black in zip(order[::2], order[1::2]):
+            white_score = rnd.choice([0, 0.5, 1])
+            pairings[white].append(JavafoPairing(black, 'white', white_score))
+            pairings[black].append(JavafoPairing(white, 'black', 1 - white_score))
+            scores[white] += white_score
+            scores[black] += 1 - white_score
+    return [JavafoPlayer(p, scores[p], pairings[p]) for p in field]
+
+
+def scan_write_trfx(instance):
+    # The previous approach: look up each opponent's start number by scanning the player list
+    lines = ['XXR %d\n' % instance.total_round_count]
+    for n, player in enumerate(instance.players, 1):
+        line = '001 {0: >4}  {1:74.1f}     '.format(n, player.score)
+        for pairing in player.pairings:
+            opponent_num = next((num for num, player in enumerate(instance.players, 1) if player.player == pairing.opponent), '0000')
+            color = 'w' if pairing.color == 'white' else 'b' if pairing.color == 'black' else '-'
+            if pairing.forfeit:
+                score = '+' if pairing.score == 1 else '-' if pairing.score == 0 else '=' if pairing.score == 0.5 else ' '
+            else:
+                score = '1' if pairing.score == 1 else '0' if pairing.score == 0 else '=' if pairing.score == 0.5 else ' '
+            if score == ' ':
+                color = '-'
+            line += '{0: >6} {1} {2}'.format(opponent_num, color, score)
+        if not player.include:
+            line += '{0: >6} {1} {2}'.format('0000', '-', '-')
+        lines.append(line + '\n')
+    return ''.join(lines)
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+@click.command()
+@click.option('--players', default=1000, help='number of players in the field.')
+@click.option('--rounds', default=15, help='number of rounds already played.')
+@click.option('--seed', default=0, help='random seed for the synthetic field.')
+@click.option('--skip-scan', is_flag=True, help="don't time the previous (quadratic) writer.")
+def run(players, rounds, seed, skip_scan):
+    instance = JavafoInstance(rounds + 1, make_field(players, rounds, seed))
+    trfx, write_time = timed(instance._write_trfx)
+
+    print(f"{players} players, {rounds} rounds, {len(trfx)} bytes of TRFX")
+    print(f"Start number map: {write_time * 1000:10.2f} ms")
+    if not skip_scan:
+        scan_trfx, scan_time = timed(scan_write_trfx, instance)
+        assert scan_trfx == trfx
+        print(f"Player list scan: {scan_time * 1000:10.2f} ms")
+        print(f"Speedup:          {scan_time / write_time:10.1f}x")
+
+
+if __name__ == "__main__":
+    run()
@@ -5,7 +5,8 @@ except ImportError:
     sys.exit("You have to manually install the 'click' package to run this file.")
 
 import json
-from heltour.tournament.teamgen import make_league, \
+import random
+from heltour.tournament.teamgen import make_league, get_annealed_league, \
         total_happiness, team_rating_range, team_rating_variance, reduce_variance
 
 from itertools import combinations
@@ -63,10 +64,22 @@ class Terminal:
 @click.option('--boards', default=6, help='number of boards per team.')
 @click.option('--balance', default=0.8, help='proportion of all players that will be full time')
 @click.option('--count', default=100, help='Number of iterations to run happiness optimizer')
-def run(players, output, boards, balance, count):
+@click.option('--seed', type=int, help='random seed, for reproducible runs.')
+@click.option('--optimizer', default="search", type=click.Choice(['search', 'anneal']),
+              help='search: keep the happiest of --count random leagues. anneal: improve a single league by '
+                   'simulated annealing for --time-limit seconds.')
+@click.option('--time-limit', default=30.0, help='seconds to spend annealing.')
+def run(players, output, boards, balance, count, seed, optimizer, time_limit):
     player_data = get_player_data(players)
 
-    leagues = [make_league(player_data, boards, balance) for _ in range(count)]
+    if optimizer == 'anneal':
+        league = get_annealed_league(player_data, boards, balance, time_limit, seed, progress=print_progress)
+        print("Annealed league")
+        generate_print_output(league)
+        return
+
+    rng = random.Random(seed)
+    leagues = [make_league(player_data, boards, balance, rng=rng) for _ in range(count)]
 
     max_happiness = max([total_happiness(l['teams']) for l in leagues])
     happy_leagues = [l for l in leagues if total_happiness(l['teams']) == max_happiness]
@@ -98,6 +111,11 @@ def get_player_data(players):
 
 # Output stuff
 
+def print_progress(progress):
+    print(f"{progress.elapsed:6.1f}s {progress.iterations:>9} swaps tried, temperature {progress.temperature:.3f}: "
+          f"happiness {progress.happiness} range {progress.rating_range:.2f} "
+          f"(best: happiness {progress.best_happiness} range {progress.best_rating_range:.2f})")
+
 def generate_print_output(league):
     players, alternates, teams, team_rating_bounds, alt_rating_bounds, alts_split =\
         league['players'], league['alternates'], league['teams'], \
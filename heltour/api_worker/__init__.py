@@ -0,0 +1 @@
+default_app_config = 'heltour.api_worker.apps.ApiWorkerConfig'
@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+class ApiWorkerConfig(AppConfig):
+    name = 'heltour.api_worker'
+
+    def ready(self):
+        # Start the worker when the process starts rather than on the first request
+        from . import views, worker
+        if not worker.queue_is_durable:
+            views.fail_lost_requests()
@@ -0,0 +1,441 @@
+import heapq
+import importlib
+import itertools
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.utils.crypto import get_random_string
+
+class RateLimited(Exception):
+    '''Raised by a job when the upstream server asks us to slow down.'''
+    def __init__(self, retry_after):
+        super(RateLimited, self).__init__('Rate limited for %s seconds' % retry_after)
+        self.retry_after = retry_after
+
+def retry_after(response):
+    # The seconds a 429 response asks us to wait for
+    try:
+        return max(int(response.headers.get('Retry-After', 60)), 1)
+    except ValueError:
+        return 60
+
+class TokenBucket:
+    '''A token bucket kept in process. Use a RedisTokenBucket to share a limit between processes.'''
+    clock = time.monotonic
+
+    def __init__(self, rate, capacity):
+        # rate -- tokens added per second; capacity -- the most that can build up (the burst size)
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        # Seconds until a token can be taken
+        self._refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, seconds, now):
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = 0
+        self.updated = self.paused_until
+
+# Refills a token bucket stored in a hash to ARGV[1] (the current time), then applies ARGV[4]:
+# 'wait' returns the seconds until a token can be taken, 'take' takes one and 'pause' pauses for ARGV[5] seconds.
+# Numbers are returned and stored as full precision strings, since redis truncates lua numbers to integers.
+_TOKEN_BUCKET_SCRIPT = """
+local function fmt(n)
+    return string.format('%.17g', n)
+end
+local now = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local capacity = tonumber(ARGV[3])
+local state = redis.call('hmget', KEYS[1], 'tokens', 'updated', 'paused_until')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+local paused_until = tonumber(state[3]) or 0
+tokens = math.min(capacity, tokens + (now - updated) * rate)
+updated = now
+if ARGV[4] == 'wait' then
+    if now < paused_until then
+        return fmt(paused_until - now)
+    end
+    if tokens >= 1 then
+        return '0'
+    end
+    return fmt((1 - tokens) / rate)
+elseif ARGV[4] == 'take' then
+    tokens = tokens - 1
+else
+    paused_until = math.max(paused_until, now + tonumber(ARGV[5]))
+    tokens = 0
+    updated = paused_until
+end
+redis.call('hmset', KEYS[1], 'tokens', fmt(tokens), 'updated', fmt(updated),
+           'paused_until', fmt(paused_until))
+redis.call('expire', KEYS[1], 86400)
+return '0'
+"""
+
+class RedisTokenBucket:
+    '''A token bucket kept in redis, so every process running a scheduler shares the same limit and pauses.
+
+    Checking for a token and taking it are separate steps, so two processes can both take the last one; the bucket
+    then goes into debt and the following requests wait longer, which keeps the average rate.
+    '''
+    clock = time.time
+
+    def __init__(self, redis, key, rate, capacity):
+        self._key = key
+        self.rate = rate
+        self.capacity = capacity
+        self._script = redis.register_script(_TOKEN_BUCKET_SCRIPT)
+
+    def _call(self, now, op, seconds=0):
+        return float(self._script(keys=[self._key], args=[repr(now), self.rate, self.capacity, op, seconds]))
+
+    def wait_time(self, now):
+        return self._call(now, 'wait')
+
+    def take(self, now):
+        self._call(now, 'take')
+
+    def pause(self, seconds, now):
+        self._call(now, 'pause', seconds)
+
+class _Job:
+    def __init__(self, priority, lane, fn, args, max_retries, on_failure):
+        self.id = get_random_string(length=16)
+        self.priority = priority
+        self.lane = lane
+        self.fn = fn
+        self.args = args
+        self.max_retries = max_retries
+        self.on_failure = on_failure
+        self.retry_count = 0
+        self.order = None
+
+class MemoryQueue:
+    '''Keeps the queued jobs in process; they're lost if the process exits.'''
+    poll_interval = None
+
+    def __init__(self, lanes):
+        self._queues = {lane: [] for lane in lanes}
+        self._delayed = []
+        self._seq = itertools.count()
+
+    def push(self, job):
+        # Ties between jobs of the same priority are broken by the order they were queued in
+        heapq.heappush(self._queues[job.lane], (-job.priority, next(self._seq), job))
+
+    def heads(self):
+        # The sort key of the first job in each non-empty lane (lower runs first)
+        return {lane: queue[0][:2] for lane, queue in self._queues.items() if queue}
+
+    def claim(self, lane):
+        return heapq.heappop(self._queues[lane])[2]
+
+    def ack(self, job):
+        pass
+
+    def heartbeat(self, jobs, now):
+        pass
+
+    def retry(self, job, ready_time):
+        heapq.heappush(self._delayed, (ready_time, next(self._seq), job))
+
+    def promote(self, now):
+        # Moves delayed jobs that are due back into their lanes; returns the time the next one is due, if any
+        while self._delayed and self._delayed[0][0] <= now:
+            self.push(heapq.heappop(self._delayed)[2])
+        return self._delayed[0][0] if self._delayed else None
+
+# Moves the jobs in a sorted set whose score (a time) has passed back into their lane queues
+_PROMOTE_SCRIPT = """
+local ids = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 100)
+for _, id in ipairs(ids) do
+    redis.call('zrem', KEYS[1], id)
+    local data = redis.call('hget', KEYS[2], id)
+    if data then
+        local job = cjson.decode(data)
+        redis.call('zadd', ARGV[2] .. job['lane'], job['order'], id)
+    end
+end
+return #ids
+"""
+
+# Takes the first job in a lane queue and marks it as being processed until the visibility deadline
+_CLAIM_SCRIPT = """
+local id = redis.call('zrange', KEYS[1], 0, 0)[1]
+if not id then
+    return nil
+end
+redis.call('zrem', KEYS[1], id)
+redis.call('zadd', KEYS[2], ARGV[1], id)
+return {id, redis.call('hget', KEYS[3], id)}
+"""
+
+def _qualified_name(fn):
+    return '%s.%s' % (fn.__module__, fn.__qualname__) if fn is not None else None
+
+def _resolve(name):
+    if name is None:
+        return None
+    module, attr = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module), attr)
+
+class RedisQueue:
+    '''Keeps the queued jobs in redis, so they survive restarts.
+
+    A claimed job stays in redis until it's acknowledged. While it runs, the scheduler extends its claim (see
+    heartbeat), so if it isn't acknowledged or extended within the visibility timeout (e.g. because the worker died
+    while running it) it's put back in its queue. Job functions must be module level, and their args JSON
+    serializable.
+    '''
+    poll_interval = 1
+
+    def __init__(self, redis, lanes, prefix='apiworker', visibility_timeout=120):
+        self._redis = redis
+        self._lanes = list(lanes)
+        self._prefix = prefix
+        self._visibility_timeout = visibility_timeout
+        self._next_heartbeat = 0
+        self._promote = redis.register_script(_PROMOTE_SCRIPT)
+        self._claim = redis.register_script(_CLAIM_SCRIPT)
+
+    def _key(self, name):
+        return '%s:%s' % (self._prefix, name)
+
+    def _save(self, pipe, job):
+        pipe.hset(self._key('jobs'), job.id, json.dumps({
+            'priority': job.priority,
+            'lane': job.lane,
+            'fn': _qualified_name(job.fn),
+            'args': job.args,
+            'max_retries': job.max_retries,
+            'on_failure': _qualified_name(job.on_failure),
+            'retry_count': job.retry_count,
+            'order': job.order,
+        }))
+
+    def push(self, job):
+        # The order is fixed when the job is first queued: by priority, then the order jobs were queued in
+        job.order = -job.priority * 1e12 + self._redis.incr(self._key('seq'))
+        pipe = self._redis.pipeline()
+        self._save(pipe, job)
+        pipe.zadd(self._key('queue:' + job.lane), {job.id: job.order})
+        pipe.execute()
+
+    def heads(self):
+        pipe = self._redis.pipeline()
+        for lane in self._lanes:
+            pipe.zrange(self._key('queue:' + lane), 0, 0, withscores=True)
+        return {lane: head[0][1] for lane, head in zip(self._lanes, pipe.execute()) if head}
+
+    def claim(self, lane):
+        keys = [self._key('queue:' + lane), self._key('processing'), self._key('jobs')]
+        while True:
+            claimed = self._claim(keys=keys, args=[time.time() + self._visibility_timeout])
+            if claimed is None:
+                return None
+            job_id, data = claimed[0].decode('utf-8'), claimed[1]
+            try:
+                return self._load(job_id, data)
+            except Exception:
+                # The job was deleted or its function no longer exists; drop it
+                job = _Job(0, lane, None, [], 0, None)
+                job.id = job_id
+                self.ack(job)
+                self._drop(data)
+
+    def _drop(self, data):
+        # Calls the failure handler of a job that can't be run, if it can still be found, so anyone waiting for the
+        # job's result is told rather than left to time out
+        try:
+            fields = json.loads(data.decode('utf-8'))
+            on_failure = _resolve(fields['on_failure'])
+            if on_failure is not None:
+                on_failure(*fields['args'])
+        except Exception:
+            pass
+
+    def _load(self, job_id, data):
+        fields = json.loads(data.decode('utf-8'))
+        job = _Job(fields['priority'], fields['lane'], _resolve(fields['fn']), fields['args'],
+                   fields['max_retries'], _resolve(fields['on_failure']))
+        job.id = job_id
+        job.retry_count = fields['retry_count']
+        job.order = fields['order']
+        return job
+
+    def ack(self, job):
+        pipe = self._redis.pipeline()
+        pipe.zrem(self._key('processing'), job.id)
+        pipe.hdel(self._key('jobs'), job.id)
+        pipe.execute()
+
+    def heartbeat(self, jobs, now):
+        # Extends the claims on the running jobs, a few times per visibility timeout, so long jobs (e.g. streams)
+        # aren't put back in the queue while they're still running
+        if not jobs or now < self._next_heartbeat:
+            return
+        self._next_heartbeat = now + self._visibility_timeout / 3
+        self._redis.zadd(self._key('processing'), {job.id: now + self._visibility_timeout for job in jobs}, xx=True)
+
+    def retry(self, job, ready_time):
+        pipe = self._redis.pipeline()
+        self._save(pipe, job)
+        pipe.zrem(self._key('processing'), job.id)
+        pipe.zadd(self._key('delayed'), {job.id: ready_time})
+        pipe.execute()
+
+    def promote(self, now):
+        for name in ('delayed', 'processing'):
+            self._promote(keys=[self._key(name), self._key('jobs')], args=[now, self._key('queue:')])
+        first = self._redis.zrange(self._key('delayed'), 0, 0, withscores=True)
+        return first[0][1] if first else None
+
+class Scheduler:
+    '''Runs jobs on a small pool of threads, highest priority first.
+
+    Each job belongs to a lane (e.g. a class of API endpoints) with its own token bucket, so a slow or rate
+    limited lane doesn't hold up the others. Failed jobs are retried after a jittered exponential backoff, and a
+    job raising RateLimited pauses its lane for the requested time; neither blocks the other work.
+    '''
+
+    def __init__(self, limits, connections, default_lane='default', backoff=2, max_backoff=60, queue=None,
+                 buckets=None):
+        # limits -- {lane: (rate, capacity)}
+        # queue -- where queued jobs are kept (a MemoryQueue by default)
+        # buckets -- {lane: token bucket} to use instead of in-process TokenBuckets for the limits
+        if buckets is None:
+            buckets = {lane: TokenBucket(rate, capacity) for lane, (rate, capacity) in limits.items()}
+        self._buckets = buckets
+        self._queue = queue if queue is not None else MemoryQueue(limits)
+        self._cond = threading.Condition()
+        self._connections = connections
+        self._running = {}
+        self._default_lane = default_lane
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._executor = ThreadPoolExecutor(connections)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def queue_work(self, priority, fn, *args, lane=None, max_retries=0, on_failure=None):
+        # on_failure -- called with the job's args once its retries are used up
+        if lane not in self._buckets:
+            lane = self._default_lane
+        with self._cond:
+            self._queue.push(_Job(priority, lane, fn, args, max_retries, on_failure))
+            self._cond.notify()
+
+    def take_token(self, lane):
+        # Waits for a token from the lane's bucket, for requests made outside of a job (e.g. long running streams)
+        bucket = self._buckets.get(lane, self._buckets[self._default_lane])
+        while True:
+            with self._cond:
+                wait = bucket.wait_time(bucket.clock())
+                if wait <= 0:
+                    bucket.take(bucket.clock())
+                    return
+            time.sleep(wait)
+
+    def pause(self, lane, seconds):
+        # Pauses the lane, as a job raising RateLimited would
+        bucket = self._buckets.get(lane, self._buckets[self._default_lane])
+        with self._cond:
+            bucket.pause(seconds, bucket.clock())
+
+    def _next_job(self):
+        # Returns (job, None), or (None, seconds to wait before something may be ready)
+        wall_now = time.time()
+        self._queue.heartbeat(list(self._running.values()), wall_now)
+        next_delayed = self._queue.promote(wall_now)
+        timeout = self._queue.poll_interval
+        if next_delayed is not None:
+            timeout = _min_timeout(timeout, next_delayed - wall_now)
+        if len(self._running) >= self._connections:
+            return None, timeout
+        best = None
+        heads = self._queue.heads()
+        for lane, head in heads.items():
+            bucket = self._buckets[lane]
+            wait = bucket.wait_time(bucket.clock())
+            if wait > 0:
+                timeout = _min_timeout(timeout, wait)
+            elif best is None or head < heads[best]:
+                best = lane
+        if best is None:
+            return None, timeout
+        job = self._queue.claim(best)
+        if job is None:
+            # Taken by another worker
+            return None, 0
+        self._buckets[best].take(self._buckets[best].clock())
+        return job, None
+
+    def _run(self):
+        with self._cond:
+            while True:
+                try:
+                    job, timeout = self._next_job()
+                except Exception:
+                    # e.g. redis is unavailable
+                    job, timeout = None, 5
+                if job is None:
+                    if timeout != 0:
+                        self._cond.wait(timeout)
+                    continue
+                self._running[job.id] = job
+                self._executor.submit(self._execute, job)
+
+    def _execute(self, job):
+        retry_delay = None
+        try:
+            job.fn(*job.args)
+        except RateLimited as e:
+            bucket = self._buckets[job.lane]
+            with self._cond:
+                bucket.pause(e.retry_after, bucket.clock())
+            retry_delay = 0
+        except Exception:
+            retry_delay = min(self._backoff * 2 ** job.retry_count, self._max_backoff) * random.uniform(0.5, 1.5)
+
+        give_up = retry_delay is not None and job.retry_count >= job.max_retries
+        with self._cond:
+            del self._running[job.id]
+            try:
+                if retry_delay is not None and not give_up:
+                    job.retry_count += 1
+                    self._queue.retry(job, time.time() + retry_delay)
+                else:
+                    self._queue.ack(job)
+            except Exception:
+                # Left for the visibility timeout to put back
+                pass
+            self._cond.notify()
+        if give_up and job.on_failure is not None:
+            try:
+                job.on_failure(*job.args)
+            except Exception:
+                pass
+
+def _min_timeout(a, b):
+    return b if a is None else min(a, b)
@@ -1,43 +1,212 @@
+import hashlib
+import json
+import os
+import socket
 import requests
-import time
 from . import worker
+from .scheduler import RateLimited, retry_after
+from heltour import settings
+from django_redis import get_redis_connection
 from django.core.cache import cache
 from django.http.response import HttpResponse, JsonResponse
 from django.utils.crypto import get_random_string
 from django.views.decorators.csrf import csrf_exempt
 
-def _do_lichess_api_call(redis_key, path, method, post_data, params, priority, max_retries, format, retry_count=0):
-    url = "https://lichess.org/%s" % path
+# Keep-alive connections to lichess, shared by the worker threads
+_session = requests.Session()
+_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=settings.API_WORKER_CONNECTIONS))
 
-    try:
-        headers = {}
-        if format:
-            headers['Accept'] = format
-        if method == 'POST':
-            r = requests.post(url, params=params, data=post_data, headers=headers)
+# Pushed after the last record of a streamed response (see lichessapi._stream)
+STREAM_END = 'end'
+
+def _set_result(redis_key, *results):
+    # The caller is waiting on the key with a blocking pop (see lichessapi._apicall)
+    redis = get_redis_connection('default')
+    pipe = redis.pipeline()
+    pipe.rpush(redis_key, *results)
+    pipe.expire(redis_key, 60)
+    pipe.execute()
+
+def _lane(path):
+    # The endpoint class, which has its own rate limit (see API_WORKER_RATE_LIMITS)
+    if path.startswith('api/users/status'):
+        return 'status'
+    if path.startswith('game/export/') or path.startswith('games/export/') or path.startswith('api/games/'):
+        return 'games'
+    if path.startswith('api/user'):
+        return 'users'
+    return 'default'
+
+def _cache_timeout(lane, path, format, text):
+    # How long the response can be reused for (see API_WORKER_CACHE_TIMEOUTS)
+    if path.startswith('game/export/'):
+        # Finished games don't change
+        if format == 'application/json':
+            try:
+                finished = json.loads(text).get('status') not in ('created', 'started')
+            except ValueError:
+                finished = False
         else:
-            r = requests.get(url, params, headers=headers)
-
-        if r.status_code == 200:
-            # Success
-            cache.set(redis_key, r.text, timeout=60)
-            time.sleep(2)
-            return
-    except:
-        r = None
-
-    # Failure
-    if retry_count >= max_retries:
-        cache.set(redis_key, '', timeout=60)
+            finished = '[Result "*"]' not in text
+        if finished:
+            return settings.API_WORKER_CACHE_TIMEOUTS['finished_games']
+    return settings.API_WORKER_CACHE_TIMEOUTS.get(lane, 0)
+
+# Identical requests that are queued or running share one call to lichess. The redis keys of the callers waiting
+# for a request are kept in a redis list, so they outlive a restart of the worker.
+_WAITERS_PREFIX = 'apiworker:waiters:'
+
+def _request_key(path, method, post_data, params, format):
+    request = json.dumps([path, method, post_data, sorted(params.items()), format])
+    return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+def _process_id():
+    return '%s-%d' % (socket.gethostname(), os.getpid())
+
+def _waiters_key(request_key):
+    # Without a durable queue a request is only run by the process that queued it, so it's only shared within that
+    # process; the list is named after the process so it can be failed once the process is gone
+    if worker.queue_is_durable:
+        return _WAITERS_PREFIX + request_key
+    return '%s%s:%s' % (_WAITERS_PREFIX, _process_id(), request_key)
+
+def _join(request_key, redis_key):
+    # Returns True if there's no identical request in flight, i.e. the request should be queued
+    waiters_key = _waiters_key(request_key)
+    pipe = get_redis_connection('default').pipeline()
+    pipe.rpush(waiters_key, redis_key)
+    pipe.expire(waiters_key, 60 * 60)
+    return pipe.execute()[0] == 1
+
+def _finish_waiters(waiters_key, result):
+    pipe = get_redis_connection('default').pipeline()
+    pipe.lrange(waiters_key, 0, -1)
+    pipe.delete(waiters_key)
+    redis_keys = pipe.execute()[0]
+    for redis_key in redis_keys:
+        _set_result(redis_key.decode('utf-8'), result)
+
+def _finish(request_key, result):
+    _finish_waiters(_waiters_key(request_key), result)
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def fail_lost_requests():
+    # Without a durable queue, the requests queued by a process are gone when it exits; when a worker starts, tell
+    # the callers of the processes on this host that no longer exist straight away rather than leaving them to time
+    # out. The requests of the other running workers are left alone.
+    redis = get_redis_connection('default')
+    host = socket.gethostname()
+    for key in redis.scan_iter(_WAITERS_PREFIX + '*'):
+        key = key.decode('utf-8')
+        process_id = key[len(_WAITERS_PREFIX):].split(':', 1)[0]
+        key_host, _, pid = process_id.rpartition('-')
+        if key_host != host or not pid.isdigit() or int(pid) == os.getpid() or _process_exists(int(pid)):
+            continue
+        _finish_waiters(key, '')
+
+def _lichess_request(path, method, post_data, params, format, stream=False):
+    # Failures are raised so the worker can retry them later (see scheduler.Scheduler)
+    url = "https://lichess.org/%s" % path
+    headers = {}
+    if format:
+        headers['Accept'] = format
+    if method == 'POST':
+        r = _session.post(url, params=params, data=post_data, headers=headers, timeout=60, stream=stream)
     else:
-        # Retry
-        worker.queue_work(priority, _do_lichess_api_call, redis_key, path, method, post_data, params, priority, max_retries, format, retry_count + 1)
+        r = _session.get(url, params=params, headers=headers, timeout=60, stream=stream)
 
-    if r is not None and r.status_code == 429:
+    if r.status_code == 429:
         # Too many requests
-        time.sleep(60)
-    else:
-        time.sleep(2)
+        raise RateLimited(retry_after(r))
+    r.raise_for_status()
+    return r
+
+def _do_lichess_api_call(request_key, path, method, post_data, params, format):
+    r = _lichess_request(path, method, post_data, params, format)
+    timeout = _cache_timeout(_lane(path), path, format, r.text)
+    if timeout:
+        cache.set('lichessapi-response-%s' % request_key, r.text, timeout)
+    _finish(request_key, r.text)
+
+_json_decoder = json.JSONDecoder()
+
+def _split_json_records(buffer):
+    # Splits the complete records off the front of a partly received JSON array or NDJSON body.
+    # Returns (the record texts, the rest of the buffer).
+    records = []
+    pos = 0
+    while True:
+        while pos < len(buffer) and buffer[pos] in '[],\r\n\t ':
+            pos += 1
+        try:
+            _, end = _json_decoder.raw_decode(buffer, pos)
+        except ValueError:
+            return records, buffer[pos:]
+        records.append(buffer[pos:end])
+        pos = end
+
+def _started_key(redis_key):
+    return '%s:started' % redis_key
+
+def _streams_key():
+    # Without a durable queue the streams queued by a process are lost with it; their redis keys are listed under
+    # the process, like its waiters, so fail_lost_requests can fail them
+    return '%s%s:streams' % (_WAITERS_PREFIX, _process_id())
+
+def _end_stream(redis_key, result):
+    _set_result(redis_key, result)
+    pipe = get_redis_connection('default').pipeline()
+    pipe.delete(_started_key(redis_key))
+    if not worker.queue_is_durable:
+        pipe.lrem(_streams_key(), 0, redis_key)
+    pipe.execute()
+
+def _do_lichess_api_stream(redis_key, path, method, post_data, params, format):
+    # The records are pushed to the caller as they arrive, so neither side holds the whole response in memory
+    redis = get_redis_connection('default')
+    if redis.exists(_started_key(redis_key)):
+        # The job was claimed again after records were sent (e.g. the worker running it died); running it again
+        # would repeat the records the caller already has
+        _end_stream(redis_key, '')
+        return
+    r = _lichess_request(path, method, post_data, params, format, stream=True)
+    if r.encoding is None:
+        r.encoding = 'utf-8'
+    sent = False
+    try:
+        buffer = ''
+        for chunk in r.iter_content(chunk_size=16384, decode_unicode=True):
+            records, buffer = _split_json_records(buffer + chunk)
+            if records:
+                if not sent:
+                    redis.set(_started_key(redis_key), 1, ex=60 * 60)
+                _set_result(redis_key, *records)
+                sent = True
+        if buffer:
+            raise ValueError('Truncated response from %s' % path)
+    except Exception:
+        if not sent:
+            raise
+        # Retrying would repeat the records the caller already has
+        _end_stream(redis_key, '')
+        return
+    finally:
+        r.close()
+    _end_stream(redis_key, STREAM_END)
+
+def _lichess_api_call_failed(request_key, *args):
+    _finish(request_key, '')
+
+def _lichess_api_stream_failed(redis_key, *args):
+    _end_stream(redis_key, '')
 
 @csrf_exempt
 def lichess_api_call(request, path):
@@ -45,8 +214,35 @@ def lichess_api_call(request, path):
     priority = int(params.pop('priority', 0))
     max_retries = int(params.pop('max_retries', 3))
     format = params.pop('format', None)
-    redis_key = get_random_string(length=16)
-    worker.queue_work(priority, _do_lichess_api_call, redis_key, path, request.method, request.body.decode('utf-8'), params, priority, max_retries, format)
+    stream = params.pop('stream', None) == '1'
+    post_data = request.body.decode('utf-8')
+    redis_key = 'lichessapi-result-%s' % get_random_string(length=16)
+    if stream:
+        # Streamed responses are passed straight through, so they're neither shared nor cached
+        if not worker.queue_is_durable:
+            pipe = get_redis_connection('default').pipeline()
+            pipe.rpush(_streams_key(), redis_key)
+            pipe.expire(_streams_key(), 60 * 60)
+            pipe.execute()
+        worker.queue_work(priority, _do_lichess_api_stream, redis_key, path, request.method, post_data, params, format,
+                          lane=_lane(path), max_retries=max_retries, on_failure=_lichess_api_stream_failed)
+        return HttpResponse(redis_key)
+    request_key = _request_key(path, request.method, post_data, params, format)
+
+    cached = cache.get('lichessapi-response-%s' % request_key)
+    if cached is not None:
+        _set_result(redis_key, cached)
+        return HttpResponse(redis_key)
+    if not _join(request_key, redis_key):
+        return HttpResponse(redis_key)
+    try:
+        worker.queue_work(priority, _do_lichess_api_call, request_key, path, request.method, post_data, params,
+                          format, lane=_lane(path), max_retries=max_retries, on_failure=_lichess_api_call_failed)
+    except Exception:
+        # Otherwise the callers that joined the request would wait for a job that was never queued, and the request
+        # couldn't be made again until the waiters list expired
+        _finish(request_key, '')
+        raise
     return HttpResponse(redis_key)
 
 @csrf_exempt
@@ -57,6 +253,7 @@ def watch(request):
 
 @csrf_exempt
 def watch_add(request):
-    game_id = request.body.decode('utf-8')
-    worker.add_watch(game_id)
-    return JsonResponse({'ok': True})
+    # Takes one or more comma separated game ids; returns the ones that aren't being streamed
+    game_ids = [game_id for game_id in request.body.decode('utf-8').split(',') if game_id]
+    unstreamed = [game_id for game_id in game_ids if not worker.add_watch(game_id)]
+    return JsonResponse({'ok': True, 'unstreamed': unstreamed})
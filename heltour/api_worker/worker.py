@@ -1,26 +1,37 @@
-import queue
+import os
 import threading
+import requests
 import websocket
 import json
 import time
 from django.utils import timezone
 from datetime import timedelta
+from heltour import settings
+from django_redis import get_redis_connection
+from heltour.celery import app
+from .scheduler import Scheduler, MemoryQueue, RedisQueue, RedisTokenBucket, retry_after
 
-def _run_worker():
-    while True:
-        _, fn, args = _work_queue.get()
-        try:
-            fn(*args)
-        except:
-            pass
+def _make_queue():
+    if settings.API_WORKER_QUEUE == 'redis':
+        return RedisQueue(get_redis_connection('default'), settings.API_WORKER_RATE_LIMITS,
+                          visibility_timeout=settings.API_WORKER_VISIBILITY_TIMEOUT)
+    return MemoryQueue(settings.API_WORKER_RATE_LIMITS)
 
-_work_queue = queue.PriorityQueue()
-_worker_thread = threading.Thread(target=_run_worker)
-_worker_thread.daemon = True
-_worker_thread.start()
+def _make_buckets():
+    # Every gunicorn worker runs a scheduler, so with the redis queue the rate limits (and any pause after a 429)
+    # are shared through redis too. In memory mode each process gets its own buckets.
+    if settings.API_WORKER_QUEUE == 'redis':
+        redis = get_redis_connection('default')
+        return {lane: RedisTokenBucket(redis, 'apiworker:bucket:%s' % lane, rate, capacity)
+                for lane, (rate, capacity) in settings.API_WORKER_RATE_LIMITS.items()}
+    return None
 
-def queue_work(priority, fn, *args):
-    _work_queue.put((-priority, fn, args))
+queue_is_durable = settings.API_WORKER_QUEUE == 'redis'
+_scheduler = Scheduler(settings.API_WORKER_RATE_LIMITS, settings.API_WORKER_CONNECTIONS, queue=_make_queue(),
+                       buckets=_make_buckets())
+
+def queue_work(priority, fn, *args, lane=None, max_retries=0, on_failure=None):
+    _scheduler.queue_work(priority, fn, *args, lane=lane, max_retries=max_retries, on_failure=on_failure)
 
 
 def _run_socket():
@@ -65,6 +76,99 @@ _socket_thread = threading.Thread(target=_run_socket)
 _socket_thread.daemon = True
 _socket_thread.start()
 
+# Each watched game is also followed on lichess' game stream, which ends when the game does. Heltour is then told
+# to update the game straight away rather than waiting for the next poll. Streams are opened through the 'streams'
+# lane of the scheduler, so they're rate limited (and paused after a 429) like the other requests, and at most
+# API_WORKER_MAX_GAME_STREAMS are open at once; games over the limit are left to the regular polling until a
+# stream is free and they're watched again.
+#
+# A game is only streamed by one API worker process at a time: the process holds a claim in redis, renewed while
+# the stream is open, so if it dies the claim expires and the next watch (see tasks.update_tv_state) opens the
+# stream again in whichever process receives it.
+_streams = set()
+_streams_lock = threading.Lock()
+_stream_session = requests.Session()
+_STREAM_CLAIM_KEY = 'apiworker:stream:%s'
+
+def _stream_claim_timeout():
+    return settings.API_WORKER_GAME_STREAM_TIMEOUT + 120
+
+def _claim_stream(game_id):
+    try:
+        return bool(get_redis_connection('default').set(_STREAM_CLAIM_KEY % game_id, os.getpid(), nx=True,
+                                                        ex=_stream_claim_timeout()))
+    except Exception:
+        # Without redis each process streams the games it's asked to
+        return True
+
+def _renew_stream_claim(game_id):
+    try:
+        get_redis_connection('default').expire(_STREAM_CLAIM_KEY % game_id, _stream_claim_timeout())
+    except Exception:
+        pass
+
+def _release_stream_claim(game_id):
+    try:
+        get_redis_connection('default').delete(_STREAM_CLAIM_KEY % game_id)
+    except Exception:
+        pass
+
+def _follow_game(game_id):
+    opened = False
+    start = time.monotonic()
+    try:
+        while True:
+            _scheduler.take_token('streams')
+            start = time.monotonic()
+            r = _stream_session.get('https://lichess.org/api/stream/game/%s' % game_id, stream=True,
+                                    timeout=(10, settings.API_WORKER_GAME_STREAM_TIMEOUT))
+            try:
+                if r.status_code == 429:
+                    # Too many requests; the next token comes once the pause is over
+                    _scheduler.pause('streams', retry_after(r))
+                    continue
+                r.raise_for_status()
+                opened = True
+                renewed = time.monotonic()
+                for _ in r.iter_lines():
+                    if time.monotonic() - renewed > 60:
+                        _renew_stream_claim(game_id)
+                        renewed = time.monotonic()
+            finally:
+                r.close()
+            break
+    except Exception:
+        pass
+    # If the stream failed or ended straight away, don't open it again (via heltour watching the game again) too
+    # quickly
+    time.sleep(max(0, settings.API_WORKER_GAME_STREAM_MIN_INTERVAL - (time.monotonic() - start)))
+    with _streams_lock:
+        _streams.discard(game_id)
+    _release_stream_claim(game_id)
+    if not opened:
+        # The stream couldn't be opened, so there's nothing to report; the game is still polled
+        return
+    try:
+        app.send_task('heltour.tournament.tasks.game_finished', args=[game_id])
+    except Exception:
+        pass
+
+def _start_stream(game_id):
+    # Returns False if the game isn't being streamed, because this process already has as many streams as it can
+    with _streams_lock:
+        if game_id in _streams:
+            return True
+        if len(_streams) >= settings.API_WORKER_MAX_GAME_STREAMS:
+            return False
+        if not _claim_stream(game_id):
+            # Streamed by another process
+            return True
+        _streams.add(game_id)
+    thread = threading.Thread(target=_follow_game, args=(game_id,))
+    thread.daemon = True
+    thread.start()
+    return True
+
 def watch_games(game_ids):
     with _games_lock:
         game_id_set = set(game_ids)
@@ -73,10 +177,15 @@ def watch_games(game_ids):
         for game_id in game_id_set - set(_games.keys()):
             _games[game_id] = None
             _start_watching(game_id)
+        for game_id in game_id_set:
+            # Also retries the games that were over the stream limit
+            _start_stream(game_id)
         return [_games[game_id] for game_id in game_ids]
 
 def add_watch(game_id):
+    # Returns False if the game couldn't be streamed (see _start_stream)
     with _games_lock:
         if game_id not in _games:
             _games[game_id] = None
             _start_watching(game_id)
+    return _start_stream(game_id)
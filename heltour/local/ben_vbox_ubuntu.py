@@ -7,6 +7,7 @@ LICHESS_CREDS_FILE_PATH = '/home/ben/lichess-creds'
 FCM_API_KEY_FILE_PATH = '/home/ben/fcm-key'
 LICHESS_DOMAIN = 'https://listage.ovh/'
 JAVAFO_COMMAND = 'java -jar /home/ben/javafo.jar'
+JAVAFO_ENGINE = 'process'
 LINK_PROTOCOL = 'http'
 
 INTERNAL_IPS = ['127.0.0.1', '192.168.56.101']
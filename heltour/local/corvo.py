@@ -3,3 +3,4 @@ GOOGLE_SERVICE_ACCOUNT_KEYFILE_PATH = '/media/mausoleum/Work/Development/heltour
 
 INTERNAL_IPS = ['127.0.0.1', '192.168.56.100']
 JAVAFO_COMMAND = 'java -jar /home/lakin/Personal-Repos/heltour/javafo.jar'
+JAVAFO_ENGINE = 'process'
@@ -2,6 +2,7 @@ DEBUG = True
 GOOGLE_SERVICE_ACCOUNT_KEYFILE_PATH = '/home/freefal/Downloads/client_id.json'
 SLACK_API_TOKEN_FILE_PATH = '/home/ben/slack-token'
 JAVAFO_COMMAND = 'java -jar /home/ben/javafo.jar'
+JAVAFO_ENGINE = 'process'
 
 INTERNAL_IPS = ['127.0.0.1', '192.168.56.100']
 
@@ -4,4 +4,5 @@ SLACK_API_TOKEN_FILE_PATH = '/home/lakin/work/development/heltour/slack-token.co
 
 INTERNAL_IPS = ['127.0.0.1', '192.168.1.19']
 JAVAFO_COMMAND = 'java -jar /home/lakin/personal-repos/heltour/javafo.jar'
+JAVAFO_ENGINE = 'process'
 
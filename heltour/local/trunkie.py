@@ -5,6 +5,7 @@ SLACK_WEBHOOK_FILE_PATH = '/home/lakin/personal-repos/heltour/slack-webhook.txt'
 
 INTERNAL_IPS = ['127.0.0.1', '192.168.1.19']
 JAVAFO_COMMAND = 'java -jar /home/lakin/personal-repos/heltour/javafo.jar'
+JAVAFO_ENGINE = 'process'
 TEAMGEN_PROCESSES_NUMBER = 32
 
 
@@ -4,6 +4,7 @@ SLACK_API_TOKEN_FILE_PATH = '/home/vagrant/heltour/slack-token.conf'
 
 INTERNAL_IPS = ['127.0.0.1']
 JAVAFO_COMMAND = 'java -jar /home/vagrant/heltour/javafo.jar'
+JAVAFO_ENGINE = 'process'
 STATIC_ROOT = '/home/vagrant/heltour/static'
 
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
@@ -68,6 +68,36 @@ INSTALLED_APPS = [
 COMMENTS_APP = 'heltour.comments'
 
 API_WORKER_HOST = 'http://localhost:8780'
+# Requests from the API worker to lichess, as {endpoint class: (requests per second, burst size)}. With the redis
+# queue these are shared by all the API worker processes; in memory mode each process gets them separately.
+API_WORKER_RATE_LIMITS = {
+    'users': (0.5, 2),
+    'status': (1, 3),
+    'games': (1, 3),
+    'default': (0.5, 2),
+    'streams': (1, 5),
+}
+# The number of concurrent connections from each API worker process to lichess
+API_WORKER_CONNECTIONS = 3
+# Where the API worker keeps queued requests and rate limits: 'memory' (per process, lost on restart) or 'redis'
+# (durable and shared by all the API worker processes)
+API_WORKER_QUEUE = 'redis'
+# Seconds before a request claimed by a worker that didn't finish it is queued again
+API_WORKER_VISIBILITY_TIMEOUT = 120
+# How long the API worker reuses lichess responses for, in seconds by endpoint class (finished games don't change)
+API_WORKER_CACHE_TIMEOUTS = {
+    'users': 60,
+    'status': 5,
+    'games': 10,
+    'default': 0,
+    'finished_games': 60 * 60 * 24 * 7,
+}
+# Seconds without data before the API worker gives up on a game stream (the game is then checked and watched again)
+API_WORKER_GAME_STREAM_TIMEOUT = 600
+# The least time between the API worker opening streams for the same game, in seconds
+API_WORKER_GAME_STREAM_MIN_INTERVAL = 30
+# The most game streams each API worker process keeps open at once
+API_WORKER_MAX_GAME_STREAMS = 100
 
 MIDDLEWARE_CLASSES = [
     'debug_toolbar.middleware.DebugToolbarMiddleware',
@@ -174,11 +204,21 @@ CELERYBEAT_SCHEDULE = {
 #         'schedule': timedelta(minutes=30),
 #         'args': ()
 #     },
+    'find-started-games': {
+        'task': 'heltour.tournament.tasks.find_started_games',
+        'schedule': timedelta(minutes=5),
+        'args': ()
+    },
     'update-tv-state': {
         'task': 'heltour.tournament.tasks.update_tv_state',
         'schedule': timedelta(minutes=5),
         'args': ()
     },
+    'poll-tv-state': {
+        'task': 'heltour.tournament.tasks.update_tv_state',
+        'schedule': timedelta(minutes=30),
+        'args': (True,)
+    },
     'update-slack-users': {
         'task': 'heltour.tournament.tasks.update_slack_users',
         'schedule': timedelta(minutes=30),
@@ -270,11 +310,30 @@ CACHEOPS = {
     '*.*': {'ops': 'all', 'timeout': 60 * 60},
 }
 
+# Score recalculations after result changes are coalesced and run in the background after this many seconds.
+# Set to None to recalculate synchronously.
+SCORE_RECALCULATION_DELAY = 2
+
 GOOGLE_SERVICE_ACCOUNT_KEYFILE_PATH = '/home/lichess4545/etc/heltour/gspread.conf'
 SLACK_API_TOKEN_FILE_PATH = '/home/lichess4545/etc/heltour/slack-token.conf'
 SLACK_WEBHOOK_FILE_PATH = '/home/lichess4545/etc/heltour/slack-webhook.conf'
 LICHESS_CREDS_FILE_PATH = '/home/lichess4545/etc/heltour/lichess-creds.conf'
 JAVAFO_COMMAND = 'java -jar /home/lichess4545/etc/heltour/javafo.jar'
+# Pairings are generated by starting javafo for each request. Set JAVAFO_ENGINE to 'daemon' to use a persistent javafo
+# process instead (avoids JVM startup costs; needs sysadmin/JavafoDaemon.java compiled with sysadmin/build-javafo-daemon.sh),
+# or 'stub' to use a Python stand-in. The daemon traps javafo's System.exit with a security manager, which Java 18+ only
+# allows with -Djava.security.manager=allow (Java 12+ accepts the flag; remove it from the command on Java 11 or older).
+JAVAFO_ENGINE = 'process'
+JAVAFO_DAEMON_COMMAND = 'java -Djava.security.manager=allow -cp /home/lichess4545/etc/heltour/javafo.jar:/home/lichess4545/etc/heltour JavafoDaemon /home/lichess4545/etc/heltour/javafo.jar'
+JAVAFO_TIMEOUT = 120
+# Pairing engine results are cached by their input for this many seconds (None to disable)
+PAIRING_RESULT_CACHE_TIMEOUT = 60 * 60
+# Players who aren't in a running season have their lichess profile refreshed this often
+PLAYER_RATING_REFRESH_INTERVAL = timedelta(days=1)
+# Team creation results are cached by their input for this many seconds, so repeated runs reuse them
+CREATE_TEAMS_RESULT_CACHE_TIMEOUT = 60 * 60 * 24
+# A team creation job that hasn't reported progress for this many seconds can be restarted from the admin
+CREATE_TEAMS_STALE_TIMEOUT = 10 * 60
 FCM_API_KEY_FILE_PATH = '/home/lichess4545/etc/heltour/fcm-key.conf'
 
 SLACK_APP_TOKEN = ''
@@ -293,6 +352,10 @@ import sys
 TESTING = 'test' in sys.argv
 if TESTING:
     CACHEOPS = {}
+    SCORE_RECALCULATION_DELAY = None
+    JAVAFO_ENGINE = 'stub'
+    PAIRING_RESULT_CACHE_TIMEOUT = None
+    API_WORKER_QUEUE = 'memory'
 
 # Host-based settings overrides.
 import platform
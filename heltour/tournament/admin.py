@@ -18,7 +18,7 @@ from datetime import timedelta
 from django_comments.models import Comment
 from django.contrib.sites.models import Site
 from django.core.urlresolvers import reverse
-from django.http.response import HttpResponse
+from django.http.response import HttpResponse, JsonResponse
 from django.utils.http import urlquote
 from django.core.mail.message import EmailMultiAlternatives
 from django.core import mail
@@ -33,8 +33,8 @@ from django.db.models.signals import post_save
 from django.dispatch.dispatcher import receiver
 from django.contrib.contenttypes.models import ContentType
 from heltour.tournament.team_rating_utils import team_rating_range, team_rating_variance
-from heltour.tournament import teamgen
 import time
+import uuid
 
 # Customize which sections are visible
 # admin.site.register(Comment)
@@ -334,6 +334,9 @@ class SeasonAdmin(_BaseAdmin):
             url(r'^(?P<object_id>[0-9]+)/create_teams/$',
                 self.admin_site.admin_view(self.create_teams_view),
                 name='create_teams'),
+            url(r'^(?P<object_id>[0-9]+)/create_teams/status/$',
+                self.admin_site.admin_view(self.create_teams_status_view),
+                name='create_teams_status'),
             url(r'^(?P<object_id>[0-9]+)/player_info/(?P<player_name>[\w-]+)/$',
                 self.admin_site.admin_view(self.player_info_view),
                 name='edit_rosters_player_info'),
@@ -391,7 +394,8 @@ class SeasonAdmin(_BaseAdmin):
                 for team_pairing in TeamPairing.objects.filter(round__season=season):
                     team_pairing.refresh_points()
                     team_pairing.save()
-            season.calculate_scores()
+            # Also clears any recalculation queued by the saves above
+            season.flush_scores(recalculate=True)
         self.message_user(request, 'Scores recalculated.', messages.INFO)
 
     def verify_data(self, request, queryset):
@@ -812,51 +816,27 @@ class SeasonAdmin(_BaseAdmin):
         return render(request, 'tournament/admin/edit_rosters_player_info.html', context)
 
     def create_teams_view(self, request, object_id):
-        def insert_teams(teams):
-            for team_number, team in enumerate(teams, 1):
-                team_instance = Team.objects.create(season=season,
-                                                    number=team_number,
-                                                    name=f'Team {team_number}')
-                for board_number, board in enumerate(team.boards, 1):
-                    player = Player.objects.get(lichess_username=board.name)
-                    TeamMember.objects.create(team=team_instance,
-                                              player=player,
-                                              board_number=board_number)
-
-        def insert_alternates(alts_split):
-            for board_number, board in enumerate(alts_split, 1):
-                for player in board:
-                    season_player = (SeasonPlayer.objects
-                                     .get(season=season,
-                                          player__lichess_username__iexact=player.name))
-                    Alternate.objects.create(season_player=season_player,
-                                             board_number=board_number)
-
         season = get_object_or_404(Season, pk=object_id)
         season_started = Round.objects.filter(season=season, publish_pairings=True).exists()
         if season_started:
             return HttpResponse(status=400)
         team_count = Team.objects.filter(season=season).count()
+        progress = season.create_teams_progress()
+        in_progress = season.create_teams_in_progress(progress)
+        stale = not in_progress and progress is not None and progress['status'] in ('queued', 'running')
         if request.method == 'POST':
             form = forms.CreateTeamsForm(team_count, request.POST)
             if form.is_valid():
-                player_data = [p for p in season.export_players() if p['date_created']]
-                league = teamgen.get_best_league(player_data,
-                                         season.boards,
-                                         form.cleaned_data['balance'],
-                                         form.cleaned_data['count'])
-
-                with reversion.create_revision():
-                    reversion.set_user(request.user)
-                    reversion.set_comment('Create teams')
-
-                    Team.objects.filter(season=season).delete()
-                    insert_teams(league['teams'])
-
-                    Alternate.objects.filter(season_player__season=season).delete()
-                    insert_alternates(league['alts_split'])
-
-                return redirect('admin:manage_players', object_id)
+                if in_progress:
+                    self.message_user(request, 'Teams are already being created for this season.', messages.ERROR)
+                else:
+                    options = {k: v for k, v in form.cleaned_data.items() if k != 'confirm_create'}
+                    # The task id is recorded first, so a stale job that starts late sees it was superseded
+                    task_id = uuid.uuid4().hex
+                    season.set_create_teams_progress('queued', detail='Waiting for a worker', task_id=task_id)
+                    signals.do_create_teams.send(sender=self.__class__, season_id=season.pk, options=options,
+                                                 user_id=request.user.pk, task_id=task_id)
+                return redirect('admin:create_teams', object_id)
 
         else:
             form = forms.CreateTeamsForm(team_count)
@@ -865,10 +845,17 @@ class SeasonAdmin(_BaseAdmin):
             'opts': self.model._meta,
             'season': season,
             'form': form,
-            'season_started': season_started
+            'season_started': season_started,
+            'progress': progress,
+            'in_progress': in_progress,
+            'stale': stale,
         }
         return render(request, 'tournament/admin/create_teams.html', context)
 
+    def create_teams_status_view(self, request, object_id):
+        season = get_object_or_404(Season, pk=object_id)
+        return JsonResponse({'progress': season.create_teams_progress()})
+
     def manage_players_view(self, request, object_id):
         season = get_object_or_404(Season, pk=object_id)
         if not request.user.has_perm('tournament.manage_players', season.league):
@@ -1188,6 +1175,8 @@ class RoundAdmin(_BaseAdmin):
             form = forms.GeneratePairingsForm(request.POST)
             if form.is_valid():
                 try:
+                    if 'preview' in form.data:
+                        return self._preview_pairings(request, round_, form)
                     if form.cleaned_data['run_in_background']:
                         signals.do_generate_pairings.send(sender=self.__class__, round_id=round_.pk, overwrite=form.cleaned_data['overwrite_existing'])
                         self.message_user(request, 'Generating pairings in background.', messages.INFO)
@@ -1226,6 +1215,35 @@ class RoundAdmin(_BaseAdmin):
 
         return render(request, 'tournament/admin/generate_pairings.html', context)
 
+    def _preview_pairings(self, request, round_, form):
+        # Nothing is saved; the engine result is cached so generating the same pairings afterwards is fast
+        pairings, byes = pairinggen.generate_pairings(round_, overwrite=form.cleaned_data['overwrite_existing'], dry_run=True)
+        league = round_.season.league
+
+        def player_display(player):
+            if player is None:
+                return ''
+            rating = player.rating_for(league)
+            return player.lichess_username if rating is None else '%s (%d)' % (player.lichess_username, rating)
+
+        if league.competitor_type == 'team':
+            rows = [('%d.%d' % (p.team_pairing.pairing_order, p.board_number), p.white_team().name, player_display(p.white),
+                     p.black_team().name, player_display(p.black)) for p in pairings]
+        else:
+            rows = [(p.pairing_order, p.white_rank or '', player_display(p.white), p.black_rank or '', player_display(p.black)) for p in pairings]
+            rows += [('', b.player_rank or '', player_display(b.player), '', b.get_type_display()) for b in byes]
+        context = {
+            'has_permission': True,
+            'opts': self.model._meta,
+            'site_url': '/',
+            'original': round_,
+            'title': 'Preview pairings',
+            'form': form,
+            'is_team': league.competitor_type == 'team',
+            'rows': rows
+        }
+        return render(request, 'tournament/admin/preview_pairings.html', context)
+
     def review_pairings_view(self, request, object_id):
         round_ = get_object_or_404(Round, pk=object_id)
         if not request.user.has_perm('tournament.generate_pairings', round_.season.league):
@@ -1449,10 +1467,8 @@ class PlayerAdmin(_BaseAdmin):
 
     def update_selected_player_ratings(self, request, queryset):
 #         try:
-        usernames = [p.lichess_username for p in queryset.all()]
-        for user_meta in lichessapi.enumerate_user_metas(usernames, priority=1):
-            p = Player.objects.get(lichess_username__iexact=user_meta['id'])
-            p.update_profile(user_meta)
+        players = list(queryset.all())
+        Player.update_profiles(players, lichessapi.enumerate_user_metas([p.lichess_username for p in players], priority=1))
         self.message_user(request, 'Rating(s) updated', messages.INFO)
 #         except:
 #             self.message_user(request, 'Error updating rating(s) from lichess API', messages.ERROR)
@@ -0,0 +1,234 @@
+'''
+A pure-Python pairing engine for the Dutch Swiss system (FIDE C.04.3), used as an alternative to javafo.
+
+The pairings for a round are found with a single maximum weight matching over the whole field. The edge
+weights encode the pairing criteria in priority order:
+
+1. Absolute criteria: no rematches, no pairing of players with the same absolute colour preference, and the
+   bye only goes to a player who hasn't already had one (relaxed in that order if no pairing exists otherwise)
+2. Minimize the score differences between paired players (sum of squares, so large floats are avoided)
+3. Satisfy as many colour preferences as possible
+4. Within a score group, pair the top half against the bottom half (S1 vs S2)
+
+It reads and writes the same formats as javafo (TRFX in; the number of pairs followed by one
+"white black" line per pair out, with 0 as the opponent for the bye), so the two can be compared on
+the same inputs.
+'''
+
+import networkx as nx
+
+_PLAYED_RESULTS = '10=WDL'
+_BYE_RESULTS = '+U'
+
+_NO_PREFERENCE = 0
+_MILD = 1
+_STRONG = 2
+_ABSOLUTE = 3
+
+class PairingError(Exception):
+    pass
+
+class TrfxPlayer(object):
+    def __init__(self, number, score, results):
+        self.number = number
+        self.score = score
+        # A list of (opponent number, colour, result) tuples, one per round
+        self.results = results
+        self.include = True
+        self.acceleration = []
+
+    def pairing_score(self, round_index):
+        if round_index < len(self.acceleration):
+            return self.score + self.acceleration[round_index]
+        return self.score
+
+    def opponents(self):
+        return {opponent for opponent, _, _ in self.results if opponent != 0}
+
+    def had_bye(self):
+        return any(opponent == 0 and result in _BYE_RESULTS for opponent, _, result in self.results)
+
+    def colours(self):
+        '''Returns the colour played in each round ('w', 'b' or None if no game was played).'''
+        return [colour if opponent != 0 and result in _PLAYED_RESULTS else None for opponent, colour, result in self.results]
+
+    def colour_preference(self):
+        '''Returns a (colour, strength) tuple.'''
+        played = [c for c in self.colours() if c is not None]
+        if not played:
+            return None, _NO_PREFERENCE
+        diff = played.count('w') - played.count('b')
+        if diff > 1 or played[-2:] == ['w', 'w']:
+            return 'b', _ABSOLUTE
+        if diff < -1 or played[-2:] == ['b', 'b']:
+            return 'w', _ABSOLUTE
+        if diff == 1:
+            return 'b', _STRONG
+        if diff == -1:
+            return 'w', _STRONG
+        return ('b' if played[-1] == 'w' else 'w'), _MILD
+
+def parse_trfx(trfx):
+    '''Parses a TRFX document written by JavafoInstance.
+
+    Returns a (total round count, list of TrfxPlayer) tuple. Players that are excluded from the current round
+    (marked by an extra "0000 - -" result) have include = False.
+    '''
+    total_rounds = None
+    players = []
+    acceleration = {}
+    for line in trfx.splitlines():
+        if line.startswith('XXR'):
+            total_rounds = int(line[4:])
+        elif line.startswith('XXA'):
+            parts = line.split()
+            acceleration[int(parts[1])] = [float(s) for s in parts[2:]]
+        elif line.startswith('001'):
+            results = []
+            for i in range(89, len(line.rstrip()), 10):
+                field = line[i:i + 10].ljust(10)
+                results.append((int(field[:6]), field[7], field[9]))
+            players.append(TrfxPlayer(int(line[4:8]), float(line[10:84]), results))
+    if players:
+        rounds_played = min(len(p.results) for p in players)
+        for p in players:
+            if len(p.results) > rounds_played:
+                p.include = False
+                p.results = p.results[:rounds_played]
+            p.acceleration = acceleration.get(p.number, [])
+    return total_rounds, players
+
+def pair_trfx(trfx):
+    '''Pairs the next round of a TRFX document and returns the output in javafo's format.'''
+    _, players = parse_trfx(trfx)
+    pairs = pair_round(players)
+    return '%d\n%s' % (len(pairs), ''.join('%d %d\n' % pair for pair in pairs))
+
+def pair_round(players):
+    '''Pairs the next round.
+
+    players -- a list of TrfxPlayer objects (those with include = False are skipped)
+
+    Returns a list of (white number, black number) tuples in board order, with (number, 0) last for the bye.
+    '''
+    field = [p for p in players if p.include]
+    if not field:
+        return []
+    round_index = min(len(p.results) for p in field)
+    scores = {p.number: p.pairing_score(round_index) for p in field}
+    field.sort(key=lambda p: (-scores[p.number], p.number))
+    rank = {p.number: i for i, p in enumerate(field)}
+    preferences = {p.number: p.colour_preference() for p in field}
+
+    # The position of each player within their score group
+    group_sizes = {}
+    group_position = {}
+    for p in field:
+        s = scores[p.number]
+        group_position[p.number] = group_sizes.get(s, 0)
+        group_sizes[s] = group_sizes.get(s, 0) + 1
+
+    n = len(field)
+    min_score = min(scores.values())
+    max_diff = int(round((max(scores.values()) - min_score) * 2))
+    # Weight multipliers so that each criterion strictly dominates the ones after it
+    s1s2_scale = 1
+    colour_scale = n * n + 1
+    score_scale = (n + 3) * colour_scale
+
+    def score_weight(diff):
+        d = int(round(diff * 2))
+        return (max_diff + 1) ** 2 - d ** 2
+
+    def pair_weight(p, q):
+        colour_p, strength_p = preferences[p.number]
+        colour_q, strength_q = preferences[q.number]
+        if colour_p is None or colour_q is None or colour_p != colour_q:
+            colour_weight = 2
+        elif min(strength_p, strength_q) == _MILD:
+            colour_weight = 1
+        else:
+            colour_weight = 0
+        if scores[p.number] == scores[q.number]:
+            size = group_sizes[scores[p.number]]
+            distance = abs(group_position[p.number] - group_position[q.number])
+            s1s2_weight = n - abs(distance - size // 2)
+        else:
+            lower = p if rank[p.number] > rank[q.number] else q
+            s1s2_weight = n - group_position[lower.number]
+        return score_weight(scores[p.number] - scores[q.number]) * score_scale + colour_weight * colour_scale + s1s2_weight * s1s2_scale
+
+    def bye_weight(p):
+        return score_weight(scores[p.number] - min_score) * score_scale + 2 * colour_scale + rank[p.number] * s1s2_scale
+
+    # Try with all the absolute criteria first, then relax them one at a time
+    for level in range(3):
+        graph = nx.Graph()
+        for i, p in enumerate(field):
+            for q in field[i + 1:]:
+                if level < 2 and q.number in p.opponents():
+                    continue
+                colour_p, strength_p = preferences[p.number]
+                colour_q, strength_q = preferences[q.number]
+                if level < 1 and strength_p == strength_q == _ABSOLUTE and colour_p == colour_q:
+                    continue
+                graph.add_edge(p.number, q.number, weight=pair_weight(p, q))
+            if n % 2 == 1 and (level == 2 or not p.had_bye()):
+                graph.add_edge(p.number, 0, weight=bye_weight(p))
+        matching = nx.max_weight_matching(graph, maxcardinality=True)
+        if len(matching) == (n + 1) // 2:
+            break
+    else:
+        raise PairingError('No valid pairing found')
+
+    by_number = {p.number: p for p in field}
+    pairs = []
+    bye = None
+    for u, v in matching:
+        if u == 0 or v == 0:
+            bye = u or v
+            continue
+        p, q = (by_number[u], by_number[v]) if rank[u] < rank[v] else (by_number[v], by_number[u])
+        pairs.append((p, q))
+
+    # Board order: highest score in the pair, then the sum of scores, then the rank of the higher-ranked player
+    pairs.sort(key=lambda pq: (-max(scores[pq[0].number], scores[pq[1].number]),
+                               -(scores[pq[0].number] + scores[pq[1].number]), rank[pq[0].number]))
+    result = []
+    for board, (p, q) in enumerate(pairs, 1):
+        if _allocate_white(p, q, preferences, board):
+            result.append((p.number, q.number))
+        else:
+            result.append((q.number, p.number))
+    if bye is not None:
+        result.append((bye, 0))
+    return result
+
+def _allocate_white(p, q, preferences, board):
+    '''Returns True if the higher-ranked player p should have white.'''
+    colour_p, strength_p = preferences[p.number]
+    colour_q, strength_q = preferences[q.number]
+    if colour_p is None and colour_q is None:
+        # Neither has played yet; alternate the top player's colour by board
+        return board % 2 == 1
+    if colour_q is None:
+        return colour_p == 'w'
+    if colour_p is None or colour_p != colour_q:
+        return colour_q == 'b'
+    # Same preference: grant the stronger one
+    if strength_p != strength_q:
+        return (colour_p == 'w') == (strength_p > strength_q)
+    if strength_p == _ABSOLUTE:
+        imbalance_p = _colour_imbalance(p)
+        imbalance_q = _colour_imbalance(q)
+        if imbalance_p != imbalance_q:
+            return (colour_p == 'w') == (imbalance_p > imbalance_q)
+    # Alternate from the most recent round in which they had different colours
+    for c_p, c_q in zip(reversed(p.colours()), reversed(q.colours())):
+        if c_p is not None and c_q is not None and c_p != c_q:
+            return c_p == 'b'
+    return colour_p == 'w'
+
+def _colour_imbalance(player):
+    colours = [c for c in player.colours() if c is not None]
+    return abs(colours.count('w') - colours.count('b'))
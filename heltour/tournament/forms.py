@@ -358,11 +358,22 @@ class MoveLateRegForm(forms.Form):
         self.fields['prev_round'].initial = reg.round.number
 
 class CreateTeamsForm(forms.Form):
+    optimizer = forms.ChoiceField(choices=[('search', 'Search'), ('anneal', 'Annealing')],
+                                  initial='search',
+                                  label="Optimizer",
+                                  help_text='Search keeps the happiest of "Count" random leagues. Annealing '
+                                            'improves a single league for "Time limit" seconds, trading off '
+                                            'happiness against the team rating range.')
     count = forms.IntegerField(min_value=1,
                                initial=20,
                                label="Count",
                                help_text='Number of iterations to run the algorithm looking '
                                          'for the "happiest" league')
+    time_limit = forms.IntegerField(min_value=1,
+                                    max_value=600,
+                                    initial=20,
+                                    label="Time limit",
+                                    help_text='Seconds to spend annealing')
 
     balance = forms.FloatField(min_value=0,
                                max_value=1,
@@ -370,6 +381,15 @@ class CreateTeamsForm(forms.Form):
                                label="Balance",
                                help_text="Ratio of team members to alternates.  A value of 0.8 "
                                          "means 20% will be made alternates")
+    max_happy_leagues = forms.IntegerField(min_value=1,
+                                           required=False,
+                                           label="Stop after",
+                                           help_text='Stop early once this many leagues with the best '
+                                                     'happiness have been found')
+    seed = forms.IntegerField(required=False,
+                              label="Seed",
+                              help_text='Random seed; running again with the same seed and players gives '
+                                        'the same teams')
     confirm_create = forms.BooleanField()
 
 
@@ -1,39 +1,82 @@
+import asyncio
+import math
+import os
 import requests
-import time
 import json
+from functools import partial
 from django.core.cache import cache
+from django_redis import get_redis_connection
 import logging
 from heltour import settings
 
 logger = logging.getLogger(__name__)
 
-def _apicall(url, timeout=120, check_interval=0.1, post_data=None):
-    # Make a request to the local API worker to put the result of a lichess API call into the redis cache
-    if post_data:
-        r = requests.post(url, data=post_data)
-    else:
-        r = requests.get(url)
-    if r.status_code != 200:
-        # Retry once
+_session = None
+_session_pid = None
+
+def _get_session():
+    # A keep-alive session to the API worker, one per process (sessions can't be shared across a fork)
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        _session = requests.Session()
+        _session_pid = os.getpid()
+    return _session
+
+def _submit(url, post_data=None):
+    # Queue a lichess API call in the local API worker and return the redis key its result will be pushed to
+    session = _get_session()
+    for _ in range(2): # Retry once
         if post_data:
-            r = requests.post(url, data=post_data)
+            r = session.post(url, data=post_data)
         else:
-            r = requests.get(url)
-        if r.status_code != 200:
-            raise ApiWorkerError('API worker returned HTTP %s for %s' % (r.status_code, url))
-    # This is the key we'll use to obtain the result, which may not be set yet
-    redis_key = r.text
-
-    # Wait until the result is set in redis (with a timeout)
-    time_spent = 0
+            r = session.get(url)
+        if r.status_code == 200:
+            return r.text
+    raise ApiWorkerError('API worker returned HTTP %s for %s' % (r.status_code, url))
+
+def _wait(redis_key, timeout, url):
+    # The worker pushes the result onto a redis list, so a blocking pop returns as soon as it's available
+    popped = get_redis_connection('default').blpop([redis_key], timeout=max(int(math.ceil(timeout)), 1))
+    if popped is None:
+        raise ApiWorkerError('Timeout for %s' % url)
+    return popped[1].decode('utf-8')
+
+def _apicall(url, timeout=120, post_data=None):
+    return _wait(_submit(url, post_data), timeout, url)
+
+# Pushed by the API worker after the last record of a streamed response (see api_worker.views.STREAM_END)
+_STREAM_END = 'end'
+
+def _stream(url, timeout=120, post_data=None):
+    # Yields the records of a JSON array or NDJSON response as the worker pushes them, so the first ones can be
+    # processed while the rest are in flight. The timeout applies to the wait for each record.
+    redis_key = _submit(url + '&stream=1', post_data)
+    redis = get_redis_connection('default')
     while True:
-        result = cache.get(redis_key)
-        if result is not None:
-            return result
-        time.sleep(check_interval)
-        time_spent += check_interval
-        if time_spent >= timeout:
+        popped = redis.blpop([redis_key], timeout=max(int(math.ceil(timeout)), 1))
+        if popped is None:
             raise ApiWorkerError('Timeout for %s' % url)
+        record = popped[1].decode('utf-8')
+        if record == '':
+            raise ApiWorkerError('API failure')
+        if record == _STREAM_END:
+            return
+        yield json.loads(record)
+
+async def _apicall_async(url, timeout=120, post_data=None):
+    # Runs the call in the event loop's executor, so callers can fan out many calls with asyncio.gather
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, partial(_apicall, url, timeout, post_data))
+
+def run_async(*coroutines):
+    # Runs the coroutines concurrently in a new event loop and returns their results (or exceptions) in order
+    async def gather():
+        return await asyncio.gather(*coroutines, return_exceptions=True)
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(gather())
+    finally:
+        loop.close()
 
 def get_user_meta(lichess_username, priority=0, max_retries=3, timeout=120):
     url = '%s/lichessapi/api/user/%s?priority=%s&max_retries=%s' % (settings.API_WORKER_HOST, lichess_username, priority, max_retries)
@@ -46,11 +89,7 @@ def enumerate_user_metas(lichess_usernames, priority=0, max_retries=3, timeout=1
     url = '%s/lichessapi/api/users?with_moves=1&priority=%s&max_retries=%s' % (settings.API_WORKER_HOST, priority, max_retries)
     while len(lichess_usernames) > 0:
         batch = lichess_usernames[:300]
-        result = _apicall(url, timeout, post_data=','.join(batch))
-        if result == '':
-            raise ApiWorkerError('API failure')
-        for meta in json.loads(result):
-            yield meta
+        yield from _stream(url, timeout, post_data=','.join(batch))
         lichess_usernames = lichess_usernames[300:]
 
 def enumerate_user_statuses(lichess_usernames, priority=0, max_retries=3, timeout=120):
@@ -92,35 +131,55 @@ def get_pgn_with_cache(gameid, priority=0, max_retries=3, timeout=120):
     cache.set('pgn_%s' % gameid, result, 60 * 60 * 24) # Cache the PGN for 24 hours
     return result
 
-def get_game_meta(gameid, priority=0, max_retries=3, timeout=120):
-    url = '%s/lichessapi/game/export/%s?priority=%s&max_retries=%s&format=application/json' % (settings.API_WORKER_HOST, gameid, priority, max_retries)
-    result = _apicall(url, timeout)
+def _game_meta_url(gameid, priority, max_retries):
+    return '%s/lichessapi/game/export/%s?priority=%s&max_retries=%s&format=application/json' % (settings.API_WORKER_HOST, gameid, priority, max_retries)
+
+def _parse_game_meta(result):
     if result == '':
         raise ApiWorkerError('API failure')
     return json.loads(result)
 
+def get_game_meta(gameid, priority=0, max_retries=3, timeout=120):
+    return _parse_game_meta(_apicall(_game_meta_url(gameid, priority, max_retries), timeout))
+
+async def get_game_meta_async(gameid, priority=0, max_retries=3, timeout=120):
+    return _parse_game_meta(await _apicall_async(_game_meta_url(gameid, priority, max_retries), timeout))
+
+def enumerate_game_metas(gameids, priority=0, max_retries=3, timeout=120):
+    url = '%s/lichessapi/games/export/_ids?priority=%s&max_retries=%s&format=application/x-ndjson' % (settings.API_WORKER_HOST, priority, max_retries)
+    while len(gameids) > 0:
+        batch = gameids[:300]
+        yield from _stream(url, timeout, post_data=','.join(batch))
+        gameids = gameids[300:]
+
 def get_latest_game_metas(lichess_username, number, priority=0, max_retries=3, timeout=120):
+    return list(enumerate_latest_game_metas(lichess_username, number, priority, max_retries, timeout))
+
+def enumerate_latest_game_metas(lichess_username, number, priority=0, max_retries=3, timeout=120):
     url = '%s/lichessapi/api/games/user/%s?max=%s&ongoing=true&priority=%s&max_retries=%s&format=application/x-ndjson' % (settings.API_WORKER_HOST, lichess_username, number, priority, max_retries)
-    result = _apicall(url, timeout)
-    if result == '':
-        raise ApiWorkerError('API failure')
-    return [json.loads(g) for g in result.split('\n') if g.strip()]
+    return _stream(url, timeout)
 
 def watch_games(game_ids):
     try:
         url = '%s/watch/' % (settings.API_WORKER_HOST)
-        r = requests.post(url, data=','.join(game_ids))
+        r = _get_session().post(url, data=','.join(game_ids))
         return r.json()['result']
     except Exception:
         logger.exception('Error watching games')
         return []
 
 def add_watch(game_id):
+    add_watches([game_id])
+
+def add_watches(game_ids):
+    # Returns the ids of the games the API worker isn't streaming (all of them if it can't be reached)
     try:
         url = '%s/watch/add/' % (settings.API_WORKER_HOST)
-        requests.post(url, data=game_id)
+        r = _get_session().post(url, data=','.join(game_ids))
+        return r.json()['unstreamed']
     except Exception:
         logger.exception('Error adding watch')
+        return list(game_ids)
 
 # HTTP headers used to send non-API requests to lichess
 _headers = {'Accept': 'application/vnd.lichess.v1+json'}
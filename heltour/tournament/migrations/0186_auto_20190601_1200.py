@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tournament', '0184_auto_20190518_1606'),
+        ('tournament', '0185_auto_20190512_0117'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='league',
+            name='pairing_type',
+            field=models.CharField(choices=[('swiss-dutch', 'Swiss Tournament: Dutch Algorithm'), ('swiss-dutch-baku-accel', 'Swiss Tournament: Dutch Algorithm + Baku Acceleration'), ('swiss-dutch-native', 'Swiss Tournament: Dutch Algorithm (built-in engine)'), ('swiss-dutch-baku-accel-native', 'Swiss Tournament: Dutch Algorithm + Baku Acceleration (built-in engine)')], max_length=32),
+        ),
+    ]
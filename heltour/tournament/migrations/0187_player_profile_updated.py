@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tournament', '0186_auto_20190601_1200'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='player',
+            name='profile_updated',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -8,6 +8,7 @@ from datetime import timedelta
 from django.utils import timezone
 from django import forms as django_forms
 from collections import namedtuple, defaultdict
+from itertools import chain
 import re
 from django.core.exceptions import ValidationError
 import select2.fields
@@ -17,9 +18,17 @@ from django.contrib.auth.models import User
 from django.contrib.postgres.fields.jsonb import JSONField
 from django.contrib.sites.models import Site
 from django_comments.models import Comment
+from django.db.models import Case, F, When, Value
+from django.core.cache import cache
 from heltour import settings
+from heltour.tournament.tiebreaks import LoneResults, standings_order, fide_dp_lookup
+from heltour.tournament.teamgen import resolve_names
+from math import isnan
 import reversion
 
+if not settings.TESTING:
+    from cacheops.invalidation import invalidate_model
+
 logger = logging.getLogger(__name__)
 
 # Helper function to find an item in a list by its properties
@@ -35,6 +44,31 @@ def getnestedattr(obj, k):
         obj = getattr(obj, k2)
     return obj
 
+class PairingIndex(object):
+    '''Indexes pairings and byes by (round id, competitor id) so they can be looked up without scanning.
+
+    For team pairings, pass white_key='white_team_id' and black_key='black_team_id'.
+    '''
+
+    def __init__(self, pairings=(), byes=(), white_key='white_id', black_key='black_id'):
+        self.white = {}
+        self.black = {}
+        self.byes = {}
+        for p in pairings:
+            self.white.setdefault((p.round_id, getattr(p, white_key)), p)
+            self.black.setdefault((p.round_id, getattr(p, black_key)), p)
+        for bye in byes:
+            self.byes.setdefault((bye.round_id, bye.player_id), bye)
+
+    def white_pairing(self, round_id, competitor_id):
+        return self.white.get((round_id, competitor_id))
+
+    def black_pairing(self, round_id, competitor_id):
+        return self.black.get((round_id, competitor_id))
+
+    def bye(self, round_id, player_id):
+        return self.byes.get((round_id, player_id))
+
 def abs_url(url):
     site = Site.objects.get_current().domain
     return '%s://%s%s' % (settings.LINK_PROTOCOL, site, url)
@@ -92,6 +126,8 @@ COMPETITOR_TYPE_OPTIONS = (
 PAIRING_TYPE_OPTIONS = (
     ('swiss-dutch', 'Swiss Tournament: Dutch Algorithm'),
     ('swiss-dutch-baku-accel', 'Swiss Tournament: Dutch Algorithm + Baku Acceleration'),
+    ('swiss-dutch-native', 'Swiss Tournament: Dutch Algorithm (built-in engine)'),
+    ('swiss-dutch-baku-accel-native', 'Swiss Tournament: Dutch Algorithm + Baku Acceleration (built-in engine)'),
 )
 
 #-------------------------------------------------------------------------------
@@ -207,8 +243,17 @@ class Season(_BaseModel):
 
     def export_players(self):
         last_season_alts = self.last_season_alternates()
+        season_players = list(self.seasonplayer_set
+                              .filter(is_active=True)
+                              .select_related('player', 'registration')
+                              .nocache())
+        # Friend/avoid requests are resolved to player ids once here, so team generation doesn't have to
+        # search every request for every player's name
+        ids_by_username = {sp.player.lichess_username.lower(): sp.player_id for sp in season_players}
+
         def extract(sp):
             info = {
+                'id': sp.player_id,
                 'name': sp.player.lichess_username,
                 'rating': sp.player.rating_for(self.league),
                 'has_20_games': not sp.player.provisional_for(self.league),
@@ -217,6 +262,8 @@ class Season(_BaseModel):
                 'date_created': None,
                 'friends': None,
                 'avoid': None,
+                'friend_ids': [],
+                'avoid_ids': [],
                 'prefers_alt': False,
                 'previous_season_alternate': sp.player in last_season_alts
             }
@@ -227,16 +274,30 @@ class Season(_BaseModel):
                     'peak_classical_rating': reg.peak_classical_rating,
                     'friends': reg.friends,
                     'avoid': reg.avoid,
+                    'friend_ids': resolve_names(reg.friends, ids_by_username),
+                    'avoid_ids': resolve_names(reg.avoid, ids_by_username),
                     'prefers_alt': reg.alternate_preference == 'alternate',
                 })
             return info
 
-        season_players = (self.seasonplayer_set
-                          .filter(is_active=True)
-                          .select_related('player', 'registration')
-                          .nocache())
         return [extract(sp) for sp in season_players]
 
+    def create_teams_progress(self):
+        '''Returns the status of the latest background team creation (see tasks.create_teams), or None.'''
+        return cache.get('create_teams_progress-%d' % self.pk)
+
+    def set_create_teams_progress(self, status, **details):
+        cache.set('create_teams_progress-%d' % self.pk, dict(details, status=status, updated=timezone.now()),
+                  timeout=60 * 60)
+
+    def create_teams_in_progress(self, progress):
+        '''Whether a team creation job is queued or running and has reported progress recently. A job that stopped
+        reporting (e.g. it was lost with its worker) doesn't block a new run.'''
+        if progress is None or progress['status'] not in ('queued', 'running'):
+            return False
+        stale = timezone.now() - timedelta(seconds=settings.CREATE_TEAMS_STALE_TIMEOUT)
+        return progress.get('updated') is not None and progress['updated'] > stale
+
     def clean(self):
         if self.league_id and self.league.competitor_type == 'team' and self.boards is None:
             raise ValidationError('Boards must be specified for a team season')
@@ -269,6 +330,7 @@ class Season(_BaseModel):
                 SeasonPrize.objects.create(season=self, max_rating=1600, rank=1)
 
         if is_completed_changed and self.is_completed:
+            self.flush_scores()
             # Remove out of date prizes
             SeasonPrizeWinner.objects.filter(season_prize__season=self).delete()
             # Award prizes
@@ -280,28 +342,99 @@ class Season(_BaseModel):
                         for member in team_scores[prize.rank - 1].team.teammember_set.all():
                             SeasonPrizeWinner.objects.create(season_prize=prize, player=member.player)
             else:
-                player_scores = sorted(LonePlayerScore.objects.filter(season_player__season=self).select_related('season_player__player').nocache(), key=lambda s: s.final_standings_sort_key(), reverse=True)
+                # Rank the players straight from the results, in the same order as the final standings
+                season_players = list(SeasonPlayer.objects.filter(season=self).select_related('player').nocache())
+                results, _ = self.lone_results(season_players)
+                ratings = [sp.player_rating_display(self.league) or 0 for sp in season_players]
+                ranked = [season_players[i] for i in standings_order(results.standings(), ratings=ratings)]
                 for prize in self.seasonprize_set.all():
-                    eligible_players = [s.season_player.player for s in player_scores if prize.max_rating is None or s.season_player.seed_rating < prize.max_rating]
+                    eligible_players = [sp.player for sp in ranked if prize.max_rating is None or sp.seed_rating < prize.max_rating]
                     if prize.rank <= len(eligible_players):
                         SeasonPrizeWinner.objects.create(season_prize=prize, player=eligible_players[prize.rank - 1])
 
-    def calculate_scores(self):
+    def calculate_scores(self, changed_ids=None):
+        '''Recalculates the scores and tiebreaks for the season.
+
+        changed_ids -- optional player ids (lone) or team ids (team) whose results have changed.
+                       If given, only the scores that can depend on those results are recalculated.
+
+        In either case, only the score rows whose values have actually changed are written.
+        '''
+        if changed_ids is not None:
+            changed_ids = {id_ for id_ in changed_ids if id_ is not None}
         if self.league.competitor_type == 'team':
-            self._calculate_team_scores()
+            self._calculate_team_scores(changed_ids)
         else:
-            self._calculate_lone_scores()
-
-    def _calculate_team_scores(self):
+            self._calculate_lone_scores(changed_ids)
+
+    def mark_scores_dirty(self, changed_ids=None):
+        '''Queues a score recalculation for the season.
+
+        Changes made within SCORE_RECALCULATION_DELAY seconds of each other are coalesced into a single
+        calculate_scores() call by a background task. Use flush_scores() when up-to-date scores are needed.
+        '''
+        if settings.SCORE_RECALCULATION_DELAY is None:
+            self.calculate_scores(changed_ids)
+            return
+        self._merge_dirty_scores(changed_ids)
+        season_id = self.pk
+
+        def committed():
+            # A recalculation that ran before the commit may have consumed the marker without seeing the changes
+            Season(pk=season_id)._merge_dirty_scores(changed_ids)
+            signals.do_calculate_scores.send(sender=Season, season_id=season_id)
+        transaction.on_commit(committed)
+
+    def _merge_dirty_scores(self, changed_ids):
+        key = 'season_scores_dirty-%d' % self.pk
+        with cache.lock(key + '-lock'):
+            dirty = cache.get(key)
+            if dirty is None:
+                dirty = {'changed_ids': None if changed_ids is None else set(changed_ids)}
+            elif changed_ids is None:
+                dirty['changed_ids'] = None
+            elif dirty['changed_ids'] is not None:
+                dirty['changed_ids'] |= set(changed_ids)
+            cache.set(key, dirty, timeout=None)
+
+    def flush_scores(self, recalculate=False):
+        '''Immediately runs the score recalculation queued by mark_scores_dirty(), if any.
+
+        recalculate -- recalculate all the scores even if nothing is queued
+        '''
+        key = 'season_scores_dirty-%d' % self.pk
+        if settings.SCORE_RECALCULATION_DELAY is None or cache.get(key) is None:
+            # Nothing is queued (checked without the lock, since this runs on page views)
+            if recalculate:
+                self.calculate_scores()
+            return
+        with cache.lock(key + '-lock'):
+            dirty = cache.get(key)
+            cache.delete(key)
+        if recalculate:
+            self.calculate_scores()
+        elif dirty is not None:
+            self.calculate_scores(dirty['changed_ids'])
+
+    def _calculate_team_scores(self, changed_team_ids=None):
         # Note: The scores are calculated in a particular way to allow easy adding of new tiebreaks
         score_dict = {}
 
+        teams = list(Team.objects.filter(season=self).nocache())
+        team_scores = list(TeamScore.objects.filter(team__season=self).nocache())
+        opponents = defaultdict(set)
+
+        pairings = list(TeamPairing.objects.filter(round__season=self, round__is_completed=True).nocache())
+        pairing_index = PairingIndex(pairings, white_key='white_team_id', black_key='black_team_id')
+        for p in pairings:
+            opponents[p.white_team_id].add(p.black_team_id)
+            opponents[p.black_team_id].add(p.white_team_id)
+
         last_round = None
         for round_ in self.round_set.filter(is_completed=True).order_by('number'):
-            round_pairings = round_.teampairing_set.all()
-            for team in Team.objects.filter(season=self):
-                white_pairing = find(round_pairings, white_team_id=team.id)
-                black_pairing = find(round_pairings, black_team_id=team.id)
+            for team in teams:
+                white_pairing = pairing_index.white_pairing(round_.id, team.id)
+                black_pairing = pairing_index.black_pairing(round_.id, team.id)
                 is_playoffs = round_.number > self.rounds - self.playoffs
 
                 def increment_score(round_opponent, round_points, round_opponent_points, round_wins):
@@ -338,12 +471,31 @@ class Season(_BaseModel):
 
         # Precalculate groups of tied teams for the tiebreaks
         tied_team_map = defaultdict(set)
-        for team in Team.objects.filter(season=self):
-            score_state = score_dict[(team.pk, last_round.number)]
-            tied_team_map[(score_state.match_points, score_state.game_points)].add(team.pk)
+        if last_round is not None:
+            for team in teams:
+                score_state = score_dict[(team.pk, last_round.number)]
+                tied_team_map[(score_state.match_points, score_state.game_points)].add(team.pk)
 
-        team_scores = TeamScore.objects.filter(team__season=self)
+        if changed_team_ids is None:
+            affected_team_ids = {team.pk for team in teams}
+        else:
+            # A changed result affects the teams involved, their opponents (SB), and the teams
+            # that were or are now tied with them (head-to-head)
+            affected_team_ids = set(changed_team_ids)
+            for team_id in changed_team_ids:
+                affected_team_ids |= opponents[team_id]
+            for score in team_scores:
+                if score.team_id in changed_team_ids:
+                    affected_team_ids |= tied_team_map[(score.match_points, score.game_points)]
+                    if last_round is not None:
+                        score_state = score_dict[(score.team_id, last_round.number)]
+                        affected_team_ids |= tied_team_map[(score_state.match_points, score_state.game_points)]
+
+        changed_scores = []
         for score in team_scores:
+            if score.team_id not in affected_team_ids:
+                continue
+            old_values = _score_values(score, _TEAM_SCORE_FIELDS)
             if last_round is None:
                 score.playoff_score = 0
                 score.match_count = 0
@@ -374,95 +526,71 @@ class Season(_BaseModel):
                             score.sb_score += score_dict[(round_state.round_opponent, last_round.number)].match_points / 2.0
                         if opponent in tied_team_set:
                             score.head_to_head += round_state.round_match_points
-            score.save()
-
-    def _calculate_lone_scores(self):
-        season_players = SeasonPlayer.objects.filter(season=self).select_related('loneplayerscore').nocache()
-        seed_rating_dict = {sp.player_id: sp.seed_rating for sp in season_players}
-        score_dict = {}
-        last_round = None
-        for round_ in self.round_set.filter(is_completed=True).order_by('number'):
-            pairings = round_.loneplayerpairing_set.all().nocache()
-            byes = PlayerBye.objects.filter(round=round_)
+            if _score_values(score, _TEAM_SCORE_FIELDS) != old_values:
+                changed_scores.append(score)
+        _bulk_update(TeamScore, changed_scores, _TEAM_SCORE_FIELDS)
+
+    def lone_results(self, season_players):
+        '''Returns a LoneResults with the completed rounds of the season, for the given season players.
+
+        It can be copied and modified to get what-if standings without touching the database.
+        '''
+        rounds = list(self.round_set.filter(is_completed=True).order_by('number'))
+        pairings = list(LonePlayerPairing.objects.filter(round__season=self, round__is_completed=True).nocache())
+        byes = PlayerBye.objects.filter(round__season=self, round__is_completed=True).nocache()
+        pairing_index = PairingIndex(pairings, byes)
+        results = LoneResults([sp.player_id for sp in season_players], len(rounds))
+        for round_index, round_ in enumerate(rounds):
             for sp in season_players:
-                white_pairing = find(pairings, white_id=sp.player_id)
-                black_pairing = find(pairings, black_id=sp.player_id)
-                bye = find(byes, player_id=sp.player_id)
-
-                def increment_score(round_opponent, round_score, round_played):
-                    total, mm_total, cumul, perf, _, _ = score_dict[(sp.player_id, last_round.number)] if last_round is not None else (0, 0, 0, PerfRatingCalc(), None, False)
-                    total += round_score
-                    cumul += total
-                    if round_played:
-                        mm_total += round_score
-                        opp_rating = seed_rating_dict.get(round_opponent, None)
-                        if opp_rating is not None:
-                            perf.add_game(round_score, opp_rating)
-                    else:
-                        # Special cases for unplayed games
-                        mm_total += 0.5
-                        cumul -= round_score
-                    score_dict[(sp.player_id, round_.number)] = _LoneScoreState(total, mm_total, cumul, perf, round_opponent, round_played)
-
+                white_pairing = pairing_index.white_pairing(round_.id, sp.player_id)
+                black_pairing = pairing_index.black_pairing(round_.id, sp.player_id)
+                bye = pairing_index.bye(round_.id, sp.player_id)
                 if white_pairing is not None:
-                    increment_score(white_pairing.black_id, white_pairing.white_score() or 0, white_pairing.game_played())
+                    results.set_result(round_index, sp.player_id, white_pairing.white_score() or 0, white_pairing.black_id, white_pairing.game_played())
                 elif black_pairing is not None:
-                    increment_score(black_pairing.white_id, black_pairing.black_score() or 0, black_pairing.game_played())
+                    results.set_result(round_index, sp.player_id, black_pairing.black_score() or 0, black_pairing.white_id, black_pairing.game_played())
                 elif bye is not None:
-                    increment_score(None, bye.score(), False)
-                else:
-                    increment_score(None, 0, False)
-            last_round = round_
-
-        player_scores = [sp.get_loneplayerscore() for sp in season_players]
-
-        for score in player_scores:
-            player_id = score.season_player.player_id
-            if last_round is None:
-                score.points = 0
-                score.tiebreak1 = 0
-                score.tiebreak2 = 0
-                score.tiebreak3 = 0
-                score.tiebreak4 = 0
-            else:
-                score_state = score_dict[(score.season_player.player_id, last_round.number)]
-                score.points = score_state.total
-
-                # Tiebreak calculations
-
-                opponent_scores = []
-                opponent_cumuls = []
-                for round_number in range(1, last_round.number + 1):
-                    round_state = score_dict[(player_id, round_number)]
-                    if round_state.round_played and round_state.round_opponent is not None:
-                        opponent_scores.append(score_dict[(round_state.round_opponent, last_round.number)].mm_total)
-                        opponent_cumuls.append(score_dict[(round_state.round_opponent, last_round.number)].cumul)
-                    else:
-                        opponent_scores.append(0)
-                opponent_scores.sort()
-
-                # TB1: Modified Median
-                median_scores = opponent_scores
-                skip = 2 if last_round.number >= 9 else 1
-                if score.points <= last_round.number / 2.0:
-                    median_scores = median_scores[:-skip]
-                if score.points >= last_round.number / 2.0:
-                    median_scores = median_scores[skip:]
-                score.tiebreak1 = sum(median_scores)
-
-                # TB2: Solkoff
-                score.tiebreak2 = sum(opponent_scores)
-
-                # TB3: Cumulative
-                score.tiebreak3 = score_state.cumul
-
-                # TB4: Cumulative opponent
-                score.tiebreak4 = sum(opponent_cumuls)
+                    results.set_result(round_index, sp.player_id, bye.score())
+        return results, pairings
 
-                # Performance rating
-                score.perf_rating = score_state.perf.calculate()
+    def _calculate_lone_scores(self, changed_player_ids=None):
+        season_players = list(SeasonPlayer.objects.filter(season=self).select_related('loneplayerscore').nocache())
+        seed_rating_dict = {sp.player_id: sp.seed_rating for sp in season_players}
+        results, pairings = self.lone_results(season_players)
 
-            score.save()
+        if changed_player_ids is None:
+            affected_player_ids = set(seed_rating_dict)
+        else:
+            # A changed result affects the players involved and everyone who has been paired against
+            # them (since the opponent tiebreaks depend on their scores)
+            opponents = defaultdict(set)
+            for p in pairings:
+                opponents[p.white_id].add(p.black_id)
+                opponents[p.black_id].add(p.white_id)
+            affected_player_ids = set(changed_player_ids)
+            for player_id in changed_player_ids:
+                affected_player_ids |= opponents[player_id]
+
+        standings = results.standings(seed_rating_dict)
+
+        changed_scores = []
+        for i, sp in enumerate(season_players):
+            if sp.player_id not in affected_player_ids:
+                continue
+            score = sp.get_loneplayerscore()
+            old_values = _score_values(score, _LONE_SCORE_FIELDS)
+            score.points = float(standings.points[i])
+            score.tiebreak1 = float(standings.tiebreak1[i])
+            score.tiebreak2 = float(standings.tiebreak2[i])
+            score.tiebreak3 = float(standings.tiebreak3[i])
+            score.tiebreak4 = float(standings.tiebreak4[i])
+            if results.scores.shape[1]:
+                perf_rating = standings.perf_rating[i]
+                score.perf_rating = None if isnan(perf_rating) else int(perf_rating)
+
+            if _score_values(score, _LONE_SCORE_FIELDS) != old_values:
+                changed_scores.append(score)
+        _bulk_update(LonePlayerScore, changed_scores, _LONE_SCORE_FIELDS)
 
     def is_started(self):
         return self.start_date is not None and self.start_date < timezone.now()
@@ -514,15 +642,32 @@ class Season(_BaseModel):
         return self.name
 
 _TeamScoreState = namedtuple('_TeamScoreState', 'playoff_score, match_count, match_points, game_points, games_won, round_match_points, round_points, round_opponent, round_opponent_points')
-_LoneScoreState = namedtuple('_LoneScoreState', 'total, mm_total, cumul, perf, round_opponent, round_played')
 
-# From https://www.fide.com/component/handbook/?id=174&view=article
-# Used for performance rating calculations
-fide_dp_lookup = [-800, -677, -589, -538, -501, -470, -444, -422, -401, -383, -366, -351, -336, -322, -309, -296, -284, -273, -262, -251,
-                   - 240, -230, -220, -211, -202, -193, -184, -175, -166, -158, -149, -141, -133, -125, -117, -110, -102, -95, -87, -80, -72,
-                   - 65, -57, -50, -43, -36, -29, -21, -14, -7, 0, 7, 14, 21, 29, 36, 43, 50, 57, 65, 72, 80, 87, 95, 102, 110, 117, 125, 133,
-                   141, 149, 158, 166, 175, 184, 193, 202, 211, 220, 230, 240, 251, 262, 273, 284, 296, 309, 322, 336, 351, 366, 383, 401,
-                   422, 444, 470, 501, 538, 589, 677, 800]
+_TEAM_SCORE_FIELDS = ('playoff_score', 'match_count', 'match_points', 'game_points', 'head_to_head', 'games_won', 'sb_score')
+_LONE_SCORE_FIELDS = ('points', 'tiebreak1', 'tiebreak2', 'tiebreak3', 'tiebreak4', 'perf_rating')
+
+def _score_values(score, fields):
+    return tuple(getattr(score, f) for f in fields)
+
+def _bulk_update(model, objs, fields, batch_size=500):
+    # Write the fields of the objects with one UPDATE statement per batch, bypassing the per-row save() overhead
+    if not objs:
+        return
+    now = timezone.now()
+    with transaction.atomic():
+        for start in range(0, len(objs), batch_size):
+            batch = objs[start:start + batch_size]
+            values = {}
+            for f in fields:
+                output_field = model._meta.get_field(f)
+                values[f] = Case(*[When(pk=o.pk, then=Value(getattr(o, f), output_field=output_field)) for o in batch],
+                                 default=F(f), output_field=output_field)
+            model.objects.filter(pk__in=[o.pk for o in batch]).update(date_modified=now, **values)
+    for o in objs:
+        o.date_modified = now
+    # Since the update skips the post_save signal, invalidate the cache once for the whole batch
+    if not settings.TESTING:
+        invalidate_model(model)
 
 def get_fide_dp(score, total):
     # Turn the score into a number from 0-100 (0 = 0%, 100 = 100%)
@@ -638,6 +783,15 @@ ACCOUNT_STATUS_OPTIONS = (
     ('closed', 'Closed'),
 )
 
+# Lichess profile keys that change on almost every fetch without affecting anything we use
+_VOLATILE_PROFILE_KEYS = ('seenAt', 'playTime', 'nbFollowers', 'nbFollowing')
+
+def _same_profile(profile, user_meta):
+    if profile is None:
+        return False
+    strip = lambda p: {k: v for k, v in p.items() if k not in _VOLATILE_PROFILE_KEYS}
+    return strip(profile) == strip(user_meta)
+
 #-------------------------------------------------------------------------------
 class Player(_BaseModel):
     # TODO: we should find out the real restrictions on a lichess username and
@@ -654,6 +808,7 @@ class Player(_BaseModel):
     account_status = models.CharField(default='normal', max_length=31, choices=ACCOUNT_STATUS_OPTIONS)
 
     profile = JSONField(blank=True, null=True)
+    profile_updated = models.DateTimeField(blank=True, null=True)
 
     def player_rating_display(self, league=None):
         return self.rating_for(league)
@@ -682,16 +837,64 @@ class Player(_BaseModel):
             signals.player_account_status_changed.send(Player, instance=self, old_value=self.initial_account_status, new_value=self.account_status)
 
     def update_profile(self, user_meta):
-        self.profile = user_meta
+        for field, value in self._profile_fields(user_meta).items():
+            setattr(self, field, value)
+        self.profile_updated = timezone.now()
+        self.save()
+
+    def _profile_fields(self, user_meta):
+        # The fields derived from a lichess user meta, keeping the stored profile if only volatile keys differ
+        fields = {'profile': self.profile if _same_profile(self.profile, user_meta) else user_meta}
         classical = user_meta['perfs'].get('classical')
         if classical is not None:
-            self.rating = classical['rating']
-            self.games_played = classical['games']
+            fields['rating'] = classical['rating']
+            fields['games_played'] = classical['games']
         is_engine = user_meta.get('engine', False)
         is_booster = user_meta.get('booster', False)
         is_closed = user_meta.get('disabled', False)
-        self.account_status = 'closed' if is_closed else 'engine' if is_engine else 'booster' if is_booster else 'normal'
-        self.save()
+        fields['account_status'] = 'closed' if is_closed else 'engine' if is_engine else 'booster' if is_booster else 'normal'
+        return fields
+
+    @classmethod
+    def update_profiles(cls, players, user_metas, batch_size=100):
+        '''Bulk version of update_profile. Only the players whose profile changed are written, and
+        player_account_status_changed is only sent for real transitions. Returns (players found, players changed).'''
+        by_username = {p.lichess_username.lower(): p for p in players}
+        changed = []
+        unchanged_ids = []
+        changed_fields = {'profile_updated'}
+        found = changed_count = 0
+
+        def write():
+            now = timezone.now()
+            for p in changed:
+                p.profile_updated = now
+            _bulk_update(cls, changed, changed_fields)
+            cls.objects.filter(pk__in=unchanged_ids).update(profile_updated=now)
+            for p in changed:
+                if p.account_status != p.initial_account_status:
+                    signals.player_account_status_changed.send(Player, instance=p, old_value=p.initial_account_status, new_value=p.account_status)
+                    p.initial_account_status = p.account_status
+            del changed[:], unchanged_ids[:]
+
+        for user_meta in user_metas:
+            p = by_username.get(user_meta['id'].lower())
+            if p is None:
+                continue
+            found += 1
+            fields = {field: value for field, value in p._profile_fields(user_meta).items() if getattr(p, field) != value}
+            if fields:
+                for field, value in fields.items():
+                    setattr(p, field, value)
+                changed.append(p)
+                changed_fields.update(fields)
+                changed_count += 1
+            else:
+                unchanged_ids.append(p.pk)
+            if len(changed) + len(unchanged_ids) >= batch_size:
+                write()
+        write()
+        return found, changed_count
 
     @classmethod
     def get_or_create(cls, user):
@@ -927,13 +1130,14 @@ class PlayerBye(_BaseModel):
             self.player_rating = None
         super(PlayerBye, self).save(*args, **kwargs)
         if (round_changed or player_changed or type_changed) and self.round.is_completed:
-            self.round.season.calculate_scores()
+            self.round.season.mark_scores_dirty(changed_ids={self.player_id, self.initial_player_id})
 
     def delete(self, *args, **kwargs):
         round_ = self.round
+        player_id = self.player_id
         super(PlayerBye, self).delete(*args, **kwargs)
         if round_.is_completed:
-            round_.season.calculate_scores()
+            round_.season.mark_scores_dirty(changed_ids={player_id})
 
     def clean(self):
         if self.round_id and self.round.season.league.competitor_type == 'team':
@@ -959,8 +1163,10 @@ class Team(_BaseModel):
             return TeamScore.objects.create(team=self)
 
     def boards(self):
-        team_members = self.teammember_set.all()
-        return [(n, find(team_members, board_number=n)) for n in Season.objects.get(pk=self.season_id).board_number_list()]
+        board_dict = {}
+        for tm in self.teammember_set.all():
+            board_dict.setdefault(tm.board_number, tm)
+        return [(n, board_dict.get(n)) for n in Season.objects.get(pk=self.season_id).board_number_list()]
 
     def average_rating(self, expected_rating=False):
         n = 0
@@ -1087,16 +1293,16 @@ class TeamScore(_BaseModel):
         return (self.playoff_score, self.match_points, self.game_points, self.head_to_head, self.games_won, self.sb_score, self.team.seed_rating)
 
     def round_scores(self):
-        white_pairings = self.team.pairings_as_white.all()
-        black_pairings = self.team.pairings_as_black.all()
+        pairing_index = PairingIndex(chain(self.team.pairings_as_white.all(), self.team.pairings_as_black.all()),
+                                     white_key='white_team_id', black_key='black_team_id')
         for round_ in Round.objects.filter(season_id=self.team.season_id).order_by('number'):
             if round_ is None or not round_.is_completed:
                 yield None, None, None
                 continue
             points = None
             opp_points = None
-            white_pairing = find(white_pairings, round_id=round_.id)
-            black_pairing = find(black_pairings, round_id=round_.id)
+            white_pairing = pairing_index.white_pairing(round_.id, self.team_id)
+            black_pairing = pairing_index.black_pairing(round_.id, self.team_id)
             if white_pairing is not None:
                 points = white_pairing.white_points
                 opp_points = white_pairing.black_points
@@ -1108,11 +1314,15 @@ class TeamScore(_BaseModel):
     def cross_scores(self, sorted_teams=None):
         if sorted_teams is None:
             sorted_teams = Team.objects.filter(season_id=self.team.season_id).order_by('number')
-        white_pairings = self.team.pairings_as_white.all()
-        black_pairings = self.team.pairings_as_black.all()
+        white_pairing_dict = {}
+        for p in self.team.pairings_as_white.select_related('round'):
+            white_pairing_dict.setdefault(p.black_team_id, p)
+        black_pairing_dict = {}
+        for p in self.team.pairings_as_black.select_related('round'):
+            black_pairing_dict.setdefault(p.white_team_id, p)
         for other_team in sorted_teams:
-            white_pairing = find(white_pairings, black_team_id=other_team.pk)
-            black_pairing = find(black_pairings, white_team_id=other_team.pk)
+            white_pairing = white_pairing_dict.get(other_team.pk)
+            black_pairing = black_pairing_dict.get(other_team.pk)
             points = None
             opp_points = None
             round_num = None
@@ -1157,7 +1367,7 @@ class TeamPairing(_BaseModel):
         points_changed = self.pk is None or self.white_points != self.initial_white_points or self.black_points != self.initial_black_points
         super(TeamPairing, self).save(*args, **kwargs)
         if points_changed and self.round.is_completed:
-            self.round.season.calculate_scores()
+            self.round.season.mark_scores_dirty(changed_ids={self.white_team_id, self.black_team_id})
 
     def clean(self):
         if self.white_team_id and self.black_team_id and self.white_team.season != self.round.season or self.black_team.season != self.round.season:
@@ -1381,7 +1591,7 @@ class PlayerPairing(_BaseModel):
         if hasattr(self, 'loneplayerpairing'):
             lpp = LonePlayerPairing.objects.nocache().get(pk=self.loneplayerpairing.pk)
             if result_changed and lpp.round.is_completed:
-                lpp.round.season.calculate_scores()
+                lpp.round.season.mark_scores_dirty(changed_ids={self.white_id, self.black_id, self.initial_white_id, self.initial_black_id})
             # If the players for a PlayerPairing in the current round are edited, then we can update the player ranks
             if (white_changed or black_changed) and lpp.round.publish_pairings and not lpp.round.is_completed:
                 lpp.refresh_ranks()
@@ -1426,7 +1636,7 @@ class PlayerPairing(_BaseModel):
             self.teamplayerpairing.team_pairing.refresh_points()
             self.teamplayerpairing.team_pairing.save()
         if round_ is not None:
-            round_.season.calculate_scores()
+            round_.season.mark_scores_dirty(changed_ids={self.white_id, self.black_id})
 
 def result_is_forfeit(result):
     return result.endswith(('X', 'F', 'Z'))
@@ -1676,10 +1886,8 @@ class LonePlayerScore(_BaseModel):
 
     perf_rating = models.PositiveIntegerField(blank=True, null=True)
 
-    def round_scores(self, rounds, player_number_dict, white_pairings_dict, black_pairings_dict, byes_dict, include_current=False):
-        white_pairings = white_pairings_dict.get(self.season_player.player, [])
-        black_pairings = black_pairings_dict.get(self.season_player.player, [])
-        byes = byes_dict.get(self.season_player.player, [])
+    def round_scores(self, rounds, player_number_dict, pairing_index, include_current=False):
+        player_id = self.season_player.player_id
         cumul_score = 0.0
         for round_ in rounds:
             if not round_.is_completed and (not include_current or not round_.publish_pairings):
@@ -1690,9 +1898,9 @@ class LonePlayerScore(_BaseModel):
             opponent = None
             color = None
 
-            white_pairing = find(white_pairings, round_id=round_.id)
-            black_pairing = find(black_pairings, round_id=round_.id)
-            bye = find(byes, round_id=round_.id)
+            white_pairing = pairing_index.white_pairing(round_.id, player_id)
+            black_pairing = pairing_index.black_pairing(round_.id, player_id)
+            bye = pairing_index.bye(round_.id, player_id)
 
             if white_pairing is not None and white_pairing.black is not None:
                 opponent = white_pairing.black
@@ -1,20 +1,54 @@
 from .models import *
+from . import dutch
 from heltour import settings
-from django.db import transaction
+from django.db import transaction, connections, router
+from django.core.cache import cache
 import tempfile
 import subprocess
 import os
 import reversion
 import math
-
-def generate_pairings(round_, overwrite=False):
+import atexit
+import hashlib
+import select
+import shlex
+import threading
+import time
+from collections import defaultdict
+from itertools import chain
+
+if not settings.TESTING:
+    from cacheops.invalidation import invalidate_model
+
+def generate_pairings(round_, overwrite=False, dry_run=False):
+    '''Generates and saves the pairings for a round.
+
+    With dry_run=True nothing is saved; a (pairings, byes) tuple with the proposed pairings is returned instead.
+    For team leagues, the pairings are the TeamPlayerPairing objects and there are no byes.
+    '''
+    # Pairings depend on the standings, so make sure any queued score changes are applied
+    round_.season.flush_scores()
     if round_.season.league.competitor_type == 'team':
-        _generate_team_pairings(round_, overwrite)
+        generate = _generate_team_pairings
     else:
-        _generate_lone_pairings(round_, overwrite)
+        generate = _generate_lone_pairings
+    if not dry_run:
+        generate(round_, overwrite)
+        return None
+    try:
+        with transaction.atomic():
+            raise _DryRunRollback(generate(round_, overwrite))
+    except _DryRunRollback as e:
+        return e.result
+
+class _DryRunRollback(Exception):
+    def __init__(self, result):
+        self.result = result
 
 def _generate_team_pairings(round_, overwrite=False):
-    with transaction.atomic():
+    # Record the whole run as a single revision
+    with transaction.atomic(), reversion.create_revision():
+        reversion.set_comment('Generated pairings.')
         existing_pairings = TeamPairing.objects.filter(round=round_)
         if existing_pairings.count() > 0:
             if overwrite:
@@ -27,45 +61,55 @@ def _generate_team_pairings(round_, overwrite=False):
         for team in teams:
             if team.seed_rating is None:
                 team.seed_rating = team.average_rating()
-                with reversion.create_revision():
-                    reversion.set_comment('Set seed rating.')
-                    team.save()
+                team.save()
         teams = sorted(teams, key=lambda team: team.get_teamscore().pairing_sort_key(), reverse=True)
 
         previous_pairings = TeamPairing.objects.filter(round__season=round_.season, round__number__lt=round_.number).order_by('round__number')
 
         # Run the pairing algorithm
-        pairing_system = DutchTeamPairingSystem()
+        pairing_system = DutchTeamPairingSystem(engine=_league_pairing_engine(round_.season.league))
         team_pairings = pairing_system.create_team_pairings(round_, teams, previous_pairings)
 
         # Save the team pairings and create the individual pairings based on the team pairings
+        team_pairings = TeamPairing.objects.bulk_create(team_pairings)
         board_count = round_.season.boards
+        player_lists = _get_player_lists(round_, teams, board_count)
+        player_pairings = []
         for team_pairing in team_pairings:
-            with reversion.create_revision():
-                reversion.set_comment('Generated pairings.')
-                team_pairing.save()
-
-            white_player_list = _get_player_list(team_pairing.white_team, round_, board_count)
-            black_player_list = _get_player_list(team_pairing.black_team, round_, board_count)
+            white_player_list = player_lists[team_pairing.white_team_id]
+            black_player_list = player_lists[team_pairing.black_team_id]
             for board_number in range(1, board_count + 1):
                 white_player = white_player_list[board_number - 1]
                 black_player = black_player_list[board_number - 1]
                 if board_number % 2 == 0:
                     white_player, black_player = black_player, white_player
-                with reversion.create_revision():
-                    reversion.set_comment('Generated pairings.')
-                    TeamPlayerPairing.objects.create(team_pairing=team_pairing, board_number=board_number, white=white_player, black=black_player)
-
+                player_pairings.append(TeamPlayerPairing(team_pairing=team_pairing, board_number=board_number, white=white_player, black=black_player))
+        _bulk_create_player_pairings(TeamPlayerPairing, player_pairings)
+
+        for obj in chain(team_pairings, player_pairings):
+            reversion.add_to_revision(obj)
+        if not settings.TESTING:
+            invalidate_model(TeamPairing)
+        if team_pairings and round_.is_completed:
+            round_.season.mark_scores_dirty(changed_ids={tp.white_team_id for tp in team_pairings} | {tp.black_team_id for tp in team_pairings})
+        return player_pairings, []
+
+def _get_player_lists(round_, teams, board_count):
+    # Fetch the team members and alternate assignments for all the teams at once
+    team_members = {(tm.team_id, tm.board_number): tm for tm in TeamMember.objects.filter(team__in=teams).select_related('player').nocache()}
+    alternates = defaultdict(list)
+    for alt in AlternateAssignment.objects.filter(round=round_, team__in=teams).order_by('board_number') \
+                                          .select_related('player', 'replaced_player').nocache():
+        alternates[alt.team_id].append(alt)
+    return {team.id: _get_player_list([team_members.get((team.id, b)) for b in range(1, board_count + 1)], alternates[team.id])
+            for team in teams}
 
 # Create a list of players playing for the team this round
 #
 # The players and board numbers defined in AlternateAssignment are our invariants.
 # Other players could end up in slightly different boards than expected if the board
 # order changed since an alternate was assigned.
-def _get_player_list(team, round_, board_count):
-    team_members = [TeamMember.objects.filter(team=team, board_number=b).first() for b in range(1, board_count + 1)]
-    alternates = list(AlternateAssignment.objects.filter(round=round_, team=team).order_by('board_number'))
-
+def _get_player_list(team_members, alternates):
     player_list = [tm.player if tm is not None else None for tm in team_members]
 
     # Remove players that are being replaced by alternates
@@ -84,8 +128,38 @@ def _get_player_list(team, round_, board_count):
 
     return player_list
 
+def _bulk_create_player_pairings(model, pairings):
+    # bulk_create doesn't support multi-table inheritance, so bulk create the PlayerPairing rows first
+    # and then insert the subclass rows that point to them
+    if not pairings:
+        return
+    parent_fields = PlayerPairing._meta.concrete_fields
+    parents = PlayerPairing.objects.bulk_create([PlayerPairing(**{f.attname: getattr(p, f.attname) for f in parent_fields}) for p in pairings])
+    for pairing, parent in zip(pairings, parents):
+        for f in parent_fields:
+            setattr(pairing, f.attname, getattr(parent, f.attname))
+        pairing.playerpairing_ptr_id = parent.pk
+
+    db = router.db_for_write(model)
+    connection = connections[db]
+    fields = model._meta.local_concrete_fields
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (connection.ops.quote_name(model._meta.db_table),
+                                               ', '.join(connection.ops.quote_name(f.column) for f in fields),
+                                               ', '.join(['%s'] * len(fields)))
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, [[f.get_db_prep_save(getattr(pairing, f.attname), connection) for f in fields]
+                                 for pairing in pairings])
+    for pairing in pairings:
+        pairing._state.adding = False
+        pairing._state.db = db
+    if not settings.TESTING:
+        invalidate_model(PlayerPairing)
+        invalidate_model(model)
+
 def _generate_lone_pairings(round_, overwrite=False):
-    with transaction.atomic():
+    # Record the whole run as a single revision
+    with transaction.atomic(), reversion.create_revision():
+        reversion.set_comment('Generated pairings.')
         existing_pairings = LonePlayerPairing.objects.filter(round=round_)
         if existing_pairings.count() > 0:
             if overwrite:
@@ -107,9 +181,7 @@ def _generate_lone_pairings(round_, overwrite=False):
         for sp in season_players:
             if sp.seed_rating is None:
                 sp.seed_rating = sp.player.rating_for(round_.season.league)
-                with reversion.create_revision():
-                    reversion.set_comment('Set seed rating.')
-                    sp.save()
+                sp.save()
         season_players = sorted(season_players, key=lambda sp: sp.get_loneplayerscore().pairing_sort_key(), reverse=True)
 
         # Create byes for unavailable players
@@ -120,9 +192,7 @@ def _generate_lone_pairings(round_, overwrite=False):
         players_needing_byes = unavailable_players & active_players - current_byes
 
         for p in players_needing_byes:
-            with reversion.create_revision():
-                reversion.set_comment('Generated pairings.')
-                PlayerBye.objects.create(round=round_, player=p, type='half-point-bye')
+            PlayerBye.objects.create(round=round_, player=p, type='half-point-bye')
 
         # Don't generate pairings for players that have been withdrawn or have byes
         include_players = {sp for sp in season_players if sp.is_active and sp.player not in current_byes and sp.player not in unavailable_players}
@@ -133,26 +203,25 @@ def _generate_lone_pairings(round_, overwrite=False):
                                  .order_by('round__number').select_related('player', 'round').nocache()
 
         # Run the pairing algorithm
-        if round_.season.league.pairing_type == 'swiss-dutch-baku-accel':
-            pairing_system = DutchLonePairingSystem(accel='baku')
-        else:
-            pairing_system = DutchLonePairingSystem()
+        league = round_.season.league
+        accel = 'baku' if league.pairing_type.startswith('swiss-dutch-baku-accel') else None
+        pairing_system = DutchLonePairingSystem(accel=accel, engine=_league_pairing_engine(league))
         lone_pairings, byes = pairing_system.create_lone_pairings(round_, season_players, include_players, previous_pairings, previous_byes)
 
         # Save the lone pairings
         rank_dict = lone_player_pairing_rank_dict(round_.season)
         for lone_pairing in lone_pairings:
             lone_pairing.refresh_ranks(rank_dict)
-            with reversion.create_revision():
-                reversion.set_comment('Generated pairings.')
-                lone_pairing.save()
+        _bulk_create_player_pairings(LonePlayerPairing, lone_pairings)
+        for lone_pairing in lone_pairings:
+            reversion.add_to_revision(lone_pairing)
 
         # Save pairing byes and update player ranks for all byes
-        for bye in byes + list(PlayerBye.objects.filter(round=round_).select_related('player').nocache()):
+        byes += list(PlayerBye.objects.filter(round=round_).select_related('player').nocache())
+        for bye in byes:
             bye.refresh_rank(rank_dict)
-            with reversion.create_revision():
-                reversion.set_comment('Generated pairings.')
-                bye.save()
+            bye.save()
+        return lone_pairings, byes
 
 def delete_pairings(round_):
     if round_.season.league.competitor_type == 'team':
@@ -185,6 +254,9 @@ class PlaceholderTeamPairingSystem:
         return team_pairings
 
 class DutchTeamPairingSystem:
+    def __init__(self, engine=None):
+        self.engine = engine
+
     def create_team_pairings(self, round_, teams, previous_pairings):
         # Note: Assumes teams is sorted by seed and previous_pairings is sorted by round
 
@@ -192,7 +264,7 @@ class DutchTeamPairingSystem:
             JavafoPlayer(team, team.teamscore.match_points, list(self._process_pairings(team, previous_pairings))) for team in teams
         ]
         javafo = JavafoInstance(round_.season.rounds, players)
-        pairs = javafo.run()
+        pairs = javafo.run(self.engine)
 
         team_pairings = []
         for i in range(len(pairs)):
@@ -211,8 +283,9 @@ class DutchTeamPairingSystem:
                 yield JavafoPairing(p.white_team, 'black', 1.0 if p.black_points > p.white_points else 0.5 if p.white_points == p.black_points else 0)
 
 class DutchLonePairingSystem:
-    def __init__(self, accel=None):
+    def __init__(self, accel=None, engine=None):
         self.accel = accel
+        self.engine = engine
 
     def create_lone_pairings(self, round_, season_players, include_players, previous_pairings, previous_byes):
         # Note: Assumes season_players is sorted by seed and previous_pairings/previous_byes are sorted by round
@@ -256,7 +329,7 @@ class DutchLonePairingSystem:
             ) for sp in season_players
         ]
         javafo = JavafoInstance(round_.season.rounds, players)
-        pairs = javafo.run()
+        pairs = javafo.run(self.engine)
         lone_pairings = []
         byes = []
         for i in range(len(pairs)):
@@ -328,44 +401,90 @@ class JavafoInstance:
 
     Returns a list of JavafoPairingResult objects in the order they should be displayed.
     '''
-    def run(self):
+    def run(self, engine=None):
+        if engine is None:
+            engine = get_pairing_engine()
+        trfx = self._write_trfx()
+
+        pairs = self._read_output(_cached_pair(engine, trfx, '-q 10000'))
+        if len(pairs) == 0 and len(self.players) > 1:
+            # Took too long before terminating, use the slower but more deterministic algorithm
+            pairs = self._read_output(_cached_pair(engine, trfx, '-w'))
+
+        return pairs
+
+    def _write_trfx(self):
+        start_numbers = {player.player: n for n, player in enumerate(self.players, 1)}
+        lines = ['XXR %d\n' % self.total_round_count]
+        for n, player in enumerate(self.players, 1):
+            line = ['001 {0: >4}  {1:74.1f}     '.format(n, player.score)]
+            for pairing in player.pairings:
+                opponent_num = start_numbers.get(pairing.opponent, '0000')
+                color = 'w' if pairing.color == 'white' else 'b' if pairing.color == 'black' else '-'
+                if pairing.forfeit:
+                    score = '+' if pairing.score == 1 else '-' if pairing.score == 0 else '=' if pairing.score == 0.5 else ' '
+                else:
+                    score = '1' if pairing.score == 1 else '0' if pairing.score == 0 else '=' if pairing.score == 0.5 else ' '
+                if score == ' ':
+                    color = '-'
+                line.append('{0: >6} {1} {2}'.format(opponent_num, color, score))
+            if not player.include:
+                line.append('{0: >6} {1} {2}'.format('0000', '-', '-'))
+            line.append('\n')
+            lines.append(''.join(line))
+        for n, player in enumerate(self.players, 1):
+            if player.acceleration_scores:
+                line = 'XXA {0: >4} {1}\n'.format(n, ' '.join('{0: >4.1f}'.format(s) for s in player.acceleration_scores))
+                lines.append(line)
+        return ''.join(lines)
+
+    def _read_output(self, output):
+        output_lines = output.splitlines()
+        if not output_lines:
+            return []
+        pair_count = int(output_lines[0])
+        pairs = []
+        for line in output_lines[1:pair_count + 1]:
+            w, b = line.split()
+            if int(b) == 0:
+                pairs.append([self.players[int(w) - 1].player, None])
+            else:
+                pairs.append([self.players[int(w) - 1].player, self.players[int(b) - 1].player])
+        return pairs
+
+#-------------------------------------------------------------------------------
+# Pairing engines
+#
+# An engine takes a TRFX document and javafo command-line arguments, and returns the
+# contents of the javafo output file (the number of pairs, then one "white black" line per pair).
+
+class JavafoProcessEngine:
+    '''Starts a new javafo process for each request.'''
+
+    def __init__(self, command, timeout=None):
+        self.command = command
+        self.timeout = timeout
+
+    def pair(self, trfx, args=''):
         input_file = tempfile.NamedTemporaryFile(suffix='.trfx', mode='w+')
         output_file_name = input_file.name + ".out.txt"
         try:
-            # Write to input file
-            input_file.write('XXR %d\n' % self.total_round_count)
-            for n, player in enumerate(self.players, 1):
-                line = '001  {0: >3}  {1:74.1f}     '.format(n, player.score)
-                for pairing in player.pairings:
-                    opponent_num = next((num for num, player in enumerate(self.players, 1) if player.player == pairing.opponent), '0000')
-                    color = 'w' if pairing.color == 'white' else 'b' if pairing.color == 'black' else '-'
-                    if pairing.forfeit:
-                        score = '+' if pairing.score == 1 else '-' if pairing.score == 0 else '=' if pairing.score == 0.5 else ' '
-                    else:
-                        score = '1' if pairing.score == 1 else '0' if pairing.score == 0 else '=' if pairing.score == 0.5 else ' '
-                    if score == ' ':
-                        color = '-'
-                    line += '{0: >6} {1} {2}'.format(opponent_num, color, score)
-                if not player.include:
-                    line += '{0: >6} {1} {2}'.format('0000', '-', '-')
-                line += '\n'
-                input_file.write(line)
-            for n, player in enumerate(self.players, 1):
-                if player.acceleration_scores:
-                    line = 'XXA {0: >4} {1}\n'.format(n, ' '.join('{0: >4.1f}'.format(s) for s in player.acceleration_scores))
-                    input_file.write(line)
-                    pass
+            input_file.write(trfx)
             input_file.flush()
-
-            self._call_proc(input_file.name, output_file_name, '-q 10000')
-
-            pairs = self._read_output(output_file_name)
-            if len(pairs) == 0 and len(self.players) > 1:
-                # Took too long before terminating, use the slower but more deterministic algorithm
-                self._call_proc(input_file.name, output_file_name, '-w')
-                pairs = self._read_output(output_file_name)
-
-            return pairs
+            proc = subprocess.Popen('%s %s -p %s %s' % (self.command, input_file.name, output_file_name, args), shell=True, stdout=subprocess.PIPE)
+            try:
+                stdout = proc.communicate(timeout=self.timeout)[0]
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.communicate()
+                raise PairingGenerationException('Javafo timed out after %s seconds' % self.timeout)
+            if proc.returncode != 0:
+                raise PairingGenerationException('Javafo return code: %s. Output: %s' % (proc.returncode, stdout))
+            try:
+                with open(output_file_name) as output_file:
+                    return output_file.read()
+            except FileNotFoundError:
+                raise PairingGenerationException('Javafo did not write an output file. Output: %s' % stdout)
         finally:
             input_file.close()
             try:
@@ -373,20 +492,176 @@ class JavafoInstance:
             except OSError:
                 pass
 
-    def _call_proc(self, input_file_name, output_file_name, args):
-        proc = subprocess.Popen('%s %s -p %s %s' % (settings.JAVAFO_COMMAND, input_file_name, output_file_name, args), shell=True, stdout=subprocess.PIPE)
-        stdout = proc.communicate()[0]
-        if proc.returncode != 0:
-            raise PairingGenerationException('Javafo return code: %s. Output: %s' % (proc.returncode, stdout))
-
-    def _read_output(self, output_file_name):
-        with open(output_file_name) as output_file:
-            pair_count = int(output_file.readline())
-            pairs = []
-            for _ in range(pair_count):
-                w, b = output_file.readline().split(' ')
-                if int(b) == 0:
-                    pairs.append([self.players[int(w) - 1].player, None])
-                else:
-                    pairs.append([self.players[int(w) - 1].player, self.players[int(b) - 1].player])
-            return pairs
+class JavafoDaemonEngine:
+    '''Sends requests to a long-running javafo process (sysadmin/JavafoDaemon.java) so the JVM stays warm.
+
+    Protocol over stdin/stdout:
+    request -- "<length> <javafo args>\\n" followed by <length> bytes of TRFX
+    response -- "OK <length>\\n" or "ERR <length>\\n" followed by <length> bytes of output or error message
+
+    The daemon is (re)started on demand. If a request times out the daemon is killed, since
+    javafo can't be interrupted mid-calculation.
+    '''
+
+    def __init__(self, command, timeout=None):
+        self.command = command
+        self.timeout = timeout
+        self._proc = None
+        self._buffer = b''
+        self._lock = threading.Lock()
+
+    def pair(self, trfx, args=''):
+        payload = trfx.encode('utf-8')
+        with self._lock:
+            try:
+                proc = self._start()
+                proc.stdin.write(('%d %s\n' % (len(payload), args)).encode('utf-8') + payload)
+                proc.stdin.flush()
+                deadline = time.time() + self.timeout if self.timeout is not None else None
+                status, length = self._read_line(deadline).split()
+                body = self._read_bytes(int(length), deadline).decode('utf-8')
+            except (OSError, ValueError) as e:
+                self.stop()
+                raise PairingGenerationException('Javafo daemon error: %s' % e)
+        if status != 'OK':
+            raise PairingGenerationException('Javafo error: %s' % body)
+        if not body.strip():
+            raise PairingGenerationException('Javafo daemon returned no output')
+        return body
+
+    def stop(self):
+        if self._proc is not None:
+            try:
+                self._proc.kill()
+                self._proc.wait()
+            except OSError:
+                pass
+        self._proc = None
+        self._buffer = b''
+
+    def _start(self):
+        if self._proc is None or self._proc.poll() is not None:
+            self._buffer = b''
+            self._proc = subprocess.Popen(shlex.split(self.command), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        return self._proc
+
+    def _read_line(self, deadline):
+        while b'\n' not in self._buffer:
+            self._fill(deadline)
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        return line.decode('utf-8')
+
+    def _read_bytes(self, length, deadline):
+        while len(self._buffer) < length:
+            self._fill(deadline)
+        data, self._buffer = self._buffer[:length], self._buffer[length:]
+        return data
+
+    def _fill(self, deadline):
+        fd = self._proc.stdout.fileno()
+        remaining = max(deadline - time.time(), 0) if deadline is not None else None
+        if not select.select([fd], [], [], remaining)[0]:
+            raise OSError('Timed out after %s seconds' % self.timeout)
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            raise OSError('Daemon exited with code %s' % self._proc.wait())
+        self._buffer += chunk
+
+class StubPairingEngine:
+    '''A pure-Python stand-in for javafo, for tests and development environments without Java.
+
+    Pairs players in order of score (then start number), avoiding rematches where possible.
+    The pairings are valid but don't follow the Dutch system rules.
+    '''
+
+    def pair(self, trfx, args=''):
+        players = []
+        for line in trfx.splitlines():
+            if not line.startswith('001'):
+                continue
+            num = int(line[4:8])
+            score = float(line[10:84])
+            results = [line[i:i + 10] for i in range(89, len(line), 10)]
+            opponents = {int(r[:6]) for r in results}
+            players.append((num, score, results, opponents))
+        if not players:
+            return '0\n'
+        rounds_played = min(len(results) for _, _, results, _ in players)
+        # Players excluded from the current round have an extra "0000 - -" entry
+        remaining = sorted(((-score, num, opponents) for num, score, results, opponents in players if len(results) == rounds_played))
+        pairs = []
+        while len(remaining) > 1:
+            _, num, opponents = remaining.pop(0)
+            index = next((i for i, (_, other, _) in enumerate(remaining) if other not in opponents), 0)
+            _, other, _ = remaining.pop(index)
+            pairs.append((num, other))
+        if remaining:
+            pairs.append((remaining[0][1], 0))
+        return '%d\n%s\n' % (len(pairs), '\n'.join('%d %d' % p for p in pairs))
+
+class NativeDutchEngine:
+    '''Pairs with the pure-Python Dutch system implementation in dutch.py instead of javafo.
+
+    javafo's arguments are ignored; the native engine always returns the best pairing it can find.
+    '''
+
+    def pair(self, trfx, args=''):
+        try:
+            return dutch.pair_trfx(trfx)
+        except dutch.PairingError as e:
+            raise PairingGenerationException(str(e))
+
+def _cached_pair(engine, trfx, args):
+    # The output only depends on the input, so regenerating pairings for an unchanged round (e.g. after a preview)
+    # can reuse the previous result. The cache is shared by all the web and celery processes.
+    timeout = settings.PAIRING_RESULT_CACHE_TIMEOUT
+    if timeout is None:
+        return engine.pair(trfx, args)
+    key = 'pairing_engine_result-%s' % hashlib.sha256(('%s %s\n%s' % (type(engine).__name__, args, trfx)).encode('utf-8')).hexdigest()
+    output = cache.get(key)
+    if output is None:
+        output = engine.pair(trfx, args)
+        if _is_complete_output(trfx, output):
+            cache.set(key, output, timeout)
+    return output
+
+def _is_complete_output(trfx, output):
+    # Whether the output is worth reusing: at least one pair, or no pairs for a field of at most one player.
+    # Anything else (e.g. javafo giving up with "0" under -q) is left for the next run to try again.
+    lines = output.splitlines()
+    try:
+        pair_count = int(lines[0])
+        pairs = [[int(n) for n in line.split()] for line in lines[1:pair_count + 1]]
+    except (IndexError, ValueError):
+        return False
+    if len(pairs) != pair_count or any(len(pair) != 2 for pair in pairs):
+        return False
+    if pair_count == 0:
+        return len([line for line in trfx.splitlines() if line.startswith('001')]) <= 1
+    return True
+
+_pairing_engine = None
+_pairing_engine_lock = threading.Lock()
+
+def get_pairing_engine():
+    '''Returns the engine configured by settings.JAVAFO_ENGINE ('daemon', 'process' or 'stub').
+
+    The daemon engine is shared within the process.
+    '''
+    global _pairing_engine
+    with _pairing_engine_lock:
+        if _pairing_engine is None:
+            if settings.JAVAFO_ENGINE == 'daemon':
+                _pairing_engine = JavafoDaemonEngine(settings.JAVAFO_DAEMON_COMMAND, settings.JAVAFO_TIMEOUT)
+                atexit.register(_pairing_engine.stop)
+            elif settings.JAVAFO_ENGINE == 'stub':
+                _pairing_engine = StubPairingEngine()
+            else:
+                _pairing_engine = JavafoProcessEngine(settings.JAVAFO_COMMAND, settings.JAVAFO_TIMEOUT)
+        return _pairing_engine
+
+def _league_pairing_engine(league):
+    # Leagues with a "-native" pairing type use the built-in engine instead of javafo
+    if league.pairing_type.endswith('-native'):
+        return NativeDutchEngine()
+    return None
@@ -0,0 +1,108 @@
+'''
+Historical ratings of the players in a season.
+
+A SeasonRatingTimeline loads the rated pairings of a season once, so the rating of any player closest to a date can
+be found in memory. Post-game ratings (which need the game from lichess) are remembered in the cache, so each game is
+fetched at most once.
+'''
+
+from bisect import bisect_right
+from collections import defaultdict, namedtuple
+from django.core.cache import cache
+from heltour.tournament import lichessapi
+from heltour.tournament.models import TeamPlayerPairing, LonePlayerPairing, SeasonPlayer, get_gameid_from_gamelink
+
+RatedGame = namedtuple('RatedGame', 'date, pairing_id, rating, game_id, color')
+
+# post_game_ratings-<game id> -> {'white': rating or None, 'black': rating or None}
+_POST_GAME_RATINGS_KEY = 'post_game_ratings-%s'
+
+def remember_post_game_ratings(game_meta):
+    '''Stores the post-game ratings from a game meta (as returned by the lichess API), if the game is over.'''
+    ratings = {}
+    for color in ('white', 'black'):
+        player_meta = game_meta['players'][color]
+        ratings[color] = player_meta['rating'] + player_meta['ratingDiff'] if 'ratingDiff' in player_meta else None
+    if game_meta.get('status') not in ('created', 'started'):
+        cache.set(_POST_GAME_RATINGS_KEY % game_meta['id'], ratings, None)
+    return ratings
+
+def post_game_ratings(game_ids):
+    '''Returns {game id: {'white': rating or None, 'black': rating or None}}, fetching the games that haven't been
+    seen before in bulk. Games lichess doesn't return are left out.'''
+    game_ids = list(set(game_ids))
+    found = cache.get_many([_POST_GAME_RATINGS_KEY % game_id for game_id in game_ids])
+    result = {game_id: found[_POST_GAME_RATINGS_KEY % game_id] for game_id in game_ids
+              if _POST_GAME_RATINGS_KEY % game_id in found}
+    missing = [game_id for game_id in game_ids if game_id not in result]
+    if missing:
+        for game_meta in lichessapi.enumerate_game_metas(missing, priority=0, timeout=300):
+            result[game_meta['id']] = remember_post_game_ratings(game_meta)
+    return result
+
+class SeasonRatingTimeline(object):
+    '''The ratings of the players in a season over time, taken from the season's rated pairings.'''
+
+    def __init__(self, season):
+        self.season = season
+        if season.league.competitor_type == 'team':
+            season_pairings = TeamPlayerPairing.objects.filter(team_pairing__round__season=season)
+            date_field = 'team_pairing__round__end_date'
+        else:
+            season_pairings = LonePlayerPairing.objects.filter(round__season=season)
+            date_field = 'round__end_date'
+        games = defaultdict(list)
+        for pk, white_id, black_id, white_rating, black_rating, game_link, date in season_pairings \
+                .exclude(white_rating=None, black_rating=None) \
+                .values_list('pk', 'white_id', 'black_id', 'white_rating', 'black_rating', 'game_link', date_field).nocache():
+            if date is None:
+                continue
+            game_id = get_gameid_from_gamelink(game_link)
+            if white_id is not None:
+                games[white_id].append(RatedGame(date, pk, white_rating, game_id, 'white'))
+            if black_id is not None:
+                games[black_id].append(RatedGame(date, pk, black_rating, game_id, 'black'))
+        for entries in games.values():
+            entries.sort()
+        self._games = dict(games)
+        self._dates = {player_id: [g.date for g in entries] for player_id, entries in games.items()}
+        self._seed_ratings = dict(SeasonPlayer.objects.filter(season=season).exclude(seed_rating=None)
+                                              .values_list('player_id', 'seed_rating').nocache())
+
+    def closest(self, player_id, date):
+        '''Returns (the player's last game on or before the date, True), or if there isn't one (their first game
+        after it, False). Returns None if the player has no rated games in the season.'''
+        entries = self._games.get(player_id)
+        if not entries:
+            return None
+        index = len(entries) if date is None else bisect_right(self._dates[player_id], date)
+        if index > 0:
+            return entries[index - 1], True
+        return entries[0], False
+
+    def rating(self, player, date, post_game=None):
+        '''The player's rating closest to the date. For a game before the date the rating after it is used, looked up
+        in post_game ({game id: ratings}, see post_game_ratings) or fetched if it isn't given. Returns None if there's
+        no player.'''
+        if player is None:
+            return None
+        found = self.closest(player.pk, date)
+        if found is None:
+            # Try to find the seed rating, defaulting to the current rating
+            rating = self._seed_ratings.get(player.pk)
+            return rating if rating is not None else player.rating_for(self.season.league)
+        game, after_game = found
+        if after_game and game.game_id is not None:
+            if post_game is None:
+                post_game = post_game_ratings([game.game_id])
+            rating = post_game.get(game.game_id, {}).get(game.color)
+            if rating is not None:
+                return rating
+        return game.rating
+
+    def post_game_ids(self, player_id, date):
+        '''The ids of the games whose post-game ratings rating() needs for the player, so they can be fetched in bulk.'''
+        found = self.closest(player_id, date)
+        if found is not None and found[1] and found[0].game_id is not None:
+            return [found[0].game_id]
+        return []
@@ -7,6 +7,8 @@ do_schedule_publish = Signal(providing_args=['round_id', 'eta'])
 do_pairings_published = Signal(providing_args=['round_id'])
 do_validate_registration = Signal(providing_args=['reg_id'])
 do_create_team_channel = Signal(providing_args=['team_ids'])
+do_calculate_scores = Signal(providing_args=['season_id'])
+do_create_teams = Signal(providing_args=['season_id', 'options', 'user_id', 'task_id'])
 
 # Signals that send notifications
 pairing_forfeit_changed = Signal(providing_args=['instance'])
@@ -1,6 +1,8 @@
 from heltour.tournament.models import *
+from heltour.tournament.models import _bulk_update
 from heltour.tournament import lichessapi, slackapi, pairinggen, \
-    alternates_manager, signals, uptime
+    alternates_manager, signals, uptime, teamgen
+from heltour.tournament.ratings import SeasonRatingTimeline, post_game_ratings, remember_post_game_ratings
 from heltour.celery import app
 from celery.utils.log import get_task_logger
 from datetime import datetime
@@ -13,133 +15,143 @@ from django.core.urlresolvers import reverse
 from heltour.tournament.workflows import RoundTransitionWorkflow
 from django.dispatch.dispatcher import receiver
 from django.db.models.signals import post_save
+from django.db.models import Q
 from django.contrib.sites.models import Site
 import time
+import hashlib
+import json
+from collections import defaultdict
+from billiard.pool import Pool as BilliardPool
 
 logger = get_task_logger(__name__)
 
+def _players_due_for_rating_update(now):
+    # Players in a running season are refreshed on every run, everyone else once their profile is stale
+    stale = now - settings.PLAYER_RATING_REFRESH_INTERVAL
+    return Player.objects.filter(Q(seasonplayer__season__is_active=True, seasonplayer__season__is_completed=False)
+                                 | Q(profile_updated=None) | Q(profile_updated__lt=stale)).distinct().nocache()
+
 @app.task(bind=True)
 def update_player_ratings(self):
-    usernames = [p.lichess_username for p in Player.objects.all()]
+    players = list(_players_due_for_rating_update(timezone.now()))
     try:
-        updated = 0
-        for user_meta in lichessapi.enumerate_user_metas(usernames, priority=1):
-            p = Player.objects.get(lichess_username__iexact=user_meta['id'])
-            p.update_profile(user_meta)
-            updated += 1
-        logger.info('Updated ratings for %d/%d players' % (updated, len(usernames)))
+        user_metas = lichessapi.enumerate_user_metas([p.lichess_username for p in players], priority=1)
+        updated, changed = Player.update_profiles(players, user_metas)
+        logger.info('Updated ratings for %d/%d players (%d changed)' % (updated, len(players), changed))
     except Exception as e:
         logger.warning('Error getting ratings: %s' % e)
 
+# The number of games populate_historical_ratings fetches per run (lichess exports up to 300 per request)
+_HISTORICAL_RATINGS_GAMES_PER_RUN = 3000
+_HISTORICAL_RATINGS_CURSOR_KEY = 'populate_historical_ratings_cursor'
+
 @app.task(bind=True)
 def populate_historical_ratings(self):
     pairings_that_should_have_ratings = PlayerPairing.objects.exclude(game_link='', result='').exclude(white=None, black=None).nocache()
     pairings_that_need_ratings = pairings_that_should_have_ratings.filter(white_rating=None) | pairings_that_should_have_ratings.filter(black_rating=None)
 
-    api_poll_count = 0
-
-    for p in pairings_that_need_ratings.exclude(game_link=''):
-        # Poll ratings for the game from the lichess API
-        if p.game_id() is None:
-            continue
-        p.refresh_from_db()
-        game_meta = lichessapi.get_game_meta(p.game_id(), priority=0, timeout=300)
-        p.white_rating = game_meta['players']['white']['rating']
-        p.black_rating = game_meta['players']['black']['rating']
-        p.save(update_fields=['white_rating', 'black_rating'])
-        api_poll_count += 1
-        if api_poll_count >= 100:
-            # Limit the processing per task execution
-            return
-
-    for p in pairings_that_need_ratings.filter(game_link=''):
+    if not _populate_game_ratings(pairings_that_need_ratings.exclude(game_link='')):
+        # Limit the processing per task execution
+        return
+    _populate_closest_ratings(pairings_that_need_ratings.filter(game_link=''))
+
+def _populate_game_ratings(pairings):
+    # Takes the ratings from the games on lichess, resuming after the last pairing processed by the previous run so
+    # games that can't be fetched don't hold up the rest. Returns True once all the pairings have been processed.
+    cursor = cache.get(_HISTORICAL_RATINGS_CURSOR_KEY, 0)
+    pending = list(pairings.filter(pk__gt=cursor).order_by('pk')[:_HISTORICAL_RATINGS_GAMES_PER_RUN])
+    for start in range(0, len(pending), 300):
+        batch = pending[start:start + 300]
+        by_game_id = defaultdict(list)
+        for p in batch:
+            if p.game_id() is not None:
+                by_game_id[p.game_id()].append(p)
+        updated = []
+        for game_meta in lichessapi.enumerate_game_metas(list(by_game_id), priority=0, timeout=300):
+            remember_post_game_ratings(game_meta)
+            for p in by_game_id.get(game_meta['id'], []):
+                p.white_rating = game_meta['players']['white'].get('rating')
+                p.black_rating = game_meta['players']['black'].get('rating')
+                updated.append(p)
+        _bulk_update(PlayerPairing, updated, ['white_rating', 'black_rating'])
+        cache.set(_HISTORICAL_RATINGS_CURSOR_KEY, batch[-1].pk, None)
+    if len(pending) < _HISTORICAL_RATINGS_GAMES_PER_RUN:
+        # Start the next pass from the beginning
+        cache.delete(_HISTORICAL_RATINGS_CURSOR_KEY)
+        return True
+    return False
+
+def _populate_closest_ratings(pairings):
+    # Fills in the ratings of rows without a game of their own from the player's games in the same season
+    lookups = [] # (row, field, player, season, date)
+    player_pairings = []
+    pairings = pairings.select_related('white', 'black', 'teamplayerpairing__team_pairing__round__season__league',
+                                       'loneplayerpairing__round__season__league')
+    for p in pairings:
         round_ = p.get_round()
         if round_ is None:
             continue
-        season = round_.season
-        league = season.league
-        p.refresh_from_db()
-        if not round_.is_completed:
-            p.white_rating = p.white.rating_for(league)
-            p.black_rating = p.black.rating_for(league)
-        else:
-            # Look for ratings from a close time period
-            p.white_rating = _find_closest_rating(p.white, round_.end_date, season)
-            p.black_rating = _find_closest_rating(p.black, round_.end_date, season)
-        p.save(update_fields=['white_rating', 'black_rating'])
-
-    for b in PlayerBye.objects.filter(player_rating=None, round__publish_pairings=True).nocache():
-        b.refresh_from_db()
+        for field, player in (('white_rating', p.white), ('black_rating', p.black)):
+            if player is None:
+                # A forfeit with an empty slot has no rating on that side
+                continue
+            if not round_.is_completed:
+                setattr(p, field, player.rating_for(round_.season.league))
+            else:
+                # Look for ratings from a close time period
+                lookups.append((p, field, player, round_.season, round_.end_date))
+        player_pairings.append(p)
+
+    byes = []
+    for b in PlayerBye.objects.filter(player_rating=None, round__publish_pairings=True) \
+                              .select_related('player', 'round__season__league').nocache():
         if not b.round.is_completed:
             b.player_rating = b.player.rating_for(b.round.season.league)
         else:
-            b.player_rating = _find_closest_rating(b.player, b.round.end_date, b.round.season)
-        b.save(update_fields=['player_rating'])
-
-    for tm in TeamMember.objects.filter(player_rating=None, team__season__is_completed=True).nocache():
-        tm.refresh_from_db()
-        tm.player_rating = _find_closest_rating(tm.player, tm.team.season.end_date(), tm.team.season)
-        tm.save(update_fields=['player_rating'])
-
-    for alt in Alternate.objects.filter(player_rating=None, season_player__season__is_completed=True).nocache():
-        alt.refresh_from_db()
-        alt.player_rating = _find_closest_rating(alt.season_player.player, alt.season_player.season.end_date(), alt.season_player.season)
-        alt.save(update_fields=['player_rating'])
-
-    for sp in SeasonPlayer.objects.filter(final_rating=None, season__is_completed=True).nocache():
-        sp.refresh_from_db()
-        sp.final_rating = _find_closest_rating(sp.player, sp.season.end_date(), sp.season)
-        sp.save(update_fields=['final_rating'])
-
-def _find_closest_rating(player, date, season):
-    if player is None:
-        return None
-    if season.league.competitor_type == 'team':
-        season_pairings = TeamPlayerPairing.objects.filter(team_pairing__round__season=season).exclude(white_rating=None, black_rating=None).nocache()
-    else:
-        season_pairings = LonePlayerPairing.objects.filter(round__season=season).exclude(white_rating=None, black_rating=None).nocache()
-    pairings = season_pairings.filter(white=player) | season_pairings.filter(black=player)
-
-    def pairing_date(p):
-        if season.league.competitor_type == 'team':
-            return p.team_pairing.round.end_date
-        else:
-            return p.round.end_date
-
-    def rating(p):
-        if p.white == player:
-            return p.white_rating
-        else:
-            return p.black_rating
-
-    pairings_by_date = sorted([(pairing_date(p), p) for p in pairings])
-    if len(pairings_by_date) == 0:
-        # Try to find the seed rating
-        sp = SeasonPlayer.objects.filter(season=season, player=player).first()
-        if sp is not None and sp.seed_rating is not None:
-            return sp.seed_rating
-        # Default to current rating
-        return player.rating_for(season.league)
-    pairings_by_date_lt = [p for p in pairings_by_date if p[0] <= date]
-    pairings_by_date_gt = [p for p in pairings_by_date if p[0] > date]
-    if len(pairings_by_date_lt) > 0:
-        # Get the rating AFTER the game
-        p = pairings_by_date_lt[-1][1]
-        if p.game_id() is not None:
-            game_meta = lichessapi.get_game_meta(p.game_id(), priority=0, timeout=300)
-            player_meta = game_meta['players']['white'] if p.white == player else game_meta['players']['black']
-            if 'ratingDiff' in player_meta:
-                return player_meta['rating'] + player_meta['ratingDiff']
-        return rating(p)
-    else:
-        return rating(pairings_by_date_gt[0][1])
+            lookups.append((b, 'player_rating', b.player, b.round.season, b.round.end_date))
+        byes.append(b)
+
+    end_dates = {}
+    def end_date(season):
+        if season.pk not in end_dates:
+            end_dates[season.pk] = season.end_date()
+        return end_dates[season.pk]
+
+    team_members = list(TeamMember.objects.filter(player_rating=None, team__season__is_completed=True)
+                                          .select_related('player', 'team__season__league').nocache())
+    for tm in team_members:
+        lookups.append((tm, 'player_rating', tm.player, tm.team.season, end_date(tm.team.season)))
+    alternates = list(Alternate.objects.filter(player_rating=None, season_player__season__is_completed=True)
+                                       .select_related('season_player__player', 'season_player__season__league').nocache())
+    for alt in alternates:
+        sp = alt.season_player
+        lookups.append((alt, 'player_rating', sp.player, sp.season, end_date(sp.season)))
+    season_players = list(SeasonPlayer.objects.filter(final_rating=None, season__is_completed=True)
+                                              .select_related('player', 'season__league').nocache())
+    for sp in season_players:
+        lookups.append((sp, 'final_rating', sp.player, sp.season, end_date(sp.season)))
+
+    # Each season's rated games are loaded once, and the games whose post-game ratings are needed fetched in bulk
+    timelines = {}
+    for row, field, player, season, date in lookups:
+        if season.pk not in timelines:
+            timelines[season.pk] = SeasonRatingTimeline(season)
+    post_game = post_game_ratings([game_id for row, field, player, season, date in lookups
+                                   for game_id in timelines[season.pk].post_game_ids(player.pk, date)])
+    for row, field, player, season, date in lookups:
+        setattr(row, field, timelines[season.pk].rating(player, date, post_game))
+
+    _bulk_update(PlayerPairing, player_pairings, ['white_rating', 'black_rating'])
+    _bulk_update(PlayerBye, byes, ['player_rating'])
+    _bulk_update(TeamMember, team_members, ['player_rating'])
+    _bulk_update(Alternate, alternates, ['player_rating'])
+    _bulk_update(SeasonPlayer, season_players, ['final_rating'])
 
 @app.task(bind=True)
-def update_tv_state(self):
+def find_started_games(self):
     games_starting = PlayerPairing.objects.filter(result='', game_link='', scheduled_time__lt=timezone.now()).nocache()
     games_starting = games_starting.filter(loneplayerpairing__round__end_date__gt=timezone.now()) | \
                      games_starting.filter(teamplayerpairing__team_pairing__round__end_date__gt=timezone.now())
-    games_in_progress = PlayerPairing.objects.filter(result='', tv_state='default').exclude(game_link='').nocache()
 
     for game in games_starting:
         try:
@@ -158,23 +170,54 @@ def update_tv_state(self):
         except Exception as e:
             logger.warning('Error updating tv state for %s: %s' % (game, e))
 
-    for game in games_in_progress:
-        gameid = get_gameid_from_gamelink(game.game_link)
-        if gameid is not None:
-            try:
-                meta = lichessapi.get_game_meta(gameid, priority=1, timeout=300)
-                if 'status' not in meta or meta['status'] != 'started':
-                    game.tv_state = 'hide'
-                if 'status' in meta and meta['status'] == 'draw':
-                    game.result = '1/2-1/2'
-                elif 'winner' in meta and meta['status'] != 'timeout': # timeout = claim victory (which isn't allowed)
-                    if meta['winner'] == 'white':
-                        game.result = '1-0'
-                    elif meta['winner'] == 'black':
-                        game.result = '0-1'
-                game.save()
-            except Exception as e:
-                logger.warning('Error updating tv state for %s: %s' % (game.game_link, e))
+@app.task(bind=True)
+def update_tv_state(self, poll_all=False):
+    # Games normally get their results within seconds of finishing from the API worker's game streams (see
+    # game_finished). The streams only live as long as the API worker process that opened them, so every game in
+    # progress is watched again here; the games it can't stream are polled straight away, and all the games are
+    # polled if poll_all is set, as a safety net for anything the streams missed.
+    games_in_progress = PlayerPairing.objects.filter(result='', tv_state='default').exclude(game_link='').nocache()
+    games_in_progress = [(game, get_gameid_from_gamelink(game.game_link)) for game in games_in_progress]
+    games_in_progress = [(game, gameid) for game, gameid in games_in_progress if gameid is not None]
+    if not games_in_progress:
+        return
+    unstreamed = set(lichessapi.add_watches(sorted({gameid for _, gameid in games_in_progress})))
+    if not poll_all:
+        games_in_progress = [(game, gameid) for game, gameid in games_in_progress if gameid in unstreamed]
+
+    # Fetch the games concurrently rather than waiting for each result in turn
+    metas = lichessapi.run_async(*[lichessapi.get_game_meta_async(gameid, priority=1, timeout=300)
+                                   for _, gameid in games_in_progress])
+    for (game, _), meta in zip(games_in_progress, metas):
+        try:
+            if isinstance(meta, Exception):
+                raise meta
+            _update_game_state(game, meta)
+        except Exception as e:
+            logger.warning('Error updating tv state for %s: %s' % (game.game_link, e))
+
+@app.task(bind=True)
+def game_finished(self, game_id):
+    # Sent by the API worker when a watched game's stream on lichess ends
+    games = list(PlayerPairing.objects.filter(game_link=get_gamelink_from_gameid(game_id), result='', tv_state='default').nocache())
+    if not games:
+        return
+    meta = lichessapi.get_game_meta(game_id, priority=2, timeout=60)
+    for game in games:
+        # If the stream was cut off before the end of the game, saving it watches the game again (see pairing_changed)
+        _update_game_state(game, meta)
+
+def _update_game_state(game, meta):
+    if 'status' not in meta or meta['status'] != 'started':
+        game.tv_state = 'hide'
+    if 'status' in meta and meta['status'] == 'draw':
+        game.result = '1/2-1/2'
+    elif 'winner' in meta and meta['status'] != 'timeout': # timeout = claim victory (which isn't allowed)
+        if meta['winner'] == 'white':
+            game.result = '1-0'
+        elif meta['winner'] == 'black':
+            game.result = '0-1'
+    game.save()
 
 @app.task(bind=True)
 def update_lichess_presence(self):
@@ -307,6 +350,124 @@ def generate_pairings(self, round_id, overwrite=False):
 def do_generate_pairings(sender, round_id, overwrite=False, **kwargs):
     generate_pairings.apply_async(args=[round_id, overwrite], countdown=1)
 
+@app.task(bind=True)
+def recalculate_scores(self, season_id):
+    cache.delete('season_scores_scheduled-%d' % season_id)
+    Season.objects.get(pk=season_id).flush_scores()
+
+@receiver(signals.do_calculate_scores, dispatch_uid='heltour.tournament.tasks')
+def do_calculate_scores(sender, season_id, **kwargs):
+    # Only schedule one task per season at a time; it picks up any changes queued before it runs
+    delay = settings.SCORE_RECALCULATION_DELAY
+    if cache.add('season_scores_scheduled-%d' % season_id, True, delay + 60):
+        recalculate_scores.apply_async(args=[season_id], countdown=delay)
+
+@app.task(bind=True)
+def create_teams(self, season_id, options, user_id=None):
+    # Runs the team creation algorithm for the season and replaces its teams and alternates with the result.
+    # The best league found so far is published with Season.set_create_teams_progress for the admin page to poll.
+    # options: the cleaned data of CreateTeamsForm
+    season = Season.objects.get(pk=season_id)
+    task_id = self.request.id
+    latest = season.create_teams_progress()
+    if task_id is not None and latest is not None and latest.get('task_id') not in (None, task_id):
+        # A newer run was started from the admin after this one went stale
+        logger.warning('[create_teams] Skipping superseded job %s for season %d' % (task_id, season_id))
+        return
+
+    def set_progress(status, **details):
+        season.set_create_teams_progress(status, task_id=task_id, **details)
+
+    player_data = [p for p in season.export_players() if p['date_created']]
+    ratings = {p['name']: p['rating'] for p in player_data}
+
+    def with_ratings(lineup):
+        return [[(name, ratings[name]) for name in team] for team in lineup]
+
+    def search_progress(progress):
+        set_progress('running',
+                     detail='%d/%d leagues searched' % (progress.leagues, progress.count),
+                     happiness=progress.best_happiness,
+                     rating_range=progress.best_rating_range,
+                     lineup=with_ratings(progress.best_lineup))
+
+    def anneal_progress(progress):
+        set_progress('running',
+                     detail='%d/%ds, %d swaps tried' % (progress.elapsed, options['time_limit'], progress.iterations),
+                     happiness=progress.best_happiness,
+                     rating_range=progress.best_rating_range,
+                     lineup=with_ratings(progress.best_lineup))
+
+    # Only seeded runs are reproducible, so a run without a seed always searches for a new league
+    if options['seed'] is not None:
+        key_input = json.dumps([player_data, season.boards, options], sort_keys=True)
+        key = 'create_teams_result-%s' % hashlib.sha256(key_input.encode('utf-8')).hexdigest()
+    else:
+        key = None
+    try:
+        result = cache.get(key) if key is not None else None
+        cached = result is not None
+        if not cached:
+            set_progress('running', detail='Starting')
+            if options['optimizer'] == 'anneal':
+                league = teamgen.get_annealed_league(player_data, season.boards, options['balance'],
+                                                     options['time_limit'], options['seed'],
+                                                     progress=anneal_progress)
+            else:
+                # Celery workers are daemonic, so the search uses billiard's pool rather than multiprocessing's
+                with teamgen.LeagueSearch(player_data, season.boards, options['balance'],
+                                          pool_class=BilliardPool) as search:
+                    league = search.best_league(options['count'], options['seed'], options['max_happy_leagues'],
+                                                progress=search_progress)
+            result = {
+                'teams': teamgen.league_lineup(league['teams']),
+                'alternates': [[player.name for player in board] for board in league['alts_split']],
+                'happiness': teamgen.total_happiness(league['teams']),
+                'rating_range': teamgen.team_rating_range(league['teams']),
+            }
+            if key is not None:
+                cache.set(key, result, settings.CREATE_TEAMS_RESULT_CACHE_TIMEOUT)
+
+        user = User.objects.get(pk=user_id) if user_id is not None else None
+        _save_teams(season, result, user)
+    except Exception as e:
+        set_progress('error', detail=str(e))
+        raise
+    set_progress('done',
+                 detail='Teams created from a previous result' if cached else 'Teams created',
+                 happiness=result['happiness'],
+                 rating_range=result['rating_range'],
+                 lineup=with_ratings(result['teams']))
+
+def _save_teams(season, result, user):
+    with reversion.create_revision():
+        reversion.set_user(user)
+        reversion.set_comment('Create teams')
+
+        Team.objects.filter(season=season).delete()
+        for team_number, team in enumerate(result['teams'], 1):
+            team_instance = Team.objects.create(season=season,
+                                                number=team_number,
+                                                name=f'Team {team_number}')
+            for board_number, name in enumerate(team, 1):
+                player = Player.objects.get(lichess_username=name)
+                TeamMember.objects.create(team=team_instance,
+                                          player=player,
+                                          board_number=board_number)
+
+        Alternate.objects.filter(season_player__season=season).delete()
+        for board_number, board in enumerate(result['alternates'], 1):
+            for name in board:
+                season_player = (SeasonPlayer.objects
+                                 .get(season=season,
+                                      player__lichess_username__iexact=name))
+                Alternate.objects.create(season_player=season_player,
+                                         board_number=board_number)
+
+@receiver(signals.do_create_teams, dispatch_uid='heltour.tournament.tasks')
+def do_create_teams(sender, season_id, options, user_id=None, task_id=None, **kwargs):
+    create_teams.apply_async(args=[season_id, options, user_id], task_id=task_id)
+
 @app.task(bind=True)
 def validate_registration(self, reg_id):
     reg = Registration.objects.get(pk=reg_id)
@@ -1,20 +1,37 @@
 import random
 import re
 import math
-from heltour.tournament.team_rating_utils import variance, \
+import time
+from collections import namedtuple
+from heltour.tournament.team_rating_utils import \
         team_rating_variance, team_rating_range
 
-from itertools import combinations
-from functools import partial
 from multiprocessing import Pool
+import numpy as np
 
 from django.conf import settings
 
+# Usernames are made of these characters; anything else in a friend/avoid request is a separator
+_username_token = re.compile(r'[-_a-zA-Z0-9]+')
+
+def username_tokens(text):
+    #lowercased candidate usernames in a free text friend/avoid request
+    if not text:
+        return []
+    return [token.lower() for token in _username_token.findall(text)]
+
+def resolve_names(text, ids_by_username):
+    #ids of the players named in text, in order of first mention
+    ids = []
+    for token in username_tokens(text):
+        player_id = ids_by_username.get(token)
+        if player_id is not None and player_id not in ids:
+            ids.append(player_id)
+    return ids
+
 class Player:
-    pref_score = 0
-    team = None
-    board = None
-    req_met = False
+    __slots__ = ('name', 'rating', 'friends', 'avoid', 'date', 'alt', 'previous_season_alt',
+                 'pref_score', 'team', 'board', 'req_met', 'id', 'player_id')
     def __init__(self, name, rating, friends, avoid, date, alt, previous_season_alt):
         self.name = name
         self.rating = rating
@@ -23,45 +40,63 @@ class Player:
         self.date = date
         self.alt = alt
         self.previous_season_alt = previous_season_alt
+        self.pref_score = 0
+        self.team = None
+        self.board = None
+        self.req_met = False
+        self.id = None #index in LeagueArrays.players
+        self.player_id = None #id from Season.export_players, if any
 
     @classmethod
     def player_from_json(cls, player):
-        return cls(
+        # friends/avoid are lists of player ids if they were resolved by Season.export_players,
+        # otherwise free text
+        p = cls(
             player['name'],
             player['rating'],
-            player['friends'],
-            player['avoid'],
+            player.get('friend_ids', player['friends']),
+            player.get('avoid_ids', player['avoid']),
             player['date_created'],
             player['prefers_alt'],
             player.get('previous_season_alternate', False)
         )
+        p.player_id = player.get('id')
+        return p
 
     def __repr__(self):
         return str((self.name, self.board, self.rating, self.req_met))
     def __lt__(self, other):
         return True
-    def set_pref_score(self):
-        self.pref_score = 0
+    def set_pref_score(self, team_members=None):
+        self.pref_score = self.pref_score_with(team_members if team_members is not None else self.team.get_members())
+    def pref_score_with(self, team_members):
+        #preference score if this player's team consisted of team_members (a set of players)
+        pref_score = 0
         for friend in self.friends:
-            if friend in self.team.get_boards():
-                self.pref_score += 1
+            if friend in team_members:
+                pref_score += 1
             else:
-                self.pref_score -= 1
+                pref_score -= 1
         for avoid in self.avoid:
-            if avoid in self.team.get_boards():
-                self.pref_score -= 1
+            if avoid in team_members:
+                pref_score -= 1
+        return pref_score
         #player with more than 5 choices can be <5 preference even if all teammates are preferred
     def set_req_met(self):
         self.req_met = False
         if not self.friends:
             self.req_met = None
+        team_members = self.team.get_members()
         for friend in self.friends:
-            if friend in self.team.get_boards():
+            if friend in team_members:
                 self.req_met = True
 
 class Team:
+    __slots__ = ('boards', 'team_pref_score', 'id')
     def __init__(self, boards):
         self.boards = [None for x in range(boards)]
+        self.team_pref_score = 0
+        self.id = None #index in LeagueArrays.teams
     def __str__(self):
         return str((self.boards, self.team_pref_score, self.get_mean()))
     def __repr__(self):
@@ -84,6 +119,8 @@ class Team:
         return mean
     def get_boards(self):
         return self.boards
+    def get_members(self):
+        return set(self.boards)
     def get_player(self, board):
         return self.boards[board]
     def set_team_pref_score(self):
@@ -95,6 +132,103 @@ def update_pref(players, teams): #update preference scores
     for team in teams:
         team.set_team_pref_score()
 
+def _bitset(ids):
+    bits = 0
+    for i in ids:
+        bits |= 1 << i
+    return bits
+
+def _popcount(bits):
+    return bin(bits).count('1')
+
+class LeagueArrays:
+    #compact representation of a league used by the swap searches in make_league and reduce_variance
+    #players and teams are referred to by their index (Player.id and Team.id); the Player and Team objects
+    #are kept in sync when swaps are made
+    def __init__(self, teams):
+        self.teams = list(teams)
+        self.players = [player for team in teams for player in team.boards]
+        for n, team in enumerate(teams):
+            team.id = n
+        ids = {}
+        for n, player in enumerate(self.players):
+            player.id = n
+            ids[player] = n
+        self.n_boards = len(teams[0].boards)
+
+        self.ratings = np.array([player.rating for player in self.players], dtype=float)
+        self.lineup = np.array([[player.id for player in team.boards] for team in teams]) #team x board -> player
+        self.team_of = np.empty(len(self.players), dtype=int)
+        self.team_of[self.lineup] = np.arange(len(teams))[:, None]
+        self.team_sums = self.ratings[self.lineup].sum(axis=1)
+
+        #friend/avoid relations as bitsets (bit n = player n) for the preference scores
+        self.friend_bits = [_bitset(ids[f] for f in player.friends if f in ids) for player in self.players]
+        self.avoid_bits = [_bitset(ids[a] for a in player.avoid if a in ids) for player in self.players]
+        self.friend_counts = [len(player.friends) for player in self.players]
+        self.members = [[player.id for player in team.boards] for team in teams]
+        self.team_bits = [_bitset(members) for members in self.members]
+
+    def pref_score(self, player_id, team_bits):
+        #preference score if the player's team consisted of the players in team_bits
+        return 2 * _popcount(self.friend_bits[player_id] & team_bits) - self.friend_counts[player_id] \
+               - _popcount(self.avoid_bits[player_id] & team_bits)
+
+    def update_pref(self, *team_ids):
+        #update the preference scores of the Player and Team objects (for all teams if none are given)
+        for t in team_ids or range(len(self.teams)):
+            team_pref_score = 0
+            for player_id in self.members[t]:
+                pref_score = self.pref_score(player_id, self.team_bits[t])
+                self.players[player_id].pref_score = pref_score
+                team_pref_score += pref_score
+            self.teams[t].team_pref_score = team_pref_score
+
+    def swap_pref_change(self, player_a, player_b):
+        #the change in preference score if the two players (on the same board) were swapped
+        #only the players on the two teams are affected, so the other teams don't need to be considered
+        team_a, team_b = self.team_of[player_a], self.team_of[player_b]
+        if team_a == team_b:
+            return 0
+        swap_bits = (1 << player_a) | (1 << player_b)
+        bits_a = self.team_bits[team_a] ^ swap_bits
+        bits_b = self.team_bits[team_b] ^ swap_bits
+        post_pref = sum(self.pref_score(p, bits_a) for p in self.members[team_a] if p != player_a) + self.pref_score(player_b, bits_a) \
+                    + sum(self.pref_score(p, bits_b) for p in self.members[team_b] if p != player_b) + self.pref_score(player_a, bits_b)
+        return post_pref - (self.teams[team_a].team_pref_score + self.teams[team_b].team_pref_score)
+
+    def swap(self, player_a, player_b):
+        #swap two players on the same board between their teams
+        team_a, team_b = self.team_of[player_a], self.team_of[player_b]
+        board = self.players[player_a].board
+        swap_bits = (1 << player_a) | (1 << player_b)
+        self.lineup[team_a, board] = player_b
+        self.lineup[team_b, board] = player_a
+        self.team_of[player_a], self.team_of[player_b] = team_b, team_a
+        rating_diff = self.ratings[player_b] - self.ratings[player_a]
+        self.team_sums[team_a] += rating_diff
+        self.team_sums[team_b] -= rating_diff
+        self.team_bits[team_a] ^= swap_bits
+        self.team_bits[team_b] ^= swap_bits
+        self.members[team_a][board] = player_b
+        self.members[team_b][board] = player_a
+        self.teams[team_a].changeBoard(board, self.players[player_b])
+        self.teams[team_b].changeBoard(board, self.players[player_a])
+        self.update_pref(team_a, team_b)
+
+    def relation_matrix(self):
+        #relation[x, y] = (y is x's friend) + (x is y's friend) - (x avoids y) - (y avoids x)
+        n = len(self.players)
+        friends = np.zeros((n, n), dtype=int)
+        avoid = np.zeros((n, n), dtype=int)
+        for player_id in range(n):
+            friends[player_id, _bit_indices(self.friend_bits[player_id])] = 1
+            avoid[player_id, _bit_indices(self.avoid_bits[player_id])] = 1
+        return friends + friends.T - avoid - avoid.T
+
+def _bit_indices(bits):
+    return [i for i, bit in enumerate(reversed(bin(bits)[2:])) if bit == '1']
+
 def update_sort(players, teams): #based on preference score high to low
     players.sort(key=lambda player: (player.team.team_pref_score, player.pref_score), reverse = False)
     teams.sort(key=lambda team: team.team_pref_score, reverse = False)
@@ -126,7 +260,7 @@ def flatten(lst):
     return [item for sub_lst in lst for item in sub_lst]
 
 
-def make_league(playerdata, boards, balance):
+def make_league(playerdata, boards, balance, rng=random):
 
     players = []
     for player in playerdata:
@@ -168,19 +302,25 @@ def make_league(playerdata, boards, balance):
         for player in board:
             player.board = n
 
-    def convert_name_list(string_of_names, players):
-        pattern = r"([^-_a-zA-Z0-9]|^){0}([^-_a-zA-Z0-9]|$)"
-        return [player for player in players
-                if re.search(pattern.format(player.name), string_of_names, flags=re.I)]
+    order = {player: n for n, player in enumerate(players)}
+    players_by_name = {player.name.lower(): player for player in players}
+    players_by_id = {player.player_id: player for player in players if player.player_id is not None}
+
+    def convert_request(request, player):
+        if request is None or isinstance(request, str):
+            named = (players_by_name.get(token) for token in username_tokens(request))
+        else:
+            named = (players_by_id.get(player_id) for player_id in request)
+        matched = {p for p in named if p is not None and p.board != player.board}
+        return sorted(matched, key=order.get)
 
     for player in players:
-        filtered_players = [p for p in players if p.board != player.board]
-        player.friends = convert_name_list(player.friends, filtered_players)
-        player.avoid = convert_name_list(player.avoid, filtered_players)
+        player.friends = convert_request(player.friends, player)
+        player.avoid = convert_request(player.avoid, player)
 
     # randomly shuffle players
     for board in players_split:
-        random.shuffle(board)
+        rng.shuffle(board)
 
     teams = []
     for n in range(num_teams):
@@ -189,23 +329,17 @@ def make_league(playerdata, boards, balance):
         for team, player in enumerate(board):
             teams[team].changeBoard(n, player)
 
-    update_pref(players, teams)
+    league_arrays = LeagueArrays(teams)
+    league_arrays.update_pref()
     update_sort(players, teams)
 
     def swapPlayers(teama, playera, teamb, playerb, board):
         #swap players between teams - ensure players are same board for input
-        teama.changeBoard(board,playerb)
-        teamb.changeBoard(board,playera)
+        league_arrays.swap(playera.id, playerb.id)
 
     def testSwap(teama, playera, teamb, playerb, board):
-        #try a swap and return the preference change if this swap was made
-        prior_pref = teama.team_pref_score + teamb.team_pref_score
-        swapPlayers(teama, playera, teamb, playerb, board) #swap players forwards
-        update_pref(players, teams)
-        post_pref = teama.team_pref_score + teamb.team_pref_score
-        swapPlayers(teama, playerb, teamb, playera, board) #swap players back
-        update_pref(players, teams)
-        return post_pref - prior_pref #more positive = better swap
+        #return the preference change if this swap was made
+        return league_arrays.swap_pref_change(playera.id, playerb.id) #more positive = better swap
 
     # take player from least happy team
     # calculate the overall preference score if player were to swap to each of the preferences' teams or preference swaps into their team.
@@ -242,7 +376,6 @@ def make_league(playerdata, boards, balance):
         if swaps and swaps[-1][0] > 0: # there is a swap to make and it improves the preference score
             swapPlayers(*(swaps[-1][1]))
             # print(swaps[-1])
-            update_pref(players, teams)
             update_sort(players, teams)
             p = 0
         else: # go to the next player in the list
@@ -261,148 +394,253 @@ def make_league(playerdata, boards, balance):
 
 # Reduce variance functions
 
-def intersection(lst1, lst2):
-    return set(lst1).intersection(set(lst2))
-
-
-# Does this swap have a neutral effect on happiness
-def is_neutral_swap(swap):
-    def count_on_team(attr, player, team):
-        n = len(intersection(getattr(player, attr), team.boards))
-        n += len([p for p in team.boards if player in getattr(p, attr)])
-        return n
-
-    count_friends_on_team = partial(count_on_team, 'friends')
-    count_avoids_on_team = partial(count_on_team, 'avoid')
-
-    pa, pb = swap
-    pre_swap_score = count_friends_on_team(pa, pa.team) \
-                     + count_friends_on_team(pb, pb.team) \
-                     - count_avoids_on_team(pa, pa.team) \
-                     - count_avoids_on_team(pb, pb.team)
-
-    post_swap_score = count_friends_on_team(pa, pb.team) \
-                     + count_friends_on_team(pb, pa.team) \
-                     - count_avoids_on_team(pa, pb.team) \
-                     - count_avoids_on_team(pb, pa.team)
-
-    if pre_swap_score != post_swap_score:
-        return False
-    return True
-
-
-def get_swaps(teams):
-    num_boards = len(teams[0].boards)
-    boards = [[team.boards[i] for team in teams] for i in range(num_boards)]
-    swaps = [[swap for swap in combinations(board, 2) if is_neutral_swap(swap)] for board in boards]
-    return flatten(swaps)
-
-
-def rating_variance_improvement(league_mean, n_boards, swap):
-    def score(a, b):
-        return variance(league_mean, [a, b])
-
-    pa, pb = swap
-    a_mean = pa.team.get_mean()
-    b_mean = pb.team.get_mean()
-    initial_score = score(a_mean, b_mean)
-
-    # calculating change in mean if we swapped the players.
-    rating_diff = pb.rating - pa.rating
-    a_mean = a_mean + rating_diff/n_boards
-    b_mean = b_mean - rating_diff/n_boards
-    new_score = score(a_mean, b_mean)
-
-    # lower is better
-    return new_score - initial_score
-
-
-def get_best_swap(swaps, fun):
-    best_swap = min(swaps, key=fun)
-    return best_swap, fun(best_swap)
-
-
-def perform_swap(swap):
-    pa, pb = swap
-    ta = pa.team
-    tb = pb.team
-    board = pa.board
-    ta.changeBoard(board, pb)
-    tb.changeBoard(board, pa)
-
-
-def update_swaps(swaps, swap_performed, teams):
-    pa, pb = swap_performed
-    affected_players = pa.team.boards + pb.team.boards
-    # remove all swaps involving players affected by the swap.
-    swaps = [swap for swap in swaps
-             if not intersection(swap, affected_players)]
-
-    # find new neutral swaps involving the players affected by swap.
-    for player in affected_players:
-        board = player.board
-        players_on_board = [team.boards[board] for team in teams
-                            if not team.boards[board] in affected_players]
-        swaps.extend([(player, p) for p in players_on_board
-                      if is_neutral_swap((player, p))])
-
-    swaps.extend([swap for swap in zip(pa.team.boards, pb.team.boards)
-                  if is_neutral_swap(swap)])
-
-    return swaps
-
-
 def reduce_variance(teams):
-    # players = flatten([team.boards for team in teams])
+    # Repeatedly make the swap (between two players on the same board) that reduces the variance of the team
+    # rating means the most, only considering swaps that have a neutral effect on happiness
+    league_arrays = LeagueArrays(teams)
+    n_teams = len(teams)
+    n_boards = league_arrays.n_boards
+    ratings = league_arrays.ratings
+    lineup = league_arrays.lineup
+
+    league_mean = league_arrays.team_sums.sum() / n_boards / n_teams
+    relation = league_arrays.relation_matrix()
+    # team_relation[x, t] = the sum of relation[x, y] for all players y on team t
+    team_relation = np.zeros((len(league_arrays.players), n_teams), dtype=int)
+    for t in range(n_teams):
+        team_relation[:, t] = relation[:, lineup[t]].sum(axis=1)
+    upper = np.triu(np.ones((n_teams, n_teams), dtype=bool), 1)[None, :, :]
 
-    league_mean = sum([team.get_mean() for team in teams]) / len(teams)
-    n_boards = len(teams[0].boards)
-
-    swaps = get_swaps(teams)
-
-    eval_fun = partial(rating_variance_improvement, league_mean, n_boards)
-    best_swap, swap_value = get_best_swap(swaps, eval_fun)
-
-    # infinite loop possibility here?
     i = 0
     max_iterations = 200
     epsilon = 0.0000001
-    while swap_value <= -epsilon and i < max_iterations:
-        # variance = team_rating_variance(teams, league_mean)
-        # update_pref(players, teams)
-        # score = total_happiness(teams)
-        # print()
-        # print("i: ", i)
-        # print("variance: ", variance)
-        # print("score: ", score)
-        # print("swap_value: ", swap_value)
-        # print("best_swap: ", best_swap)
+    while i < max_iterations:
+        # Candidate swaps as (board, team a, team b) arrays
+        players = lineup.T # board x team
+        relation_by_team = team_relation[players] # board x team x team
+        own_team = np.diagonal(relation_by_team, axis1=1, axis2=2) # board x team
+        neutral = own_team[:, :, None] + own_team[:, None, :] == relation_by_team + relation_by_team.transpose(0, 2, 1)
+
+        means = league_arrays.team_sums / n_boards - league_mean
+        rating_diff = (ratings[players][:, None, :] - ratings[players][:, :, None]) / n_boards
+        mean_a = means[None, :, None]
+        mean_b = means[None, None, :]
+        improvement = ((mean_a + rating_diff) ** 2 + (mean_b - rating_diff) ** 2 - mean_a ** 2 - mean_b ** 2) / 2
+        improvement[~(neutral & upper)] = np.inf
+
+        board, team_a, team_b = np.unravel_index(np.argmin(improvement), improvement.shape)
+        if not improvement[board, team_a, team_b] <= -epsilon:
+            break
+        player_a, player_b = int(lineup[team_a, board]), int(lineup[team_b, board])
+        league_arrays.swap(player_a, player_b)
+        team_relation[:, team_a] += relation[:, player_b] - relation[:, player_a]
+        team_relation[:, team_b] += relation[:, player_a] - relation[:, player_b]
         i += 1
-        perform_swap(best_swap)
-        swaps = update_swaps(swaps, best_swap, teams)
-        best_swap, swap_value = get_best_swap(swaps, eval_fun)
 
-    # means = [team.get_mean() for team in teams]
-    # print("means: ", sorted(means))
     return teams
 
-def make_league_map(args):
-    return make_league(*args)
-
-def reduce_variance_map(league):
-    league['teams'] = reduce_variance(league['teams'])
+# Annealing optimizer
+#
+# Starting from a league built by make_league and reduce_variance, random swaps between two players on the same
+# board are accepted or rejected by simulated annealing on a combined objective (lower is better):
+#   -happiness + range_weight * rating range + spread_weight * standard deviation of the team rating means
+# The temperature falls geometrically over the time budget, and the best league seen is returned.
+
+AnnealProgress = namedtuple('AnnealProgress', 'elapsed, iterations, temperature, happiness, rating_range, '
+                                              'best_happiness, best_rating_range, best_cost, best_lineup')
+
+def league_lineup(teams):
+    #player names by team and board
+    return [[player.name for player in team.boards] for team in teams]
+
+def league_cost(happiness, rating_range, rating_variance, range_weight=0.05, spread_weight=0.05):
+    return -happiness + range_weight * rating_range + spread_weight * math.sqrt(max(rating_variance, 0))
+
+def anneal_league(league, time_limit, rng=random, max_iterations=None, range_weight=0.05, spread_weight=0.05,
+                  start_temperature=2.0, end_temperature=0.01, progress=None, progress_interval=1.0):
+    #time_limit -- wall-clock budget in seconds
+    #max_iterations -- also stop after this many candidate swaps (makes runs with a fixed rng reproducible)
+    #progress -- called with an AnnealProgress about every progress_interval seconds, and once at the end
+    teams = league['teams']
+    league_arrays = LeagueArrays(teams)
+    league_arrays.update_pref()
+    n_teams = len(teams)
+    n_boards = league_arrays.n_boards
+    ratings = league_arrays.ratings
+    lineup = league_arrays.lineup
+
+    means = league_arrays.team_sums / n_boards
+    league_mean = means.mean()
+    sum_squares = ((means - league_mean) ** 2).sum()
+    happiness = total_happiness(teams)
+    rating_range = means.max() - means.min()
+
+    def cost(happiness, rating_range, sum_squares):
+        return league_cost(happiness, rating_range, sum_squares / n_teams, range_weight, spread_weight)
+
+    current_cost = cost(happiness, rating_range, sum_squares)
+    best = (current_cost, happiness, rating_range, lineup.copy())
+
+    start = time.monotonic()
+    next_progress = start + progress_interval
+    iterations = 0
+    temperature = start_temperature
+    cooling = end_temperature / start_temperature
+
+    def report(now):
+        best_lineup = [[league_arrays.players[player_id].name for player_id in team] for team in best[3].tolist()]
+        progress(AnnealProgress(now - start, iterations, temperature, happiness, rating_range,
+                                best[1], best[2], best[0], best_lineup))
+
+    while n_teams > 1:
+        now = time.monotonic()
+        done = (now - start) / time_limit if time_limit else 1
+        if max_iterations is not None:
+            done = max(done, iterations / max_iterations)
+        if done >= 1:
+            break
+        if progress is not None and now >= next_progress:
+            report(now)
+            next_progress = now + progress_interval
+        temperature = start_temperature * cooling ** done
+        iterations += 1
+
+        board = rng.randrange(n_boards)
+        team_a, team_b = rng.sample(range(n_teams), 2)
+        player_a, player_b = int(lineup[team_a, board]), int(lineup[team_b, board])
+        rating_diff = (ratings[player_b] - ratings[player_a]) / n_boards
+        mean_a, mean_b = means[team_a], means[team_b]
+        new_sum_squares = sum_squares + (mean_a + rating_diff - league_mean) ** 2 + (mean_b - rating_diff - league_mean) ** 2 \
+                          - (mean_a - league_mean) ** 2 - (mean_b - league_mean) ** 2
+        means[team_a], means[team_b] = mean_a + rating_diff, mean_b - rating_diff
+        new_range = means.max() - means.min()
+        new_happiness = happiness + league_arrays.swap_pref_change(player_a, player_b)
+        new_cost = cost(new_happiness, new_range, new_sum_squares)
+
+        delta = new_cost - current_cost
+        if delta <= 0 or rng.random() < math.exp(-delta / temperature):
+            league_arrays.swap(player_a, player_b)
+            happiness, rating_range, sum_squares, current_cost = new_happiness, new_range, new_sum_squares, new_cost
+            if current_cost < best[0]:
+                best = (current_cost, happiness, rating_range, lineup.copy())
+        else:
+            means[team_a], means[team_b] = mean_a, mean_b
+
+    # Go back to the best lineup seen, one board at a time
+    best_lineup = best[3]
+    for t in range(n_teams):
+        for board in range(n_boards):
+            if lineup[t, board] != best_lineup[t, board]:
+                league_arrays.swap(int(lineup[t, board]), int(best_lineup[t, board]))
+    happiness, rating_range = best[1], best[2]
+    if progress is not None:
+        report(time.monotonic())
+
+    for player in league['players']:
+        player.set_req_met()
     return league
 
-def get_best_league(player_data, boards, balance, count):
-    pool = Pool(getattr(settings, 'TEAMGEN_PROCESSES_NUMBER', 1))
-    args = [(player_data, boards, balance) for _ in range(count)]
-    leagues = pool.map(make_league_map, args)
-    max_happiness = max([total_happiness(l['teams']) for l in leagues])
-    happy_leagues = [l for l in leagues if total_happiness(l['teams']) == max_happiness]
-
-    happy_leagues = pool.map(reduce_variance_map, happy_leagues)
-
-    min_range_league = min(happy_leagues, key=lambda l: team_rating_range(l['teams']))
-    return min_range_league
-
-
+def get_annealed_league(player_data, boards, balance, time_limit, seed=None, **kwargs):
+    rng = random.Random(seed)
+    league = make_league(player_data, boards, balance, rng=rng)
+    reduce_variance(league['teams'])
+    return anneal_league(league, time_limit, rng=rng, **kwargs)
+
+# Parallel league search
+#
+# The player data is passed to each worker process once, when the pool starts. Tasks only send a seed and get back
+# (seed, happiness, rating range); the best league is then rebuilt from its seed, since make_league and
+# reduce_variance are deterministic for a given seed.
+
+SearchProgress = namedtuple('SearchProgress', 'elapsed, leagues, count, best_happiness, best_rating_range, best_lineup')
+
+_search_args = None
+
+def _init_search_worker(player_data, boards, balance):
+    global _search_args
+    _search_args = (player_data, boards, balance)
+
+def _search_seed(seed):
+    league = make_league(*_search_args, rng=random.Random(seed))
+    happiness = total_happiness(league['teams'])
+    reduce_variance(league['teams'])
+    return seed, happiness, team_rating_range(league['teams'])
+
+class LeagueSearch:
+    def __init__(self, player_data, boards, balance, processes=None, pool_class=Pool):
+        #pool_class -- e.g. billiard's Pool, which can be started from a daemonic celery worker
+        self.player_data = player_data
+        self.boards = boards
+        self.balance = balance
+        if processes is None:
+            processes = getattr(settings, 'TEAMGEN_PROCESSES_NUMBER', 1)
+        self.processes = processes
+        self.pool_class = pool_class
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def results(self, seeds):
+        #yields (seed, happiness, rating range) for each seed in order
+        #tasks are sent a few per worker at a time, so stopping early doesn't leave work queued in the pool
+        if self.processes <= 1:
+            _init_search_worker(self.player_data, self.boards, self.balance)
+            for seed in seeds:
+                yield _search_seed(seed)
+            return
+        if self._pool is None:
+            self._pool = self.pool_class(self.processes, _init_search_worker, (self.player_data, self.boards, self.balance))
+        batch_size = self.processes * 2
+        for i in range(0, len(seeds), batch_size):
+            yield from self._pool.map(_search_seed, seeds[i:i + batch_size])
+
+    def build_league(self, seed):
+        league = make_league(self.player_data, self.boards, self.balance, rng=random.Random(seed))
+        reduce_variance(league['teams'])
+        return league
+
+    def best_league(self, count, seed=None, max_happy_leagues=None, progress=None, progress_interval=1.0):
+        #seed -- makes the search reproducible
+        #max_happy_leagues -- stop early once this many leagues with the best happiness so far have been found
+        #progress -- called with a SearchProgress about every progress_interval seconds
+        rng = random.Random(seed)
+        seeds = [rng.getrandbits(32) for _ in range(count)]
+        best = None
+        happy_count = 0
+        start = time.monotonic()
+        next_progress = start + progress_interval
+        reported = None
+        # Results are processed in seed order so the outcome doesn't depend on which worker finishes first
+        for n, result in enumerate(self.results(seeds), 1):
+            _, happiness, rating_range = result
+            if best is None or happiness > best[1]:
+                best = result
+                happy_count = 1
+            elif happiness == best[1]:
+                happy_count += 1
+                if rating_range < best[2]:
+                    best = result
+            if max_happy_leagues is not None and happy_count >= max_happy_leagues:
+                break
+            if progress is not None and time.monotonic() >= next_progress:
+                # The best league so far is only rebuilt when it has changed since the last report
+                if reported is None or reported[0] != best[0]:
+                    reported = (best[0], league_lineup(self.build_league(best[0])['teams']))
+                progress(SearchProgress(time.monotonic() - start, n, count, best[1], best[2], reported[1]))
+                next_progress = time.monotonic() + progress_interval
+
+        return self.build_league(best[0])
+
+def get_best_league(player_data, boards, balance, count, seed=None, max_happy_leagues=None):
+    with LeagueSearch(player_data, boards, balance) as search:
+        return search.best_league(count, seed, max_happy_leagues)
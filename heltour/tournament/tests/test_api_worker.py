@@ -0,0 +1,428 @@
+import json
+import requests
+import socket
+import subprocess
+import threading
+import time
+from unittest.mock import patch, Mock
+from django.core.cache import cache
+from django.test import SimpleTestCase, RequestFactory
+from django_redis import get_redis_connection
+from heltour import settings
+from heltour.api_worker import views, worker
+from heltour.api_worker.scheduler import Scheduler, TokenBucket, RedisTokenBucket, RateLimited, RedisQueue, _Job
+
+# Jobs for the redis queue need to be module level functions
+_ran = []
+_ran_semaphore = threading.Semaphore(0)
+
+def _record(name):
+    _ran.append(name)
+    _ran_semaphore.release()
+
+def _record_slowly(name):
+    time.sleep(2.5)
+    _record(name)
+
+class TokenBucketTestCase(SimpleTestCase):
+    def test_wait_time(self):
+        bucket = TokenBucket(2, 2)
+        now = bucket.updated
+        bucket.take(now)
+        bucket.take(now)
+        self.assertAlmostEqual(0.5, bucket.wait_time(now))
+        self.assertEqual(0, bucket.wait_time(now + 0.5))
+        bucket.pause(10, now + 0.5)
+        self.assertAlmostEqual(10, bucket.wait_time(now + 0.5))
+        self.assertAlmostEqual(0.5, bucket.wait_time(now + 10.5))
+
+class RedisTokenBucketTestCase(SimpleTestCase):
+    def setUp(self):
+        self.redis = get_redis_connection('default')
+
+    def tearDown(self):
+        self.redis.delete('test-apiworker:bucket')
+
+    def test_shared(self):
+        # Buckets with the same key share their tokens and pauses, as they would between processes
+        bucket = RedisTokenBucket(self.redis, 'test-apiworker:bucket', 2, 2)
+        other = RedisTokenBucket(self.redis, 'test-apiworker:bucket', 2, 2)
+        now = time.time()
+        self.assertEqual(0, bucket.wait_time(now))
+        bucket.take(now)
+        other.take(now)
+        self.assertAlmostEqual(0.5, bucket.wait_time(now), places=3)
+        self.assertEqual(0, other.wait_time(now + 0.5))
+        other.pause(10, now + 0.5)
+        self.assertAlmostEqual(10, bucket.wait_time(now + 0.5), places=3)
+        self.assertAlmostEqual(0.5, bucket.wait_time(now + 10.5), places=3)
+
+class SchedulerTestCase(SimpleTestCase):
+    def test_priority_order(self):
+        scheduler = Scheduler({'default': (1000, 1000)}, connections=1)
+        started = threading.Event()
+        release = threading.Event()
+        finished = threading.Semaphore(0)
+        order = []
+
+        def blocker():
+            started.set()
+            release.wait(5)
+
+        def job(name):
+            order.append(name)
+            finished.release()
+
+        scheduler.queue_work(0, blocker)
+        self.assertTrue(started.wait(5))
+        # Jobs with the same priority (and functions, which can't be compared) run in the order they were queued
+        for priority, name in [(0, 'a'), (1, 'b'), (0, 'c'), (1, 'd')]:
+            scheduler.queue_work(priority, job, name)
+        release.set()
+        for _ in range(4):
+            self.assertTrue(finished.acquire(timeout=5))
+        self.assertEqual(['b', 'd', 'a', 'c'], order)
+
+    def test_retries(self):
+        scheduler = Scheduler({'default': (1000, 1000)}, connections=2, backoff=0.01)
+        attempts = []
+        failed = threading.Event()
+
+        def job(name):
+            attempts.append(name)
+            raise ValueError()
+
+        scheduler.queue_work(0, job, 'x', max_retries=2, on_failure=lambda name: failed.set())
+        self.assertTrue(failed.wait(5))
+        self.assertEqual(['x', 'x', 'x'], attempts)
+
+    def test_rate_limited_lane(self):
+        scheduler = Scheduler({'a': (1000, 1000), 'b': (1000, 1000)}, connections=1)
+        times = {}
+        done = threading.Semaphore(0)
+        start = time.monotonic()
+
+        def limited():
+            if 'a' not in times:
+                times['a'] = None
+                raise RateLimited(1)
+            times['a'] = time.monotonic() - start
+            done.release()
+
+        def other():
+            times['b'] = time.monotonic() - start
+            done.release()
+
+        scheduler.queue_work(0, limited, lane='a', max_retries=1)
+        time.sleep(0.1)
+        # The other lane isn't held up by the pause
+        scheduler.queue_work(0, other, lane='b')
+        for _ in range(2):
+            self.assertTrue(done.acquire(timeout=5))
+        self.assertLess(times['b'], 0.5)
+        self.assertGreaterEqual(times['a'], 1)
+
+    def test_rate(self):
+        scheduler = Scheduler({'default': (20, 1)}, connections=3)
+        done = threading.Semaphore(0)
+        start = time.monotonic()
+        for _ in range(5):
+            scheduler.queue_work(0, done.release)
+        for _ in range(5):
+            self.assertTrue(done.acquire(timeout=5))
+        # One token to start with, then 20 per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+
+    def test_take_token(self):
+        # Requests made outside of a job wait for the lane's tokens and pauses too
+        scheduler = Scheduler({'default': (1000, 1000)}, connections=1)
+        scheduler.pause('default', 0.2)
+        start = time.monotonic()
+        scheduler.take_token('default')
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+
+class LichessApiCallTestCase(SimpleTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.redis_keys = []
+        self.jobs = []
+        patcher = patch.object(views.worker, 'queue_work', side_effect=lambda *args, **kwargs: self.jobs.append(args))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        redis = get_redis_connection('default')
+        if self.redis_keys:
+            redis.delete(*self.redis_keys)
+        # The requests left queued
+        for key in redis.scan_iter(views._waiters_key('*')):
+            redis.delete(key)
+        cache.delete_pattern('lichessapi-response-*')
+
+    def call(self, path):
+        response = views.lichess_api_call(self.factory.get('/lichessapi/' + path), path.split('?')[0])
+        self.redis_keys.append(response.content.decode('utf-8'))
+        return self.redis_keys[-1]
+
+    def run_job(self, text):
+        _, fn, *args = self.jobs.pop(0)
+        with patch.object(views, '_session', Mock(get=Mock(return_value=Mock(status_code=200, text=text)))):
+            fn(*args)
+
+    def result(self, redis_key):
+        return get_redis_connection('default').lpop(redis_key).decode('utf-8')
+
+    def test_coalescing(self):
+        key1 = self.call('game/export/abc?priority=1&format=application/json')
+        key2 = self.call('game/export/abc?priority=0&format=application/json')
+        self.call('game/export/xyz?format=application/json')
+        self.assertEqual(2, len(self.jobs))
+
+        # Both callers get the result of one request
+        with patch.dict(settings.API_WORKER_CACHE_TIMEOUTS, {'games': 0}):
+            self.run_job('{"id": "abc", "status": "started"}')
+        self.assertEqual('{"id": "abc", "status": "started"}', self.result(key1))
+        self.assertEqual('{"id": "abc", "status": "started"}', self.result(key2))
+
+        # Once it's finished, the request goes to lichess again
+        self.call('game/export/abc?format=application/json')
+        self.assertEqual(2, len(self.jobs))
+
+    def test_queue_failure(self):
+        # If the job can't be queued, the callers are told straight away and the request can be made again
+        self.redis_keys.append('lichessapi-result-queuefailure')
+        with patch.object(views.worker, 'queue_work', side_effect=ConnectionError()), \
+             patch.object(views, 'get_random_string', return_value='queuefailure'):
+            with self.assertRaises(ConnectionError):
+                self.call('game/export/abc?format=application/json')
+        self.assertEqual('', self.result('lichessapi-result-queuefailure'))
+        self.call('game/export/abc?format=application/json')
+        self.assertEqual(1, len(self.jobs))
+
+    def test_finished_game_cache(self):
+        with patch.dict(settings.API_WORKER_CACHE_TIMEOUTS, {'games': 0}):
+            self.call('game/export/abc.pgn')
+            self.run_job('[Result "*"]\n\n1. e4 *')
+            # Ongoing games aren't cached
+            self.call('game/export/abc.pgn')
+            self.assertEqual(1, len(self.jobs))
+            self.run_job('[Result "1-0"]\n\n1. e4 1-0')
+            # Finished games are
+            key = self.call('game/export/abc.pgn')
+            self.assertEqual(0, len(self.jobs))
+            self.assertEqual('[Result "1-0"]\n\n1. e4 1-0', self.result(key))
+
+    def test_stream(self):
+        # Without a durable queue, a stream is listed under the process that queued it until it ends (see
+        # views.fail_lost_requests)
+        with patch.object(views.worker, 'queue_is_durable', False):
+            key = self.call('api/games/user/abc?stream=1')
+            redis = get_redis_connection('default')
+            self.assertIn(key.encode('utf-8'), redis.lrange(views._streams_key(), 0, -1))
+            _, fn, *args = self.jobs.pop(0)
+            self.assertEqual(views._do_lichess_api_stream, fn)
+            views._lichess_api_stream_failed(*args)
+            self.assertNotIn(key.encode('utf-8'), redis.lrange(views._streams_key(), 0, -1))
+        self.assertEqual('', self.result(key))
+
+class LichessApiStreamTestCase(SimpleTestCase):
+    def tearDown(self):
+        get_redis_connection('default').delete('test-result-1', views._started_key('test-result-1'))
+
+    def test_split_json_records(self):
+        self.assertEqual((['{"id": "a"}', '{"id": "b, c"}'], '{"id": '),
+                         views._split_json_records('[{"id": "a"},\n {"id": "b, c"}, {"id": '))
+        self.assertEqual((['{"a": 1}', '{"b": [2]}'], ''), views._split_json_records('{"a": 1}\n{"b": [2]}\n'))
+        self.assertEqual(([], ''), views._split_json_records(']'))
+
+    def stream(self, chunks, fail=False):
+        def iter_content(**kwargs):
+            for chunk in chunks:
+                yield chunk
+            if fail:
+                raise IOError()
+        response = Mock(status_code=200, encoding='utf-8', iter_content=iter_content)
+        with patch.object(views, '_session', Mock(get=Mock(return_value=response))):
+            views._do_lichess_api_stream('test-result-1', 'api/games/user/abc', 'GET', '', {}, 'application/x-ndjson')
+        return [r.decode('utf-8') for r in get_redis_connection('default').lrange('test-result-1', 0, -1)]
+
+    def test_stream(self):
+        # Records split across chunks are pushed once they're complete
+        self.assertEqual(['{"id": "a"}', '{"id": "bc"}', 'end'],
+                         self.stream(['{"id": "a"}\n{"id"', ': "bc"}\n']))
+
+    def test_stream_failure(self):
+        # A failure before anything was sent can be retried
+        with self.assertRaises(IOError):
+            self.stream([], fail=True)
+        # But not after, since the caller already has some of the records
+        self.assertEqual(['{"id": "a"}', ''], self.stream(['{"id": "a"}\n{"id"'], fail=True))
+
+    def test_reclaimed_stream(self):
+        # A stream job that's claimed again after it started sending records (e.g. because the worker running it
+        # died) isn't run again, since that would repeat the records the caller already has
+        get_redis_connection('default').set(views._started_key('test-result-1'), 1)
+        self.assertEqual([''], self.stream(['{"id": "a"}\n']))
+        # Once a stream has ended it's no longer marked as started
+        self.assertFalse(get_redis_connection('default').exists(views._started_key('test-result-1')))
+
+class RedisQueueTestCase(SimpleTestCase):
+    def setUp(self):
+        self.redis = get_redis_connection('default')
+        del _ran[:]
+
+    def tearDown(self):
+        keys = list(self.redis.scan_iter('test-apiworker:*'))
+        if keys:
+            self.redis.delete(*keys)
+
+    def queue(self, visibility_timeout=120):
+        return RedisQueue(self.redis, ['default'], prefix='test-apiworker', visibility_timeout=visibility_timeout)
+
+    def wait_for(self, count):
+        for _ in range(count):
+            self.assertTrue(_ran_semaphore.acquire(timeout=5))
+
+    def test_survives_restart(self):
+        # Jobs queued before a restart are run by the next worker, in priority order
+        queue = self.queue()
+        for priority, name in [(0, 'a'), (1, 'b'), (0, 'c')]:
+            queue.push(_Job(priority, 'default', _record, [name], 0, None))
+        Scheduler({'default': (1000, 1000)}, connections=1, queue=self.queue())
+        self.wait_for(3)
+        self.assertEqual(['b', 'a', 'c'], _ran)
+        # The last job is acknowledged just after it runs
+        deadline = time.monotonic() + 5
+        while self.redis.hlen('test-apiworker:jobs') and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(0, self.redis.hlen('test-apiworker:jobs'))
+
+    def test_visibility_timeout(self):
+        # A job claimed by a worker that died is run again once the visibility timeout has passed
+        queue = self.queue(visibility_timeout=1)
+        queue.push(_Job(0, 'default', _record, ['a'], 0, None))
+        self.assertEqual(['a'], queue.claim('default').args)
+        self.assertIsNone(queue.claim('default'))
+
+        start = time.monotonic()
+        Scheduler({'default': (1000, 1000)}, connections=1, queue=self.queue())
+        self.wait_for(1)
+        self.assertGreaterEqual(time.monotonic() - start, 0.5)
+        self.assertEqual(['a'], _ran)
+
+    def test_heartbeat(self):
+        # A job that runs for longer than the visibility timeout isn't run again while it's still running
+        queue = self.queue(visibility_timeout=1)
+        queue.push(_Job(0, 'default', _record_slowly, ['a'], 0, None))
+        Scheduler({'default': (1000, 1000)}, connections=2, queue=self.queue(visibility_timeout=1))
+        self.wait_for(1)
+        self.assertFalse(_ran_semaphore.acquire(timeout=1.5))
+        self.assertEqual(['a'], _ran)
+
+    def test_dropped_job(self):
+        # A job whose function no longer exists is dropped, but its failure handler is still called
+        queue = self.queue()
+        job = _Job(0, 'default', _record, ['a'], 0, _record)
+        queue.push(job)
+        data = json.loads(self.redis.hget('test-apiworker:jobs', job.id).decode('utf-8'))
+        data['fn'] = 'heltour.tournament.tests.test_api_worker._missing'
+        self.redis.hset('test-apiworker:jobs', job.id, json.dumps(data))
+        self.assertIsNone(queue.claim('default'))
+        self.wait_for(1)
+        self.assertEqual(['a'], _ran)
+        self.assertEqual(0, self.redis.hlen('test-apiworker:jobs'))
+
+    def test_fail_lost_requests(self):
+        # Only the requests of processes that have exited are failed
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+        lost_key = '%s%s-%d:test-request' % (views._WAITERS_PREFIX, socket.gethostname(), proc.pid)
+        self.redis.rpush(lost_key, 'test-apiworker:lost-result')
+        redis_key = 'test-apiworker:result'
+        self.assertTrue(views._join('test-request', redis_key))
+        self.assertFalse(views._join('test-request', redis_key))
+        try:
+            views.fail_lost_requests()
+            self.assertEqual([b''], self.redis.lrange('test-apiworker:lost-result', 0, -1))
+            self.assertFalse(self.redis.exists(lost_key))
+            self.assertFalse(self.redis.exists(redis_key))
+        finally:
+            views._finish('test-request', '')
+        self.assertEqual([b'', b''], self.redis.lrange(redis_key, 0, -1))
+
+class GameStreamTestCase(SimpleTestCase):
+    def test_follow_game(self):
+        response = Mock(status_code=200, iter_lines=Mock(return_value=iter([b'{"id": "game0001"}', b''])))
+        with patch.object(worker, '_stream_session', Mock(get=Mock(return_value=response))) as session, \
+             patch.object(worker.app, 'send_task') as send_task, \
+             patch.object(settings, 'API_WORKER_GAME_STREAM_MIN_INTERVAL', 0):
+            worker._streams.add('game0001')
+            worker._follow_game('game0001')
+        self.assertEqual('https://lichess.org/api/stream/game/game0001', session.get.call_args[0][0])
+        # Heltour is told once the stream ends, and the game can be streamed again
+        send_task.assert_called_once_with('heltour.tournament.tasks.game_finished', args=['game0001'])
+        self.assertNotIn('game0001', worker._streams)
+        response.close.assert_called_once_with()
+
+    def test_rate_limited(self):
+        # A 429 pauses the streams lane and the stream is opened again, without telling heltour the game finished
+        limited = Mock(status_code=429, headers={'Retry-After': '5'})
+        response = Mock(status_code=200, iter_lines=Mock(return_value=iter([])))
+        with patch.object(worker, '_stream_session', Mock(get=Mock(side_effect=[limited, response]))) as session, \
+             patch.object(worker, '_scheduler') as scheduler, \
+             patch.object(worker.app, 'send_task') as send_task, \
+             patch.object(settings, 'API_WORKER_GAME_STREAM_MIN_INTERVAL', 0):
+            worker._streams.add('game0001')
+            worker._follow_game('game0001')
+        self.assertEqual(2, session.get.call_count)
+        self.assertEqual(2, scheduler.take_token.call_count)
+        scheduler.take_token.assert_called_with('streams')
+        scheduler.pause.assert_called_once_with('streams', 5)
+        send_task.assert_called_once_with('heltour.tournament.tasks.game_finished', args=['game0001'])
+
+    def test_error(self):
+        # A stream that can't be opened isn't reported as finished
+        response = Mock(status_code=404, raise_for_status=Mock(side_effect=requests.HTTPError('Not found')))
+        with patch.object(worker, '_stream_session', Mock(get=Mock(return_value=response))), \
+             patch.object(worker.app, 'send_task') as send_task, \
+             patch.object(settings, 'API_WORKER_GAME_STREAM_MIN_INTERVAL', 0):
+            worker._streams.add('game0001')
+            worker._follow_game('game0001')
+        send_task.assert_not_called()
+        self.assertNotIn('game0001', worker._streams)
+
+    def test_stream_limit(self):
+        with patch.object(settings, 'API_WORKER_MAX_GAME_STREAMS', 1), \
+             patch.object(worker, '_streams', {'game0001'}), \
+             patch.object(worker.threading, 'Thread') as thread:
+            self.assertFalse(worker._start_stream('game0002'))
+            thread.assert_not_called()
+            self.assertEqual({'game0001'}, worker._streams)
+
+    def test_claimed_elsewhere(self):
+        # A game streamed by another API worker process isn't streamed twice, and isn't reported as unstreamed
+        redis = get_redis_connection('default')
+        redis.set(worker._STREAM_CLAIM_KEY % 'game0002', 1)
+        try:
+            with patch.object(worker, '_streams', set()), \
+                 patch.object(worker.threading, 'Thread') as thread:
+                self.assertTrue(worker._start_stream('game0002'))
+                thread.assert_not_called()
+                self.assertEqual(set(), worker._streams)
+        finally:
+            redis.delete(worker._STREAM_CLAIM_KEY % 'game0002')
+
+    def test_claim(self):
+        # Once the stream ends the claim is released, so any process can stream the game again
+        response = Mock(status_code=200, iter_lines=Mock(return_value=iter([])))
+        with patch.object(worker, '_streams', set()), \
+             patch.object(worker.threading, 'Thread') as thread, \
+             patch.object(worker, '_stream_session', Mock(get=Mock(return_value=response))), \
+             patch.object(worker.app, 'send_task'), \
+             patch.object(settings, 'API_WORKER_GAME_STREAM_MIN_INTERVAL', 0):
+            self.assertTrue(worker._start_stream('game0002'))
+            thread.assert_called_once_with(target=worker._follow_game, args=('game0002',))
+            self.assertFalse(worker._claim_stream('game0002'))
+            worker._follow_game('game0002')
+        self.assertTrue(worker._claim_stream('game0002'))
+        worker._release_stream_claim('game0002')
@@ -0,0 +1,157 @@
+import glob
+import os
+import shlex
+import shutil
+from django.test import SimpleTestCase
+from heltour import settings
+from heltour.tournament import dutch
+from heltour.tournament.pairinggen import JavafoInstance, JavafoPlayer, JavafoPairing, JavafoProcessEngine, \
+    NativeDutchEngine
+
+# TRFX recorded from simulated seasons, used as inputs for both engines. javafo's output for each input is recorded
+# next to it as <name>.javafo.txt, so the native engine can be checked against javafo without the jar.
+TRFX_DIR = os.path.join(os.path.dirname(__file__), 'trfx')
+
+def recorded_trfx():
+    for path in sorted(glob.glob(os.path.join(TRFX_DIR, '*.trfx'))):
+        with open(path) as f:
+            yield os.path.basename(path), f.read()
+
+def javafo_output_path(name):
+    return os.path.join(TRFX_DIR, os.path.splitext(name)[0] + '.javafo.txt')
+
+def recorded_javafo_output(name):
+    path = javafo_output_path(name)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read()
+
+def read_pairs(output):
+    lines = output.strip().splitlines()
+    return [tuple(int(n) for n in line.split()) for line in lines[1:int(lines[0]) + 1]]
+
+def javafo_players(count, accelerated=0):
+    return [JavafoPlayer('p%d' % n, 0, [], acceleration_scores=[1, 1, 1, 0.5, 0.5] if n <= accelerated else None)
+            for n in range(1, count + 1)]
+
+def pairing_quality(trfx, pairs):
+    '''Returns (sum of squared score differences, number of unsatisfied colour preferences).'''
+    _, players = dutch.parse_trfx(trfx)
+    by_number = {p.number: p for p in players}
+    round_index = min(len(p.results) for p in players)
+    score_diff = 0
+    colour_misses = 0
+    for white, black in pairs:
+        if black == 0:
+            continue
+        score_diff += (by_number[white].pairing_score(round_index) - by_number[black].pairing_score(round_index)) ** 2
+        colour_misses += by_number[white].colour_preference()[0] == 'b'
+        colour_misses += by_number[black].colour_preference()[0] == 'w'
+    return score_diff, colour_misses
+
+class PairingAssertions(object):
+    def assertValidPairing(self, trfx, pairs):
+        # The absolute criteria: every included player is paired exactly once, without rematches, a second bye or
+        # a pairing against an absolute colour preference
+        _, players = dutch.parse_trfx(trfx)
+        by_number = {p.number: p for p in players}
+        included = {p.number for p in players if p.include}
+        paired = [n for pair in pairs for n in pair if n != 0]
+        self.assertEqual(sorted(included), sorted(paired))
+        for white, black in pairs:
+            if black == 0:
+                self.assertFalse(by_number[white].had_bye())
+                continue
+            self.assertNotIn(black, by_number[white].opponents())
+            self.assertNotEqual(('b', dutch._ABSOLUTE), by_number[white].colour_preference())
+            self.assertNotEqual(('w', dutch._ABSOLUTE), by_number[black].colour_preference())
+
+    def assertNoWorseThanJavafo(self, trfx, native_pairs, javafo_pairs):
+        # The native engine doesn't have to match javafo pair for pair, since the Dutch rules often leave a choice
+        # between equally good pairings. It must meet the absolute criteria, pair the same number of boards, and
+        # be no worse on the score differences between opponents (floats), then on colour preferences.
+        self.assertValidPairing(trfx, native_pairs)
+        self.assertEqual(len(javafo_pairs), len(native_pairs))
+        self.assertLessEqual(pairing_quality(trfx, native_pairs), pairing_quality(trfx, javafo_pairs))
+
+class DutchEngineTestCase(PairingAssertions, SimpleTestCase):
+    def test_first_round(self):
+        trfx = JavafoInstance(5, javafo_players(8))._write_trfx()
+        # Top half against bottom half, alternating colours by board
+        self.assertEqual([(1, 5), (6, 2), (3, 7), (8, 4)], read_pairs(dutch.pair_trfx(trfx)))
+
+    def test_baku_acceleration(self):
+        trfx = JavafoInstance(5, javafo_players(8, accelerated=4))._write_trfx()
+        # The accelerated group is paired among itself in the first round
+        self.assertEqual([(1, 3), (4, 2), (5, 7), (8, 6)], read_pairs(dutch.pair_trfx(trfx)))
+
+    def test_bye(self):
+        players = javafo_players(5)
+        self.assertEqual((5, 0), read_pairs(dutch.pair_trfx(JavafoInstance(5, players)._write_trfx()))[-1])
+
+        # A player who already had a bye doesn't get another
+        players[0].pairings = [JavafoPairing('p2', 'white', 1)]
+        players[1].pairings = [JavafoPairing('p1', 'black', 0)]
+        players[2].pairings = [JavafoPairing('p3', 'white', 0)]
+        players[3].pairings = [JavafoPairing('p4', 'black', 1)]
+        players[4].pairings = [JavafoPairing(None, None, 1, forfeit=True)]
+        players[0].score = players[3].score = players[4].score = 1
+        pairs = read_pairs(dutch.pair_trfx(JavafoInstance(5, players)._write_trfx()))
+        self.assertEqual(3, len(pairs))
+        self.assertIn(pairs[-1], [(2, 0), (3, 0)])
+
+    def test_excluded_players(self):
+        players = javafo_players(6)
+        players[1].include = False
+        players[4].include = False
+        pairs = read_pairs(dutch.pair_trfx(JavafoInstance(5, players)._write_trfx()))
+        self.assertEqual({1, 3, 4, 6}, {n for pair in pairs for n in pair})
+
+    def test_rematch_fallback(self):
+        players = javafo_players(2)
+        players[0].pairings = [JavafoPairing('p2', 'white', 1)]
+        players[1].pairings = [JavafoPairing('p1', 'black', 0)]
+        # A rematch is allowed as a last resort
+        self.assertEqual([['p2', 'p1']], JavafoInstance(5, players).run(NativeDutchEngine()))
+
+    def test_recorded_inputs(self):
+        for name, trfx in recorded_trfx():
+            with self.subTest(name):
+                self.assertValidPairing(trfx, read_pairs(dutch.pair_trfx(trfx)))
+
+class JavafoRecordedOutputTestCase(PairingAssertions, SimpleTestCase):
+    '''Compares the native engine to javafo's recorded output for each recorded input (see assertNoWorseThanJavafo).
+    Inputs without a recording are skipped; see JavafoDifferentialTestCase for how to record them.'''
+
+    def test_no_worse_than_recorded_javafo(self):
+        for name, trfx in recorded_trfx():
+            with self.subTest(name):
+                javafo_output = recorded_javafo_output(name)
+                if javafo_output is None:
+                    self.skipTest('no recorded javafo output for %s' % name)
+                javafo_pairs = read_pairs(javafo_output)
+                self.assertValidPairing(trfx, javafo_pairs)
+                self.assertNoWorseThanJavafo(trfx, read_pairs(NativeDutchEngine().pair(trfx)), javafo_pairs)
+
+class JavafoDifferentialTestCase(PairingAssertions, SimpleTestCase):
+    '''Compares the native engine to javafo itself on the recorded inputs. Skipped if javafo isn't installed.
+
+    Run with JAVAFO_RECORD=1 to also (re)write the recorded outputs used by JavafoRecordedOutputTestCase.
+    '''
+
+    def setUp(self):
+        jars = [arg for arg in shlex.split(settings.JAVAFO_COMMAND) if arg.endswith('.jar')]
+        if not shutil.which('java') or not jars or not os.path.exists(jars[0]):
+            self.skipTest('javafo is not available')
+        self.javafo = JavafoProcessEngine(settings.JAVAFO_COMMAND, settings.JAVAFO_TIMEOUT)
+
+    def test_no_worse_than_javafo(self):
+        record = bool(os.environ.get('JAVAFO_RECORD'))
+        for name, trfx in recorded_trfx():
+            with self.subTest(name):
+                javafo_output = self.javafo.pair(trfx, '-q 10000')
+                if record:
+                    with open(javafo_output_path(name), 'w') as f:
+                        f.write(javafo_output)
+                self.assertNoWorseThanJavafo(trfx, read_pairs(NativeDutchEngine().pair(trfx)), read_pairs(javafo_output))
@@ -0,0 +1,73 @@
+import threading
+from unittest.mock import patch, Mock
+from django.test import SimpleTestCase
+from django_redis import get_redis_connection
+from heltour.tournament import lichessapi
+
+def worker_session(keys):
+    # Stands in for the API worker: each request returns the next key
+    session = Mock()
+    session.get.side_effect = [Mock(status_code=200, text=key) for key in keys]
+    return session
+
+def worker_session_by_game(keys):
+    # As worker_session, for concurrent requests: each game's request returns its own key, whatever order the
+    # requests are made in
+    def get(url, **kwargs):
+        game_id = url.rstrip('/').split('?')[0].rsplit('/', 1)[-1]
+        return Mock(status_code=200, text=keys[game_id])
+    session = Mock()
+    session.get.side_effect = get
+    return session
+
+def push_later(key, value, delay=0.1):
+    timer = threading.Timer(delay, lambda: get_redis_connection('default').rpush(key, value))
+    timer.start()
+    return timer
+
+class ApiCallTestCase(SimpleTestCase):
+    def tearDown(self):
+        get_redis_connection('default').delete('test-result-1', 'test-result-2')
+
+    def test_apicall(self):
+        with patch.object(lichessapi, '_get_session', return_value=worker_session(['test-result-1'])):
+            push_later('test-result-1', '{"id": "abc"}')
+            self.assertEqual({'id': 'abc'}, lichessapi.get_game_meta('abc'))
+
+    def test_api_failure(self):
+        with patch.object(lichessapi, '_get_session', return_value=worker_session(['test-result-1'])):
+            push_later('test-result-1', '', delay=0)
+            with self.assertRaises(lichessapi.ApiWorkerError):
+                lichessapi.get_game_meta('abc')
+
+    def test_timeout(self):
+        with patch.object(lichessapi, '_get_session', return_value=worker_session(['test-result-1'])):
+            with self.assertRaises(lichessapi.ApiWorkerError):
+                lichessapi._apicall('http://worker/lichessapi/x', timeout=1)
+
+    def test_run_async(self):
+        with patch.object(lichessapi, '_get_session',
+                          return_value=worker_session_by_game({'a': 'test-result-1', 'b': 'test-result-2'})):
+            # Results are returned in order regardless of which finishes first
+            push_later('test-result-1', '{"id": "a"}', delay=0.3)
+            push_later('test-result-2', '', delay=0.1)
+            meta, error = lichessapi.run_async(lichessapi.get_game_meta_async('a'),
+                                               lichessapi.get_game_meta_async('b'))
+        self.assertEqual({'id': 'a'}, meta)
+        self.assertIsInstance(error, lichessapi.ApiWorkerError)
+
+    def test_stream(self):
+        with patch.object(lichessapi, '_get_session', return_value=worker_session(['test-result-1', 'test-result-2'])):
+            push_later('test-result-1', '{"id": "a"}', delay=0)
+            metas = lichessapi.enumerate_latest_game_metas('player', 2)
+            # Records are available before the stream has finished
+            self.assertEqual({'id': 'a'}, next(metas))
+            push_later('test-result-1', '{"id": "b"}', delay=0)
+            push_later('test-result-1', 'end', delay=0.1)
+            self.assertEqual([{'id': 'b'}], list(metas))
+
+            get_redis_connection('default').rpush('test-result-2', '{"id": "c"}', '')
+            metas = lichessapi.enumerate_latest_game_metas('player', 2)
+            self.assertEqual({'id': 'c'}, next(metas))
+            with self.assertRaises(lichessapi.ApiWorkerError):
+                next(metas)
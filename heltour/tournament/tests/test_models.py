@@ -3,6 +3,8 @@ from heltour.tournament.models import *
 from django.contrib.auth.models import User
 from datetime import datetime
 from django.utils import timezone
+from unittest.mock import patch
+from django.core.urlresolvers import reverse
 
 def createCommonLeagueData():
     team_count = 4
@@ -138,6 +140,77 @@ class SeasonTestCase(TestCase):
         rounds[2].save()
         self.assertEqual([(2, 2, 2, 5, 2.5), (0.5, 1.5, 4, 1, 7.5), (0.5, 1.5, 4, 1.5, 7.5), (1, 1, 2, 2.5, 2.5)], score_matrix())
 
+    def test_season_award_lone_prizes(self):
+        season = Season.objects.get(tag='loneseason')
+        rounds = list(season.round_set.order_by('number'))
+        players = [sp.player for sp in season.seasonplayer_set.order_by('player__lichess_username')]
+        SeasonPlayer.objects.filter(season=season).update(seed_rating=1500)
+        SeasonPlayer.objects.filter(season=season, player=players[0]).update(seed_rating=1700)
+        LonePlayerPairing.objects.create(round=rounds[0], pairing_order=0, white=players[0], black=players[1], result='1-0')
+        LonePlayerPairing.objects.create(round=rounds[0], pairing_order=0, white=players[2], black=players[3], result='1/2-1/2')
+        LonePlayerPairing.objects.create(round=rounds[1], pairing_order=0, white=players[2], black=players[0], result='0-1')
+        LonePlayerPairing.objects.create(round=rounds[1], pairing_order=0, white=players[3], black=players[1], result='1/2-1/2')
+        Round.objects.filter(season=season).update(is_completed=True)
+
+        season.is_completed = True
+        season.save()
+        winners = {(w.season_prize.rank, w.season_prize.max_rating): w.player
+                   for w in SeasonPrizeWinner.objects.filter(season_prize__season=season)}
+        # Players 2 and 1 are tied on points and the first two tiebreaks; the cumulative tiebreak decides third place
+        self.assertEqual({(1, None): players[0], (2, None): players[3], (3, None): players[2], (1, 1600): players[3]},
+                         winners)
+
+    def test_season_calculate_scores_incremental(self):
+        season = Season.objects.get(tag='loneseason')
+        rounds = list(season.round_set.order_by('number'))
+        season_players = list(season.seasonplayer_set.order_by('player__lichess_username'))
+        players = [sp.player for sp in season_players]
+
+        def score_matrix():
+            scores = list(LonePlayerScore.objects.filter(season_player__season=season).order_by('season_player__player__lichess_username'))
+            return [(s.points, s.tiebreak1, s.tiebreak2, s.tiebreak3, s.tiebreak4) for s in scores]
+
+        p1 = LonePlayerPairing.objects.create(round=rounds[0], pairing_order=0, white=players[0], black=players[1], result='1-0')
+        LonePlayerPairing.objects.create(round=rounds[0], pairing_order=1, white=players[2], black=players[3], result='1/2-1/2')
+        LonePlayerPairing.objects.create(round=rounds[0], pairing_order=2, white=players[4], black=players[5], result='0-1')
+        LonePlayerPairing.objects.create(round=rounds[1], pairing_order=0, white=players[3], black=players[0], result='0-1')
+        LonePlayerPairing.objects.create(round=rounds[1], pairing_order=1, white=players[5], black=players[6], result='1-0')
+        PlayerBye.objects.create(round=rounds[1], player=players[7], type='half-point-bye')
+        rounds[0].is_completed = True
+        rounds[0].save()
+        rounds[1].is_completed = True
+        rounds[1].save()
+
+        p1.result = '0-1'
+        p1.save()
+        incremental = score_matrix()
+        season.calculate_scores()
+        self.assertEqual(score_matrix(), incremental)
+
+        bye = PlayerBye.objects.get(player=players[7])
+        bye.type = 'full-point-bye'
+        bye.save()
+        incremental = score_matrix()
+        season.calculate_scores()
+        self.assertEqual(score_matrix(), incremental)
+
+    def test_export_players(self):
+        season = Season.objects.get(tag='loneseason')
+        season.start_date = timezone.now()
+        sps = {sp.player.lichess_username: sp for sp in season.seasonplayer_set.select_related('player')}
+        sp = sps['Player1']
+        sp.registration = create_reg(season, sp.player.user)
+        sp.registration.friends = 'player3, Player2 and player3 again (not player-2 or Player22)'
+        sp.registration.avoid = '@PLAYER4'
+        sp.registration.save()
+        sp.save()
+
+        exported = {p['name']: p for p in season.export_players()}
+        self.assertEqual(8, len(exported))
+        self.assertEqual([sps['Player3'].player_id, sps['Player2'].player_id], exported['Player1']['friend_ids'])
+        self.assertEqual([sps['Player4'].player_id], exported['Player1']['avoid_ids'])
+        self.assertEqual([], exported['Player2']['friend_ids'])
+
 class TeamTestCase(TestCase):
     def setUp(self):
         createCommonLeagueData()
@@ -302,6 +375,61 @@ class LonePlayerPairingTestCase(TestCase):
         self.assertEqual(0, score1.points)
         self.assertEqual(0, score2.points)
 
+    def test_loneplayerpairing_deferred_scores(self):
+        season = Season.objects.get(tag='loneseason')
+        round1 = season.round_set.get(number=1)
+        sp1 = season.seasonplayer_set.all()[0]
+        sp2 = season.seasonplayer_set.all()[1]
+        score1 = sp1.loneplayerscore
+
+        round1.is_completed = True
+        round1.save()
+
+        with patch.object(settings, 'SCORE_RECALCULATION_DELAY', 2):
+            pairing = LonePlayerPairing.objects.create(round=round1, white=sp1.player, black=sp2.player, pairing_order=1, result='1-0')
+            pairing.result = '1/2-1/2'
+            pairing.save()
+            score1.refresh_from_db()
+            self.assertEqual(0, score1.points)
+
+            season.flush_scores()
+            score1.refresh_from_db()
+            self.assertEqual(0.5, score1.points)
+
+            # The standings page doesn't show scores from before a queued recalculation
+            pairing.result = '1-0'
+            pairing.save()
+            self.client.get(reverse('by_league:by_season:standings', args=[season.league.tag, season.tag]))
+            score1.refresh_from_db()
+            self.assertEqual(1, score1.points)
+
+    def test_loneplayerpairing_deferred_scores_after_commit(self):
+        season = Season.objects.get(tag='loneseason')
+        round1 = season.round_set.get(number=1)
+        sp1 = season.seasonplayer_set.all()[0]
+        sp2 = season.seasonplayer_set.all()[1]
+        score1 = sp1.loneplayerscore
+
+        round1.is_completed = True
+        round1.save()
+
+        committed = []
+        with patch.object(settings, 'SCORE_RECALCULATION_DELAY', 2), \
+             patch.object(transaction, 'on_commit', side_effect=committed.append), \
+             patch.object(signals.do_calculate_scores, 'send') as send:
+            LonePlayerPairing.objects.create(round=round1, white=sp1.player, black=sp2.player, pairing_order=1, result='1-0')
+            # A task for an earlier change consumes the marker before this transaction commits, so it can't see the
+            # new pairing
+            cache.delete('season_scores_dirty-%d' % season.pk)
+            for callback in committed:
+                callback()
+            self.assertTrue(send.called)
+
+            # The change is still queued once it's committed
+            season.flush_scores()
+            score1.refresh_from_db()
+            self.assertEqual(1, score1.points)
+
     def test_loneplayerpairing_refresh_ranks(self):
         season = Season.objects.get(tag='loneseason')
         round1 = season.round_set.get(number=1)
@@ -534,3 +662,50 @@ class PlayerByeTestCase(TestCase):
 
         bye2.refresh_rank()
         self.assertEqual(1, bye2.player_rank)
+
+def user_meta(username, rating, games=30, **marks):
+    return dict({'id': username.lower(), 'perfs': {'classical': {'rating': rating, 'games': games}},
+                 'seenAt': rating * 1000}, **marks)
+
+class PlayerTestCase(TestCase):
+    def setUp(self):
+        createCommonLeagueData()
+        self.players = list(Player.objects.order_by('pk'))
+
+    def test_update_profiles(self):
+        Player.update_profiles(self.players, [user_meta(p.lichess_username, 1500) for p in self.players])
+        for p in Player.objects.all():
+            self.assertEqual(1500, p.rating)
+            self.assertIsNotNone(p.profile_updated)
+
+        metas = [user_meta(p.lichess_username, 1500) for p in self.players]
+        metas[0]['perfs']['classical']['rating'] = 1600
+        metas[1]['engine'] = True
+        metas[2]['seenAt'] = 1
+        players = list(Player.objects.order_by('pk'))
+        with patch('heltour.tournament.signals.player_account_status_changed.send') as send, \
+             patch.object(Player, 'save') as save:
+            self.assertEqual((8, 2), Player.update_profiles(players, metas, batch_size=3))
+        save.assert_not_called()
+        send.assert_called_once_with(Player, instance=players[1], old_value='normal', new_value='engine')
+        self.assertEqual(1600, Player.objects.get(pk=players[0].pk).rating)
+        self.assertEqual('engine', Player.objects.get(pk=players[1].pk).account_status)
+        # Keys that change all the time aren't worth a write
+        self.assertEqual(1500 * 1000, Player.objects.get(pk=players[2].pk).profile['seenAt'])
+
+        # Unchanged profiles don't send the signal again
+        with patch('heltour.tournament.signals.player_account_status_changed.send') as send:
+            self.assertEqual((8, 0), Player.update_profiles(Player.objects.all(), metas))
+        send.assert_not_called()
+
+    def test_players_due_for_rating_update(self):
+        from heltour.tournament.tasks import _players_due_for_rating_update
+        now = timezone.now()
+        self.assertEqual(8, _players_due_for_rating_update(now).count())
+
+        Player.objects.update(profile_updated=now)
+        self.assertEqual(0, _players_due_for_rating_update(now).count())
+        Season.objects.filter(tag='loneseason').update(is_active=True)
+        self.assertEqual(8, _players_due_for_rating_update(now).count())
+        Season.objects.filter(tag='loneseason').update(is_active=False)
+        self.assertEqual(8, _players_due_for_rating_update(now + timedelta(days=2)).count())
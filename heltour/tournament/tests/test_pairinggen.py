@@ -0,0 +1,177 @@
+import sys
+from unittest.mock import patch
+from reversion.models import Revision
+from django.test import TestCase, SimpleTestCase, override_settings
+from heltour import settings
+from heltour.tournament.models import *
+from heltour.tournament import pairinggen
+from heltour.tournament.pairinggen import JavafoInstance, JavafoPlayer, JavafoPairing, JavafoDaemonEngine, \
+    JavafoProcessEngine, StubPairingEngine, PairingGenerationException
+from heltour.tournament.tests.test_models import createCommonLeagueData
+
+# Speaks the JavafoDaemon protocol, pairing players in start number order
+FAKE_DAEMON = '''
+import sys, time
+while True:
+    header = sys.stdin.buffer.readline()
+    if not header:
+        break
+    length, _, args = header.decode().strip().partition(' ')
+    trfx = sys.stdin.buffer.read(int(length)).decode()
+    if args == '-sleep':
+        time.sleep(10)
+    if args == '-fail':
+        body = b'bad input'
+        sys.stdout.buffer.write(b'ERR %d\\n' % len(body) + body)
+    elif args == '-empty':
+        sys.stdout.buffer.write(b'OK 0\\n')
+    else:
+        count = len([line for line in trfx.splitlines() if line.startswith('001')])
+        body = ('%d\\n' % (count // 2) + ''.join('%d %d\\n' % (n, n + 1) for n in range(1, count, 2))).encode()
+        sys.stdout.buffer.write(b'OK %d\\n' % len(body) + body)
+    sys.stdout.buffer.flush()
+'''
+
+def javafo_players(count, scores=None):
+    return [JavafoPlayer('p%d' % n, scores[n - 1] if scores else 0, []) for n in range(1, count + 1)]
+
+class PairingEngineTestCase(SimpleTestCase):
+    def test_stub_engine(self):
+        players = javafo_players(5, [1, 0, 0.5, 0.5, 1])
+        players[0].pairings = [JavafoPairing('p2', 'white', 1)]
+        players[1].pairings = [JavafoPairing('p1', 'black', 0)]
+        players[2].pairings = [JavafoPairing('p4', 'white', 0.5)]
+        players[3].pairings = [JavafoPairing('p3', 'black', 0.5)]
+        players[4].pairings = [JavafoPairing(None, None, 1, forfeit=True)]
+        pairs = JavafoInstance(3, players).run(StubPairingEngine())
+        self.assertEqual([['p1', 'p5'], ['p3', 'p2'], ['p4', None]], pairs)
+
+    def test_process_engine_without_output(self):
+        # javafo exiting cleanly without writing its output file is an error, not an empty round
+        with self.assertRaises(PairingGenerationException):
+            JavafoProcessEngine('true', timeout=5).pair('001    1')
+
+    def test_daemon_engine(self):
+        engine = JavafoDaemonEngine('%s -c "%s"' % (sys.executable, FAKE_DAEMON.replace('"', '\\"')), timeout=5)
+        try:
+            pairs = JavafoInstance(3, javafo_players(4)).run(engine)
+            self.assertEqual([['p1', 'p2'], ['p3', 'p4']], pairs)
+            # The process is reused between requests
+            proc = engine._proc
+            self.assertEqual(pairs, JavafoInstance(3, javafo_players(4)).run(engine))
+            self.assertIs(proc, engine._proc)
+
+            with self.assertRaises(PairingGenerationException):
+                engine.pair('001    1', '-fail')
+            self.assertIs(proc, engine._proc)
+            with self.assertRaises(PairingGenerationException):
+                engine.pair('001    1', '-empty')
+
+            # A timeout kills the daemon; the next request starts a new one
+            engine.timeout = 0.5
+            with self.assertRaises(PairingGenerationException):
+                engine.pair('001    1', '-sleep')
+            self.assertIsNone(engine._proc)
+            engine.timeout = 5
+            self.assertEqual(pairs, JavafoInstance(3, javafo_players(4)).run(engine))
+        finally:
+            engine.stop()
+
+class GeneratePairingsTestCase(TestCase):
+    def setUp(self):
+        createCommonLeagueData()
+
+    @patch.object(pairinggen, 'get_pairing_engine', return_value=StubPairingEngine())
+    def test_generate_lone_pairings(self, _):
+        season = Season.objects.get(tag='loneseason')
+        for n, sp in enumerate(season.seasonplayer_set.all()):
+            sp.seed_rating = 1500 + n
+            sp.save()
+        round1 = season.round_set.get(number=1)
+
+        pairinggen.generate_pairings(round1)
+        pairings = list(round1.loneplayerpairing_set.all())
+        self.assertEqual(4, len(pairings))
+        paired_players = [p.white for p in pairings] + [p.black for p in pairings]
+        self.assertEqual(8, len(set(paired_players)))
+        # Each subclass row points to its own PlayerPairing row
+        self.assertEqual(sorted(p.pk for p in pairings),
+                         sorted(PlayerPairing.objects.filter(loneplayerpairing__round=round1).values_list('pk', flat=True)))
+
+    def test_generate_native_pairings(self):
+        season = Season.objects.get(tag='loneseason')
+        season.league.pairing_type = 'swiss-dutch-native'
+        season.league.save()
+        round1 = season.round_set.get(number=1)
+
+        pairinggen.generate_pairings(round1)
+        pairings = list(round1.loneplayerpairing_set.order_by('pairing_order'))
+        self.assertEqual(4, len(pairings))
+        paired_players = [p.white for p in pairings] + [p.black for p in pairings]
+        self.assertEqual(8, len(set(paired_players)))
+
+    @patch.object(pairinggen, 'get_pairing_engine', return_value=StubPairingEngine())
+    def test_generate_team_pairings(self, _):
+        season = Season.objects.get(tag='teamseason')
+        round1 = season.round_set.get(number=1)
+        team1 = Team.objects.get(season=season, number=1)
+        replaced = TeamMember.objects.get(team=team1, board_number=2).player
+        alternate = Player.objects.create(user=User.objects.create_user('Alternate', password='test'))
+        AlternateAssignment.objects.create(round=round1, team=team1, board_number=2, player=alternate, replaced_player=replaced)
+        revision_count = Revision.objects.count()
+
+        pairinggen.generate_pairings(round1)
+        team_pairings = list(round1.teampairing_set.order_by('pairing_order'))
+        self.assertEqual(2, len(team_pairings))
+        player_pairings = list(TeamPlayerPairing.objects.filter(team_pairing__round=round1))
+        self.assertEqual(4, len(player_pairings))
+        players = [p.white for p in player_pairings] + [p.black for p in player_pairings]
+        self.assertIn(alternate, players)
+        self.assertNotIn(replaced, players)
+        # The whole run is recorded as one revision
+        self.assertEqual(revision_count + 1, Revision.objects.count())
+        revision = Revision.objects.latest('pk')
+        self.assertEqual('Generated pairings.', revision.comment)
+        self.assertEqual(4, revision.version_set.get_for_model(TeamPlayerPairing).count())
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_dry_run(self):
+        class CountingEngine(StubPairingEngine):
+            calls = 0
+
+            def pair(self, trfx, args=''):
+                CountingEngine.calls += 1
+                return super(CountingEngine, self).pair(trfx, args)
+
+        season = Season.objects.get(tag='loneseason')
+        round1 = season.round_set.get(number=1)
+        with patch.object(pairinggen, 'get_pairing_engine', return_value=CountingEngine()), \
+             patch.object(settings, 'PAIRING_RESULT_CACHE_TIMEOUT', 60):
+            pairings, byes = pairinggen.generate_pairings(round1, dry_run=True)
+            self.assertEqual(4, len(pairings))
+            self.assertEqual([], byes)
+            self.assertEqual(0, round1.loneplayerpairing_set.count())
+
+            # Generating the same pairings reuses the engine result
+            pairinggen.generate_pairings(round1)
+            self.assertEqual(1, CountingEngine.calls)
+            self.assertEqual([(p.white, p.black) for p in pairings],
+                             [(p.white, p.black) for p in round1.loneplayerpairing_set.order_by('pairing_order')])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_incomplete_output_not_cached(self):
+        class FlakyEngine(StubPairingEngine):
+            outputs = ['', '0\n', '1\n1 2\n']
+
+            def pair(self, trfx, args=''):
+                return self.outputs.pop(0)
+
+        trfx = JavafoInstance(3, javafo_players(2))._write_trfx()
+        engine = FlakyEngine()
+        with patch.object(settings, 'PAIRING_RESULT_CACHE_TIMEOUT', 60):
+            # Empty or failed output is tried again, a complete result is reused
+            self.assertEqual('', pairinggen._cached_pair(engine, trfx, '-q 10000'))
+            self.assertEqual('0\n', pairinggen._cached_pair(engine, trfx, '-q 10000'))
+            self.assertEqual('1\n1 2\n', pairinggen._cached_pair(engine, trfx, '-q 10000'))
+            self.assertEqual('1\n1 2\n', pairinggen._cached_pair(engine, trfx, '-q 10000'))
+        self.assertTrue(pairinggen._is_complete_output(JavafoInstance(3, javafo_players(1))._write_trfx(), '0\n'))
@@ -0,0 +1,50 @@
+from datetime import timedelta
+from unittest.mock import patch
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+from heltour.tournament import ratings
+from heltour.tournament.models import *
+from heltour.tournament.tests.test_models import createCommonLeagueData
+from heltour.tournament.tests.test_tasks import game_meta
+
+class SeasonRatingTimelineTestCase(TestCase):
+    def setUp(self):
+        createCommonLeagueData()
+        cache.delete_pattern('post_game_ratings-*')
+        self.season = Season.objects.select_related('league').get(tag='loneseason')
+        self.now = timezone.now()
+        self.rounds = list(self.season.round_set.order_by('number'))
+        for n, round_ in enumerate(self.rounds):
+            Round.objects.filter(pk=round_.pk).update(end_date=self.now + timedelta(days=7 * n))
+        self.players = [sp.player for sp in self.season.seasonplayer_set.order_by('player__lichess_username')]
+        for n, (white, black, game_id) in enumerate([(0, 1, 'game0001'), (2, 0, 'game0002')]):
+            pairing = LonePlayerPairing.objects.create(round=self.rounds[n], pairing_order=0, white=self.players[white],
+                                                       black=self.players[black], result='1-0',
+                                                       game_link=get_gamelink_from_gameid(game_id))
+            PlayerPairing.objects.filter(pk=pairing.pk).update(white_rating=1500 + n, black_rating=1600 + n)
+
+    def test_closest(self):
+        with self.assertNumQueries(2):
+            timeline = ratings.SeasonRatingTimeline(self.season)
+        with self.assertNumQueries(0):
+            player_id = self.players[0].pk
+            game, after_game = timeline.closest(player_id, self.now - timedelta(days=1))
+            self.assertEqual(('game0001', False), (game.game_id, after_game))
+            game, after_game = timeline.closest(player_id, self.now + timedelta(days=8))
+            self.assertEqual(('game0002', 'black', True), (game.game_id, game.color, after_game))
+            self.assertEqual(1601, game.rating)
+            self.assertIsNone(timeline.closest(self.players[3].pk, self.now))
+
+    def test_post_game_ratings(self):
+        timeline = ratings.SeasonRatingTimeline(self.season)
+        metas = [game_meta('game0001', 1500, 1600, white_diff=-7)]
+        with patch.object(ratings.lichessapi, 'enumerate_game_metas', return_value=metas) as enumerate_game_metas:
+            self.assertEqual(1493, timeline.rating(self.players[0], self.now))
+            # A game lichess didn't return falls back to the rating before the game
+            self.assertEqual(1501, timeline.rating(self.players[2], self.now + timedelta(days=7)))
+            # Each game is only fetched once
+            self.assertEqual(1493, timeline.rating(self.players[0], self.now))
+            self.assertEqual(1600, timeline.rating(self.players[1], self.now))
+        self.assertEqual([(['game0001'],), (['game0002'],)],
+                         [call[0] for call in enumerate_game_metas.call_args_list])
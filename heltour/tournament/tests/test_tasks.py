@@ -0,0 +1,146 @@
+from datetime import timedelta
+from unittest.mock import patch
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+from heltour.tournament import tasks
+from heltour.tournament.models import *
+from heltour.tournament.tests.test_models import createCommonLeagueData
+
+def game_meta(game_id, white_rating, black_rating, white_diff=None):
+    white = {'rating': white_rating}
+    if white_diff is not None:
+        white['ratingDiff'] = white_diff
+    return {'id': game_id, 'players': {'white': white, 'black': {'rating': black_rating}}}
+
+class PopulateHistoricalRatingsTestCase(TestCase):
+    def setUp(self):
+        createCommonLeagueData()
+        cache.delete(tasks._HISTORICAL_RATINGS_CURSOR_KEY)
+        cache.delete_pattern('post_game_ratings-*')
+        self.season = Season.objects.get(tag='loneseason')
+        self.rounds = list(self.season.round_set.order_by('number'))
+        now = timezone.now()
+        for n, round_ in enumerate(self.rounds):
+            Round.objects.filter(pk=round_.pk).update(end_date=now + timedelta(days=7 * n), is_completed=True)
+        self.players = [sp.player for sp in self.season.seasonplayer_set.order_by('player__lichess_username')]
+        self.metas = {'game0001': game_meta('game0001', 1500, 1600, white_diff=12),
+                      'game0002': game_meta('game0002', 1700, 1800)}
+        self.requested = []
+
+    def enumerate_game_metas(self, game_ids, **kwargs):
+        self.requested.append(sorted(game_ids))
+        return [self.metas[game_id] for game_id in game_ids if game_id in self.metas]
+
+    def pairing(self, round_, white, black, game_id=None):
+        return LonePlayerPairing.objects.create(round=round_, pairing_order=0, white=white, black=black, result='1-0',
+                                                game_link=get_gamelink_from_gameid(game_id) if game_id else '')
+
+    def test_populate(self):
+        p1 = self.pairing(self.rounds[0], self.players[0], self.players[1], 'game0001')
+        p2 = self.pairing(self.rounds[1], self.players[0], self.players[2])
+        Season.objects.filter(pk=self.season.pk).update(is_completed=True)
+        with patch.object(tasks.lichessapi, 'enumerate_game_metas', side_effect=self.enumerate_game_metas):
+            tasks.populate_historical_ratings()
+        p1.refresh_from_db()
+        self.assertEqual((1500, 1600), (p1.white_rating, p1.black_rating))
+        p2.refresh_from_db()
+        # The rating after the player's previous game, and the current rating of a player without any games
+        self.assertEqual(1512, p2.white_rating)
+        self.assertEqual(self.players[2].rating_for(self.season.league), p2.black_rating)
+        # The final rating is the one after the last game
+        self.assertEqual(1600, SeasonPlayer.objects.get(season=self.season, player=self.players[1]).final_rating)
+        # The post-game rating was remembered when the game was first fetched
+        self.assertEqual([['game0001']], self.requested)
+
+    def test_one_sided_forfeit(self):
+        # A forfeit against an empty slot leaves that side's rating empty without stopping the other lookups
+        p1 = self.pairing(self.rounds[0], self.players[0], self.players[1], 'game0001')
+        forfeit = self.pairing(self.rounds[1], self.players[0], None)
+        Round.objects.filter(pk=self.rounds[1].pk).update(publish_pairings=True)
+        bye = PlayerBye.objects.create(round=self.rounds[1], player=self.players[1], type='full-point-bye')
+        with patch.object(tasks.lichessapi, 'enumerate_game_metas', side_effect=self.enumerate_game_metas):
+            tasks.populate_historical_ratings()
+        forfeit.refresh_from_db()
+        self.assertEqual((1512, None), (forfeit.white_rating, forfeit.black_rating))
+        bye.refresh_from_db()
+        self.assertEqual(1600, bye.player_rating)
+
+    def test_resume(self):
+        pairings = [self.pairing(self.rounds[0], self.players[0], self.players[1], 'game0001'),
+                    self.pairing(self.rounds[0], self.players[2], self.players[3], 'gamemiss'),
+                    self.pairing(self.rounds[1], self.players[2], self.players[3], 'game0002')]
+        with patch.object(tasks, '_HISTORICAL_RATINGS_GAMES_PER_RUN', 2), \
+             patch.object(tasks.lichessapi, 'enumerate_game_metas', side_effect=self.enumerate_game_metas):
+            tasks.populate_historical_ratings()
+            self.assertEqual(pairings[1].pk, cache.get(tasks._HISTORICAL_RATINGS_CURSOR_KEY))
+            # The next run carries on after the game lichess didn't return
+            tasks.populate_historical_ratings()
+        self.assertEqual([['game0001', 'gamemiss'], ['game0002']], self.requested[:2])
+        self.assertIsNone(cache.get(tasks._HISTORICAL_RATINGS_CURSOR_KEY))
+        ratings = [(p.white_rating, p.black_rating) for p in PlayerPairing.objects.order_by('pk')]
+        self.assertEqual([(1500, 1600), (None, None), (1700, 1800)], ratings)
+
+class GameFinishedTestCase(TestCase):
+    def setUp(self):
+        createCommonLeagueData()
+        season = Season.objects.get(tag='loneseason')
+        players = [sp.player for sp in season.seasonplayer_set.order_by('player__lichess_username')]
+        patcher = patch.object(tasks.lichessapi, 'add_watch')
+        self.add_watch = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pairing = LonePlayerPairing.objects.create(round=season.round_set.get(number=1), pairing_order=0,
+                                                        white=players[0], black=players[1],
+                                                        game_link=get_gamelink_from_gameid('game0001'))
+        self.add_watch.reset_mock()
+
+    def test_game_finished(self):
+        with patch.object(tasks.lichessapi, 'get_game_meta', return_value={'status': 'mate', 'winner': 'black'}):
+            tasks.game_finished('game0001')
+        self.pairing.refresh_from_db()
+        self.assertEqual(('0-1', 'hide'), (self.pairing.result, self.pairing.tv_state))
+        self.add_watch.assert_not_called()
+
+    def test_stream_cut_off(self):
+        # A game that's still going is watched again
+        with patch.object(tasks.lichessapi, 'get_game_meta', return_value={'status': 'started'}):
+            tasks.game_finished('game0001')
+        self.pairing.refresh_from_db()
+        self.assertEqual(('', 'default'), (self.pairing.result, self.pairing.tv_state))
+        self.add_watch.assert_called_once_with('game0001')
+
+        # Games that aren't being shown are left alone
+        with patch.object(tasks.lichessapi, 'get_game_meta') as get_game_meta:
+            tasks.game_finished('othergam')
+        get_game_meta.assert_not_called()
+
+    def test_update_tv_state(self):
+        season = Season.objects.get(tag='loneseason')
+        players = [sp.player for sp in season.seasonplayer_set.order_by('player__lichess_username')]
+        other = LonePlayerPairing.objects.create(round=season.round_set.get(number=1), pairing_order=1,
+                                                 white=players[2], black=players[3],
+                                                 game_link=get_gamelink_from_gameid('game0002'))
+        requested = []
+
+        async def get_game_meta_async(gameid, **kwargs):
+            requested.append(gameid)
+            return {'status': 'mate', 'winner': 'white'}
+
+        # Every game in progress is watched again; only the ones the API worker can't stream are polled
+        with patch.object(tasks.lichessapi, 'add_watches', return_value=['game0002']) as add_watches, \
+             patch.object(tasks.lichessapi, 'get_game_meta_async', side_effect=get_game_meta_async):
+            tasks.update_tv_state()
+        add_watches.assert_called_once_with(['game0001', 'game0002'])
+        self.assertEqual(['game0002'], requested)
+        other.refresh_from_db()
+        self.assertEqual('1-0', other.result)
+        self.pairing.refresh_from_db()
+        self.assertEqual('', self.pairing.result)
+
+        # The safety net polls the streamed games too (game0002 has finished by now)
+        with patch.object(tasks.lichessapi, 'add_watches', return_value=[]), \
+             patch.object(tasks.lichessapi, 'get_game_meta_async', side_effect=get_game_meta_async):
+            tasks.update_tv_state(True)
+        self.assertEqual(['game0002', 'game0001'], requested)
+        self.pairing.refresh_from_db()
+        self.assertEqual('1-0', self.pairing.result)
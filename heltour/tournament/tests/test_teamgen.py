@@ -0,0 +1,210 @@
+import random
+from unittest.mock import patch
+from datetime import timedelta
+from django.utils import timezone
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase, override_settings
+from heltour import settings
+from heltour.tournament import teamgen, tasks
+from heltour.tournament.models import League, Season, Player, SeasonPlayer, Team, Alternate
+from heltour.tournament.tests.test_models import create_reg
+
+def player_data(count, seed):
+    rnd = random.Random(seed)
+    names = ['player%d' % n for n in range(count)]
+    return [{
+        'name': name,
+        'rating': rnd.randint(1000, 2400),
+        'has_20_games': True,
+        'in_slack': True,
+        'friends': ' '.join(rnd.sample(names, rnd.choice([0, 1, 2, 3]))),
+        'avoid': ' '.join(rnd.sample(names, rnd.choice([0, 0, 1]))),
+        'date_created': '2019-01-%02d' % rnd.randint(1, 28),
+        'prefers_alt': False,
+    } for name in names]
+
+class TeamgenTestCase(SimpleTestCase):
+    def test_swap_pref_change(self):
+        random.seed(4545)
+        league = teamgen.make_league(player_data(60, 1), 6, 0.8)
+        players, teams = league['players'], league['teams']
+        league_arrays = teamgen.LeagueArrays(teams)
+        rnd = random.Random(1)
+        for _ in range(200):
+            board = rnd.randrange(6)
+            teama, teamb = rnd.sample(teams, 2)
+            playera, playerb = teama.get_player(board), teamb.get_player(board)
+            delta = league_arrays.swap_pref_change(playera.id, playerb.id)
+
+            # Compare to actually making the swap and recalculating everything
+            prior_pref = teamgen.total_happiness(teams)
+            league_arrays.swap(playera.id, playerb.id)
+            self.assertIs(teamb, playera.team)
+            self.assertIs(playerb, teama.get_player(board))
+            teamgen.update_pref(players, teams)
+            self.assertEqual(teamgen.total_happiness(teams) - prior_pref, delta)
+
+    def test_make_league(self):
+        random.seed(4545)
+        league = teamgen.make_league(player_data(100, 2), 6, 0.8)
+        teams = league['teams']
+        # The incrementally maintained scores match a full recalculation
+        scores = [team.team_pref_score for team in teams]
+        teamgen.update_pref(league['players'], teams)
+        self.assertEqual([team.team_pref_score for team in teams], scores)
+        self.assertEqual(len(league['players']), sum(len(team.boards) for team in teams))
+
+    def test_reduce_variance(self):
+        random.seed(4545)
+        league = teamgen.make_league(player_data(150, 3), 6, 0.8)
+        teams = league['teams']
+        happiness = teamgen.total_happiness(teams)
+        rating_range = teamgen.team_rating_range(teams)
+
+        teamgen.reduce_variance(teams)
+        teamgen.update_pref(league['players'], teams)
+        self.assertEqual(happiness, teamgen.total_happiness(teams))
+        self.assertLess(teamgen.team_rating_range(teams), rating_range)
+        for team in teams:
+            for board, player in enumerate(team.boards):
+                self.assertIs(team, player.team)
+                self.assertEqual(board, player.board)
+
+    def test_league_search(self):
+        data = player_data(80, 4)
+
+        def lineups(league):
+            return [[p.name for p in team.boards] for team in league['teams']]
+
+        with teamgen.LeagueSearch(data, 6, 0.8, processes=1) as search:
+            league = search.best_league(6, seed=1)
+            self.assertEqual(lineups(league), lineups(search.best_league(6, seed=1)))
+        # The result doesn't depend on the number of worker processes, and the pool is reused between searches
+        with teamgen.LeagueSearch(data, 6, 0.8, processes=2) as search:
+            self.assertEqual(lineups(league), lineups(search.best_league(6, seed=1)))
+            pool = search._pool
+            search.best_league(2, seed=2, max_happy_leagues=1)
+            self.assertIs(pool, search._pool)
+        self.assertIsNone(search._pool)
+
+    def test_resolved_requests(self):
+        data = player_data(80, 5)
+        ids = {p['name']: n for n, p in enumerate(data)}
+        for p in data:
+            p['id'] = ids[p['name']]
+            p['friend_ids'] = teamgen.resolve_names(p['friends'].upper(), ids)
+            p['avoid_ids'] = teamgen.resolve_names(p['avoid'], ids)
+
+        def requests(league):
+            return [([f.name for f in p.friends], [a.name for a in p.avoid]) for p in league['players']]
+
+        # Player ids resolved up front give the same requests as the free text
+        random.seed(4545)
+        league = teamgen.make_league(data, 6, 0.8)
+        for p in data:
+            del p['friend_ids'], p['avoid_ids']
+        random.seed(4545)
+        self.assertEqual(requests(league), requests(teamgen.make_league(data, 6, 0.8)))
+
+    def test_anneal_league(self):
+        data = player_data(90, 6)
+
+        def anneal(progress=None):
+            rng = random.Random(3)
+            league = teamgen.make_league(data, 6, 0.8, rng=rng)
+            teamgen.reduce_variance(league['teams'])
+            start_cost = teamgen.league_cost(teamgen.total_happiness(league['teams']),
+                                             teamgen.team_rating_range(league['teams']),
+                                             teamgen.team_rating_variance(league['teams']))
+            return start_cost, teamgen.anneal_league(league, 60, rng=rng, max_iterations=3000, progress=progress)
+
+        reports = []
+        start_cost, league = anneal(reports.append)
+        teams = league['teams']
+        happiness = teamgen.total_happiness(teams)
+        teamgen.update_pref(league['players'], teams)
+        self.assertEqual(happiness, teamgen.total_happiness(teams))
+        final = reports[-1]
+        self.assertEqual(3000, final.iterations)
+        self.assertEqual(happiness, final.best_happiness)
+        self.assertAlmostEqual(teamgen.team_rating_range(teams), final.best_rating_range)
+        self.assertAlmostEqual(final.best_cost, teamgen.league_cost(happiness, teamgen.team_rating_range(teams),
+                                                                    teamgen.team_rating_variance(teams)))
+        self.assertLess(final.best_cost, start_cost)
+        for team in teams:
+            for board, player in enumerate(team.boards):
+                self.assertIs(team, player.team)
+                self.assertEqual(board, player.board)
+
+        # The same rng and iteration count give the same league
+        _, league2 = anneal()
+        self.assertEqual([[p.name for p in team.boards] for team in teams],
+                         [[p.name for p in team.boards] for team in league2['teams']])
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   TEAMGEN_PROCESSES_NUMBER=1)
+class CreateTeamsTaskTestCase(TestCase):
+    def setUp(self):
+        league = League.objects.create(name='Team League', tag='teamleague', competitor_type='team', rating_type='classical')
+        self.season = Season.objects.create(league=league, name='Test Season', tag='teamseason', rounds=3, boards=2,
+                                            start_date=timezone.now())
+        for n, data in enumerate(player_data(12, 8)):
+            user = User.objects.create_user(data['name'], password='test')
+            player = Player.objects.create(user=user, slack_user_id='U%d' % n,
+                                           profile={'perfs': {'classical': {'rating': data['rating'], 'prov': False}}})
+            reg = create_reg(self.season, user)
+            reg.friends = data['friends']
+            reg.save()
+            SeasonPlayer.objects.create(season=self.season, player=player, registration=reg)
+        self.options = {'optimizer': 'search', 'balance': 0.5, 'count': 5, 'time_limit': 1, 'seed': 1,
+                        'max_happy_leagues': None}
+
+    def lineups(self):
+        return [[m.player.lichess_username for m in team.teammember_set.order_by('board_number')]
+                for team in Team.objects.filter(season=self.season).order_by('number')]
+
+    def test_create_teams(self):
+        tasks.create_teams(self.season.pk, self.options)
+        progress = self.season.create_teams_progress()
+        self.assertEqual('done', progress['status'])
+        self.assertEqual('Teams created', progress['detail'])
+        lineups = self.lineups()
+        self.assertEqual(4, len(lineups))
+        self.assertEqual(lineups, [[name for name, _ in team] for team in progress['lineup']])
+        self.assertEqual(4, Alternate.objects.filter(season_player__season=self.season).count())
+
+        # The same inputs reuse the previous result
+        Team.objects.filter(season=self.season).delete()
+        with patch.object(teamgen.LeagueSearch, 'best_league') as best_league:
+            tasks.create_teams(self.season.pk, self.options)
+        best_league.assert_not_called()
+        self.assertEqual('Teams created from a previous result', self.season.create_teams_progress()['detail'])
+        self.assertEqual(lineups, self.lineups())
+
+    def test_create_teams_without_seed(self):
+        options = dict(self.options, seed=None)
+        tasks.create_teams(self.season.pk, options)
+        # Runs without a seed aren't reused
+        with patch.object(teamgen.LeagueSearch, 'best_league', side_effect=Exception('searched')):
+            with self.assertRaisesMessage(Exception, 'searched'):
+                tasks.create_teams(self.season.pk, options)
+        self.assertEqual('error', self.season.create_teams_progress()['status'])
+
+    def test_superseded_job(self):
+        self.season.set_create_teams_progress('queued', task_id='new')
+        tasks.create_teams.apply(args=[self.season.pk, self.options], task_id='old')
+        self.assertEqual('queued', self.season.create_teams_progress()['status'])
+        self.assertFalse(Team.objects.filter(season=self.season).exists())
+
+        tasks.create_teams.apply(args=[self.season.pk, self.options], task_id='new')
+        progress = self.season.create_teams_progress()
+        self.assertEqual('done', progress['status'])
+        self.assertEqual('new', progress['task_id'])
+
+    @patch.object(settings, 'CREATE_TEAMS_STALE_TIMEOUT', 60)
+    def test_stale_job(self):
+        self.season.set_create_teams_progress('queued', task_id='lost')
+        progress = self.season.create_teams_progress()
+        self.assertTrue(self.season.create_teams_in_progress(progress))
+        with patch('django.utils.timezone.now', return_value=timezone.now() + timedelta(seconds=61)):
+            self.assertFalse(self.season.create_teams_in_progress(progress))
@@ -0,0 +1,113 @@
+import random
+from math import isnan
+from django.test import SimpleTestCase
+from heltour.tournament.models import PerfRatingCalc
+from heltour.tournament.tiebreaks import LoneResults, standings_order
+
+def reference_standings(player_ids, rounds, seed_ratings):
+    # A direct port of the list-based calculation previously in Season._calculate_lone_scores
+    # rounds is a list of {player_id: (opponent_id, score, played)}
+    score_dict = {}
+    for n, round_results in enumerate(rounds, 1):
+        for player_id in player_ids:
+            round_opponent, round_score, round_played = round_results.get(player_id, (None, 0, False))
+            total, mm_total, cumul, perf, _, _ = score_dict[(player_id, n - 1)] if n > 1 else (0, 0, 0, PerfRatingCalc(), None, False)
+            total += round_score
+            cumul += total
+            if round_played:
+                mm_total += round_score
+                opp_rating = seed_ratings.get(round_opponent, None)
+                if opp_rating is not None:
+                    perf.add_game(round_score, opp_rating)
+            else:
+                mm_total += 0.5
+                cumul -= round_score
+            score_dict[(player_id, n)] = (total, mm_total, cumul, perf, round_opponent, round_played)
+
+    last = len(rounds)
+    result = {}
+    for player_id in player_ids:
+        total, _, cumul, perf, _, _ = score_dict[(player_id, last)]
+        opponent_scores = []
+        opponent_cumuls = []
+        for n in range(1, last + 1):
+            _, _, _, _, round_opponent, round_played = score_dict[(player_id, n)]
+            if round_played and round_opponent is not None:
+                opponent_scores.append(score_dict[(round_opponent, last)][1])
+                opponent_cumuls.append(score_dict[(round_opponent, last)][2])
+            else:
+                opponent_scores.append(0)
+        opponent_scores.sort()
+        median_scores = opponent_scores
+        skip = 2 if last >= 9 else 1
+        if total <= last / 2.0:
+            median_scores = median_scores[:-skip]
+        if total >= last / 2.0:
+            median_scores = median_scores[skip:]
+        result[player_id] = (total, sum(median_scores), sum(opponent_scores), cumul, sum(opponent_cumuls), perf.calculate())
+    return result
+
+def random_season(rnd, player_count, round_count):
+    player_ids = list(range(100, 100 + player_count))
+    seed_ratings = {p: rnd.choice([None, rnd.randint(1000, 2400)]) if rnd.random() < 0.1 else rnd.randint(1000, 2400) for p in player_ids}
+    rounds = []
+    for _ in range(round_count):
+        round_results = {}
+        shuffled = list(player_ids)
+        rnd.shuffle(shuffled)
+        absent = shuffled[:rnd.randint(0, 3)]
+        for p in absent:
+            if rnd.random() < 0.7:
+                round_results[p] = (None, rnd.choice([0, 0.5, 1]), False)
+        paired = shuffled[len(absent):]
+        for white, black in zip(paired[::2], paired[1::2]):
+            if rnd.random() < 0.1:
+                # Forfeit
+                white_score = rnd.choice([0, 1])
+                played = False
+            else:
+                white_score = rnd.choice([0, 0.5, 1])
+                played = True
+            round_results[white] = (black, white_score, played)
+            round_results[black] = (white, 1 - white_score, played)
+        rounds.append(round_results)
+    return player_ids, rounds, seed_ratings
+
+class TiebreaksTestCase(SimpleTestCase):
+    def test_matches_reference(self):
+        rnd = random.Random(4545)
+        for _ in range(40):
+            player_count = rnd.randint(2, 40)
+            round_count = rnd.randint(1, 11)
+            player_ids, rounds, seed_ratings = random_season(rnd, player_count, round_count)
+
+            results = LoneResults(player_ids, round_count)
+            for round_index, round_results in enumerate(rounds):
+                for player_id, (opponent_id, score, played) in round_results.items():
+                    results.set_result(round_index, player_id, score, opponent_id, played)
+            standings = results.standings(seed_ratings)
+
+            expected = reference_standings(player_ids, rounds, seed_ratings)
+            for i, player_id in enumerate(player_ids):
+                perf_rating = standings.perf_rating[i]
+                actual = (standings.points[i], standings.tiebreak1[i], standings.tiebreak2[i],
+                          standings.tiebreak3[i], standings.tiebreak4[i], None if isnan(perf_rating) else int(perf_rating))
+                self.assertEqual(expected[player_id], actual)
+
+            order = [player_ids[i] for i in standings_order(standings, ratings=[seed_ratings[p] for p in player_ids])]
+            expected_order = sorted(player_ids, key=lambda p: expected[p][:5] + (seed_ratings[p] or 0,), reverse=True)
+            self.assertEqual(expected_order, order)
+
+    def test_what_if(self):
+        results = LoneResults([1, 2, 3, 4], 2)
+        results.set_game(0, 1, 2, 1, 0)
+        results.set_game(0, 3, 4, 0.5, 0.5)
+        results.set_game(1, 3, 1, 0, 1)
+
+        what_if = results.copy()
+        what_if.set_game(1, 4, 2, 1, 0)
+        self.assertEqual([2, 0, 0.5, 1.5], list(what_if.standings().points))
+        self.assertEqual([1, 4, 3, 2], [what_if.player_ids[i] for i in standings_order(what_if.standings())])
+
+        # The original results are unchanged
+        self.assertEqual([2, 0, 0.5, 0.5], list(results.standings().points))
@@ -0,0 +1,143 @@
+'''
+Score and tiebreak calculations for lone seasons.
+
+These operate on NumPy arrays for the whole field at once and don't touch the database, so they can also
+be used to compute hypothetical standings (e.g. "what if this game ends in a draw").
+'''
+
+from collections import namedtuple
+import numpy as np
+
+NO_OPPONENT = -1
+
+# From https://www.fide.com/component/handbook/?id=174&view=article
+# Used for performance rating calculations
+fide_dp_lookup = [-800, -677, -589, -538, -501, -470, -444, -422, -401, -383, -366, -351, -336, -322, -309, -296, -284, -273, -262, -251,
+                   - 240, -230, -220, -211, -202, -193, -184, -175, -166, -158, -149, -141, -133, -125, -117, -110, -102, -95, -87, -80, -72,
+                   - 65, -57, -50, -43, -36, -29, -21, -14, -7, 0, 7, 14, 21, 29, 36, 43, 50, 57, 65, 72, 80, 87, 95, 102, 110, 117, 125, 133,
+                   141, 149, 158, 166, 175, 184, 193, 202, 211, 220, 230, 240, 251, 262, 273, 284, 296, 309, 322, 336, 351, 366, 383, 401,
+                   422, 444, 470, 501, 538, 589, 677, 800]
+_fide_dp_array = np.array(fide_dp_lookup)
+
+PERF_RATING_MIN_GAMES = 5
+
+LoneStandings = namedtuple('LoneStandings', 'points, tiebreak1, tiebreak2, tiebreak3, tiebreak4, perf_rating')
+
+#-------------------------------------------------------------------------------
+class LoneResults(object):
+    '''A player x round matrix of results.
+
+    scores -- the points each player got in each round (including byes and forfeits)
+    opponents -- the row index of each player's opponent in each round, or NO_OPPONENT
+    played -- whether the game was actually played (as opposed to a bye, forfeit, etc.)
+    '''
+
+    def __init__(self, player_ids, round_count):
+        self.player_ids = list(player_ids)
+        self.index = {player_id: i for i, player_id in enumerate(self.player_ids)}
+        shape = (len(self.player_ids), round_count)
+        self.scores = np.zeros(shape)
+        self.opponents = np.full(shape, NO_OPPONENT, dtype=int)
+        self.played = np.zeros(shape, dtype=bool)
+
+    def set_result(self, round_index, player_id, score, opponent_id=None, played=False):
+        i = self.index[player_id]
+        self.scores[i, round_index] = score
+        self.opponents[i, round_index] = self.index.get(opponent_id, NO_OPPONENT)
+        self.played[i, round_index] = played
+
+    def set_game(self, round_index, white_id, black_id, white_score, black_score, played=True):
+        self.set_result(round_index, white_id, white_score, black_id, played)
+        self.set_result(round_index, black_id, black_score, white_id, played)
+
+    def copy(self):
+        other = LoneResults.__new__(LoneResults)
+        other.player_ids = list(self.player_ids)
+        other.index = dict(self.index)
+        other.scores = self.scores.copy()
+        other.opponents = self.opponents.copy()
+        other.played = self.played.copy()
+        return other
+
+    def standings(self, seed_ratings=None):
+        '''Returns a LoneStandings of arrays indexed like player_ids.
+
+        seed_ratings -- optional dict of player_id -> seed rating, used for performance ratings
+        '''
+        ratings = None
+        if seed_ratings is not None:
+            ratings = np.array([seed_ratings.get(player_id, np.nan) for player_id in self.player_ids], dtype=float)
+        return lone_standings(self.scores, self.opponents, self.played, ratings)
+
+#-------------------------------------------------------------------------------
+def lone_standings(scores, opponents, played, seed_ratings=None):
+    '''Calculates points, tiebreaks and performance ratings for the whole field.
+
+    scores, opponents, played -- player x round arrays (see LoneResults)
+    seed_ratings -- optional array of seed ratings per player, NaN if unknown
+
+    The perf_rating array is NaN for players without enough rated games.
+    '''
+    scores = np.asarray(scores, dtype=float)
+    opponents = np.asarray(opponents, dtype=int)
+    played = np.asarray(played, dtype=bool)
+    player_count, round_count = scores.shape
+
+    points = scores.sum(axis=1)
+    # Unplayed games count as draws when calculating the player's score for opponent tiebreaks
+    mm_total = np.where(played, scores, 0.5).sum(axis=1)
+    # Unplayed rounds don't add to the cumulative score
+    cumul = np.cumsum(scores, axis=1).sum(axis=1) - np.where(played, 0, scores).sum(axis=1)
+
+    has_opponent = played & (opponents != NO_OPPONENT)
+    opp = np.where(has_opponent, opponents, 0)
+    opponent_scores = np.where(has_opponent, mm_total[opp], 0)
+    opponent_cumuls = np.where(has_opponent, cumul[opp], 0)
+
+    # TB1: Modified Median
+    sorted_scores = np.sort(opponent_scores, axis=1)
+    skip = 2 if round_count >= 9 else 1
+    keep = np.ones(sorted_scores.shape, dtype=bool)
+    drop_top = points <= round_count / 2.0
+    drop_bottom = points >= round_count / 2.0
+    keep[drop_top, max(round_count - skip, 0):] = False
+    keep[drop_bottom, :skip] = False
+    tiebreak1 = np.where(keep, sorted_scores, 0).sum(axis=1)
+
+    # TB2: Solkoff
+    tiebreak2 = opponent_scores.sum(axis=1)
+
+    # TB3: Cumulative
+    tiebreak3 = cumul
+
+    # TB4: Cumulative opponent
+    tiebreak4 = opponent_cumuls.sum(axis=1)
+
+    # Performance rating
+    if seed_ratings is None:
+        perf_rating = np.full(player_count, np.nan)
+    else:
+        seed_ratings = np.asarray(seed_ratings, dtype=float)
+        opp_ratings = np.where(has_opponent, seed_ratings[opp], np.nan)
+        rated = ~np.isnan(opp_ratings)
+        game_count = rated.sum(axis=1)
+        safe_count = np.maximum(game_count, 1)
+        perf_score = np.where(rated, scores, 0).sum(axis=1)
+        average_opp_rating = np.rint(np.where(rated, opp_ratings, 0).sum(axis=1) / safe_count)
+        dp = _fide_dp_array[np.clip(np.rint(100.0 * perf_score / safe_count), 0, 100).astype(int)]
+        perf_rating = np.where(game_count >= PERF_RATING_MIN_GAMES, average_opp_rating + dp, np.nan)
+
+    return LoneStandings(points, tiebreak1, tiebreak2, tiebreak3, tiebreak4, perf_rating)
+
+def standings_order(standings, extra_points=None, ratings=None):
+    '''Returns the player indexes sorted from first place to last.
+
+    extra_points -- optional array added to the points (e.g. late join points for intermediate standings)
+    ratings -- optional array used as the final tiebreak
+    '''
+    points = standings.points if extra_points is None else standings.points + extra_points
+    keys = [points, standings.tiebreak1, standings.tiebreak2, standings.tiebreak3, standings.tiebreak4]
+    if ratings is not None:
+        keys.append(np.nan_to_num(np.asarray(ratings, dtype=float)))
+    # np.lexsort uses the last key as the primary key; the sort is stable, so ties keep their input order
+    return np.lexsort([-k for k in reversed(keys)])
@@ -802,6 +802,8 @@ class RostersView(SeasonView):
 
 class StandingsView(SeasonView):
     def view(self, section=None):
+        # Don't show standings from before a recalculation that's still queued
+        self.season.flush_scores()
         if self.league.competitor_type == 'team':
             return self.team_view()
         else:
@@ -882,24 +884,14 @@ def _lone_player_scores(season, final=False, sort_by_seed=False, include_current
     player_number_dict = {p.season_player.player: n for n, p in player_scores}
 
     pairings = LonePlayerPairing.objects.filter(round__season=season).select_related('white', 'black').nocache()
-    white_pairings_dict = defaultdict(list)
-    black_pairings_dict = defaultdict(list)
-    for p in pairings:
-        if p.white is not None:
-            white_pairings_dict[p.white].append(p)
-        if p.black is not None:
-            black_pairings_dict[p.black].append(p)
-
-    byes = PlayerBye.objects.filter(round__season=season).select_related('round', 'player').nocache()
-    byes_dict = defaultdict(list)
-    for bye in byes:
-        byes_dict[bye.player].append(bye)
+    byes = PlayerBye.objects.filter(round__season=season).nocache()
+    pairing_index = PairingIndex(pairings, byes)
 
     rounds = Round.objects.filter(season=season).order_by('number')
     # rounds = [round_ for round_ in Round.objects.filter(season=season).order_by('number') if round_.is_completed or (include_current and round_.publish_pairings)]
 
     def round_scores(player_score):
-        return list(player_score.round_scores(rounds, player_number_dict, white_pairings_dict, black_pairings_dict, byes_dict, include_current))
+        return list(player_score.round_scores(rounds, player_number_dict, pairing_index, include_current))
 
     return [(n, ps, round_scores(ps)) for n, ps in player_scores]
 
@@ -920,6 +912,7 @@ class CrosstableView(SeasonView):
 
 class WallchartView(SeasonView):
     def view(self):
+        self.season.flush_scores()
         @cached_as(*common_lone_models)
         def _view(league_tag, season_tag, user_data):
             if self.league.competitor_type == 'team':
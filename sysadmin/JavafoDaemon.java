@@ -0,0 +1,123 @@
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.BufferedInputStream;
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.Files;
+import java.nio.file.Path;
+import java.nio.file.Paths;
+import java.security.Permission;
+import java.util.ArrayList;
+import java.util.Arrays;
+import java.util.List;
+import java.util.jar.JarFile;
+
+/**
+ * Keeps javafo loaded in a long-running JVM so that generating pairings doesn't pay the JVM startup cost.
+ * Used by JavafoDaemonEngine in heltour/tournament/pairinggen.py.
+ *
+ * Build: javac -cp javafo.jar JavafoDaemon.java (see build-javafo-daemon.sh)
+ * Run:   java -Djava.security.manager=allow -cp javafo.jar:. JavafoDaemon javafo.jar
+ *
+ * The security manager used to trap System.exit is deprecated; on Java 18+ the JVM refuses to install it unless
+ * started with -Djava.security.manager=allow. Java 12-17 accept the flag; Java 11 and older treat it as a class name
+ * and fail to start, so leave it out there.
+ *
+ * Protocol (stdin/stdout):
+ *   request:  "<length> <javafo args>\n" followed by <length> bytes of TRFX
+ *   response: "OK <length>\n" followed by <length> bytes of the javafo output file
+ *             "ERR <length>\n" followed by <length> bytes of error message
+ */
+public class JavafoDaemon {
+
+    static class ExitTrappedException extends SecurityException {
+        final int status;
+
+        ExitTrappedException(int status) {
+            this.status = status;
+        }
+    }
+
+    public static void main(String[] args) throws Exception {
+        String mainClassName;
+        try (JarFile jar = new JarFile(args[0])) {
+            mainClassName = jar.getManifest().getMainAttributes().getValue("Main-Class");
+        }
+        Method javafoMain = Class.forName(mainClassName).getMethod("main", String[].class);
+
+        // javafo calls System.exit when it's done, which would take down the daemon
+        System.setSecurityManager(new SecurityManager() {
+            @Override
+            public void checkExit(int status) {
+                throw new ExitTrappedException(status);
+            }
+
+            @Override
+            public void checkPermission(Permission perm) {
+            }
+
+            @Override
+            public void checkPermission(Permission perm, Object context) {
+            }
+        });
+
+        PrintStream protocolOut = System.out;
+        DataInputStream in = new DataInputStream(new BufferedInputStream(System.in));
+        String header;
+        while ((header = readLine(in)) != null) {
+            String[] parts = header.trim().split("\\s+");
+            byte[] trfx = new byte[Integer.parseInt(parts[0])];
+            in.readFully(trfx);
+
+            Path input = Files.createTempFile("javafo", ".trfx");
+            Path output = Paths.get(input.toString() + ".out.txt");
+            ByteArrayOutputStream captured = new ByteArrayOutputStream();
+            try {
+                Files.write(input, trfx);
+                List<String> javafoArgs = new ArrayList<>(Arrays.asList(input.toString(), "-p", output.toString()));
+                javafoArgs.addAll(Arrays.asList(parts).subList(1, parts.length));
+
+                // Keep javafo's console output out of the protocol stream
+                System.setOut(new PrintStream(captured, true));
+                try {
+                    javafoMain.invoke(null, (Object) javafoArgs.toArray(new String[0]));
+                } catch (InvocationTargetException e) {
+                    if (!(e.getCause() instanceof ExitTrappedException) || ((ExitTrappedException) e.getCause()).status != 0) {
+                        throw e;
+                    }
+                } finally {
+                    System.setOut(protocolOut);
+                }
+                respond(protocolOut, "OK", Files.exists(output) ? Files.readAllBytes(output) : new byte[0]);
+            } catch (Throwable e) {
+                Throwable cause = e instanceof InvocationTargetException ? e.getCause() : e;
+                respond(protocolOut, "ERR", (cause + "\n" + captured).getBytes(StandardCharsets.UTF_8));
+            } finally {
+                Files.deleteIfExists(input);
+                Files.deleteIfExists(output);
+            }
+        }
+    }
+
+    private static String readLine(InputStream in) throws IOException {
+        ByteArrayOutputStream line = new ByteArrayOutputStream();
+        int c;
+        while ((c = in.read()) != '\n') {
+            if (c == -1) {
+                return line.size() > 0 ? line.toString("UTF-8") : null;
+            }
+            line.write(c);
+        }
+        return line.toString("UTF-8");
+    }
+
+    private static void respond(PrintStream out, String status, byte[] body) throws IOException {
+        out.write((status + " " + body.length + "\n").getBytes(StandardCharsets.UTF_8));
+        out.write(body);
+        out.flush();
+    }
+}
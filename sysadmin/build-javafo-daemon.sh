@@ -0,0 +1,6 @@
+#!/bin/bash
+# Compiles sysadmin/JavafoDaemon.java next to javafo.jar, for JAVAFO_ENGINE = 'daemon' (see heltour/live_settings.py).
+# Run after deploying a new version of JavafoDaemon.java, then restart the heltour services.
+pushd /home/lichess4545/etc/heltour/
+javac -cp /home/lichess4545/etc/heltour/javafo.jar -d /home/lichess4545/etc/heltour/ /home/lichess4545/web/www.lichess4545.com/current/sysadmin/JavafoDaemon.java
+popd